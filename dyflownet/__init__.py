@@ -10,4 +10,18 @@ controller = import_module('.controller',  __name__)
 
 utils = import_module('.utils',  __name__)
 
-__all__ = ['net', 'cell', 'flow', 'node', 'controller', 'utils'] 
\ No newline at end of file
+engine = import_module('.engine',  __name__)
+recorder = import_module('.recorder',  __name__)
+metrics = import_module('.metrics',  __name__)
+parallel = import_module('.parallel',  __name__)
+jit = import_module('.jit',  __name__)
+steady = import_module('.steady',  __name__)
+ensemble = import_module('.ensemble',  __name__)
+meanfield = import_module('.meanfield',  __name__)
+vectorfield = import_module('.vectorfield',  __name__)
+invariant = import_module('.invariant',  __name__)
+sampler = import_module('.sampler',  __name__)
+stream = import_module('.stream',  __name__)
+equilibrium = import_module('.equilibrium',  __name__)
+
+__all__ = ['net', 'cell', 'flow', 'node', 'controller', 'utils', 'engine', 'recorder', 'metrics', 'parallel', 'jit', 'steady', 'ensemble', 'meanfield', 'vectorfield', 'invariant', 'sampler', 'stream', 'equilibrium'] 
\ No newline at end of file
@@ -41,14 +41,15 @@ class Cell(utils.NetUnit):
 
     def initialize_state(self):
         if len(self.initial_condition['density']) == self.net.param['state_len']:
-            self.state['density'] = self.initial_condition['density']
+            # Copy, the density is updated in place.
+            self.state['density'] = np.array(self.initial_condition['density'], dtype=self.net.param['dtype'])
         else:
             raise ValueError('Wrong length of initial condition.')
 
 
     def initialize_co_state(self):
         for name in ['speed', 'inflow', 'outflow']:
-            self.co_state[name] = np.full(self.net.param['state_len'], np.nan)
+            self.co_state[name] = np.full(self.net.param['state_len'], np.nan, dtype=self.net.param['dtype'])
 
 
     def initialize_flow(self):
@@ -57,21 +58,39 @@ class Cell(utils.NetUnit):
 
 
     def update_speed(self):
-        self.co_state['speed'] = self.compute_speed(self.state['density'], self.co_state['outflow'])
+        self.compute_speed(self.state['density'], self.co_state['outflow'], out=self.co_state['speed'])
 
 
     def update_density(self):
-        self.state['density'] = self.compute_density(self.state['density'], self.co_state['inflow'], self.co_state['outflow'])
+        self.compute_density(self.state['density'], self.co_state['inflow'], self.co_state['outflow'], out=self.state['density'])
 
 
-    def compute_speed(self, density, outflow):
-        speed = np.divide(outflow, density, out=np.full_like(outflow, self.param['max_speed'], dtype=float), where=(density!=0))
-        return np.clip(speed, self.param['min_speed'], self.param['max_speed'])
+    def compute_speed(self, density, outflow, out=None):
+        if out is None:
+            out = np.full_like(outflow, self.param['max_speed'], dtype=self.net.param['dtype'])
+        else:
+            out.fill(self.param['max_speed'])
+
+        is_occupied = np.not_equal(density, 0, out=self.work_buffer('is_occupied', np.shape(density), bool))
+        np.divide(outflow, density, out=out, where=is_occupied)
+        return np.clip(out, self.param['min_speed'], self.param['max_speed'], out=out)
+
+
+    def compute_density(self, density, inflow, outflow, out=None):
+        # out may be density itself.
+        density_change = np.subtract(inflow, outflow, out=self.work_buffer('density_change', np.shape(inflow)))
+        np.multiply(density_change, self.net.param['time_step_size'], out=density_change)
+        np.divide(density_change, self.param['cell_len'], out=density_change)
+
+        out = np.add(density, density_change, out=out)
+        return np.clip(out, self.param['min_density'], self.param['max_density'], out=out)
 
 
-    def compute_density(self, density, inflow, outflow):
-        density = density + (inflow - outflow) * self.net.param['time_step_size'] / self.param['cell_len']
-        return np.clip(density, self.param['min_density'], self.param['max_density'])
+    def get_max_time_step(self, courant=1):
+        # Largest stable time step, courant * cell_len / fastest wave speed of the cell's flows; inf if none is bounded.
+        # Beyond it, a step moves more vehicles than the cell holds and compute_density clips the density.
+        wave_speed = max([f.get_wave_speed() for f in self.flow_dict.values() if f is not None], default=0)
+        return courant * self.param['cell_len'] / wave_speed if wave_speed > 0 else np.inf
 
 
     def save_output(self):
@@ -121,7 +140,7 @@ class Source(Cell):
 
     def update_boundary_inflow(self):
         self.flow_dict['boundary_inflow'].iterate()
-        self.co_state['inflow'] = self.flow_dict['boundary_inflow'].get_flow()
+        self.co_state['inflow'][...] = self.flow_dict['boundary_inflow'].get_flow()
 
     def update_sending(self):
         self.flow_dict['sending'].iterate()
@@ -148,7 +167,7 @@ class Sink(Cell):
 
     def update_boundary_outflow(self):
         self.flow_dict['boundary_outflow'].iterate()
-        self.co_state['outflow'] = self.flow_dict['boundary_outflow'].get_flow()
+        self.co_state['outflow'][...] = self.flow_dict['boundary_outflow'].get_flow()
 
 
 if __name__ == '__main__':
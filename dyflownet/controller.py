@@ -22,19 +22,23 @@ class LocalController(utils.NetUnit):
     
 
     def initialize_co_state(self):
-        self.co_state['control_input'] = np.full(self.net.param['state_len'], np.nan)
+        self.co_state['control_input'] = np.full(self.net.param['state_len'], np.nan, dtype=self.net.param['dtype'])
 
 
-    def compute_control_input(self):
-        return np.full(self.net.param['state_len'], np.nan)
+    def compute_control_input(self, out=None):
+        if out is None:
+            return np.full(self.net.param['state_len'], np.nan, dtype=self.net.param['dtype'])
+        out.fill(np.nan)
+        return out
 
 
-    def _compute_control_input(self):
-        return self.compute_control_input()
+    def _compute_control_input(self, out=None):
+        return self.compute_control_input(out=out)
 
 
     def iterate(self):
-        self.co_state['control_input'] = self._compute_control_input()
+        # Control inputs are written in place into the buffer allocated at initialize().
+        self._compute_control_input(out=self.co_state['control_input'])
 
 
     def get_control_input(self):
@@ -43,6 +47,9 @@ class LocalController(utils.NetUnit):
 
 
 class SoftmaxRoutingController(LocalController):
+    # gain: one per cell of cell_list.
+    shared_param_list = ['gain']
+
     def __init__(self, gain, min_control_input=0, max_control_input=1, node=None, cell_list=None, is_state_saved=True, is_co_state_saved=True):
 
         super().__init__(min_control_input, max_control_input, node, cell_list, is_state_saved, is_co_state_saved)
@@ -51,17 +58,22 @@ class SoftmaxRoutingController(LocalController):
     
 
     def initialize_co_state(self):
-        self.co_state['control_input'] = np.full([self.net.param['state_len'], len(self.cell_list)], np.nan)
+        self.co_state['control_input'] = np.full([self.net.param['state_len'], len(self.cell_list)], np.nan, dtype=self.net.param['dtype'])
+
 
+    def compute_control_input(self, density_list, out=None):
+        # utility: (state_len, num_cell), written into out.
+        utility = np.empty([len(density_list[0]), len(density_list)], dtype=self.net.param['dtype']) if out is None else out
+        for j, density in enumerate(density_list):
+            np.multiply(-self.param['gain'][j], density, out=utility[:, j])
+        np.exp(utility, out=utility)
 
-    def compute_control_input(self, density_list):
-        utility = np.array([np.exp(-self.param['gain'][j] * density) for j, density in enumerate(density_list)]).T
-        partition = np.sum(utility, axis=1).reshape(utility.shape[0], 1)
-        return utility / partition 
+        partition = np.sum(utility, axis=1, keepdims=True, out=self.work_buffer('partition', (utility.shape[0], 1)))
+        return np.divide(utility, partition, out=utility)
     
 
-    def _compute_control_input(self):
-        return self.compute_control_input([c.state['density'] for c in self.cell_list])
+    def _compute_control_input(self, out=None):
+        return self.compute_control_input([c.state['density'] for c in self.cell_list], out=out)
 
 
 
@@ -75,24 +87,28 @@ class ALINEA(LocalController):
 
     
     def initialize_state(self):
-        self.state['control_input'] = self.param['max_control_input'] * np.ones(self.net.param['state_len'])
+        self.state['control_input'] = self.param['max_control_input'] * np.ones(self.net.param['state_len'], dtype=self.net.param['dtype'])
 
     
     def initialize_co_state(self):
         pass
 
 
-    def compute_control_input(self, density, last_step_control_input):
-        control_input = last_step_control_input + self.param['gain'] * (self.param['setpoint'] - density)
-        return np.clip(control_input, self.param['min_control_input'], self.param['max_control_input'])
+    def compute_control_input(self, density, last_step_control_input, out=None):
+        # out may be last_step_control_input itself.
+        correction = np.subtract(self.param['setpoint'], density, out=self.work_buffer('correction', np.shape(density)))
+        np.multiply(self.param['gain'], correction, out=correction)
+
+        control_input = np.add(last_step_control_input, correction, out=out)
+        return np.clip(control_input, self.param['min_control_input'], self.param['max_control_input'], out=control_input)
 
 
-    def _compute_control_input(self):
-        return self.compute_control_input(self.cell_list[0].state['density'], self.state['control_input'])
+    def _compute_control_input(self, out=None):
+        return self.compute_control_input(self.cell_list[0].state['density'], self.state['control_input'], out=out)
          
     
     def iterate(self):
-        self.state['control_input'] = self._compute_control_input()
+        self._compute_control_input(out=self.state['control_input'])
 
 
     def get_control_input(self):
@@ -109,13 +125,14 @@ class AffineController(LocalController):
         self.param['gain'] = gain
 
 
-    def compute_control_input(self, density):
-        control_input = self.param['max_control_input'] - self.param['gain'] * density
-        return np.maximum(control_input, self.param['min_control_input'])
+    def compute_control_input(self, density, out=None):
+        control_input = np.multiply(self.param['gain'], density, out=out)
+        np.subtract(self.param['max_control_input'], control_input, out=control_input)
+        return np.maximum(control_input, self.param['min_control_input'], out=control_input)
     
 
-    def _compute_control_input(self):
-        return self.compute_control_input(self.cell_list[0].state['density'])
+    def _compute_control_input(self, out=None):
+        return self.compute_control_input(self.cell_list[0].state['density'], out=out)
 
 
 
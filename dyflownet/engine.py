@@ -0,0 +1,1132 @@
+import numpy as np
+from scipy import sparse
+from . import flow, jit, node, utils
+
+
+# ============================== Helpers =====================================
+
+def _stack_param(value_list, state_len, dtype=float):
+    # value: (1, ) or (state_len, ) -> stacked: (num_unit, state_len).
+    return np.stack([np.broadcast_to(np.asarray(v, dtype=dtype), (state_len,)) for v in value_list])
+
+
+def _stack_time_varying_param(value_list, state_len, dtype=float):
+    # value: (1, num_step) or (state_len, num_step) -> stacked: (num_unit, 1, num_step) or (num_unit, state_len, num_step).
+    value_list = [np.atleast_2d(np.asarray(v, dtype=dtype)) for v in value_list]
+    row_len = state_len if any(v.shape[0] != 1 for v in value_list) else 1
+    return np.stack([np.broadcast_to(v, (row_len, v.shape[1])) for v in value_list])
+
+
+def _unit_view(array, start, stop, shape=None):
+    # Rows [start, stop) of a packed array, seen with the unit's own layout (state_len first).
+    if shape is None:
+        return array[start]
+    return np.moveaxis(array[start:stop].reshape(shape + array.shape[1:]), len(shape), 0)
+
+
+def _as_slice(idx):
+    # Contiguous increasing indices as a slice, so that indexing gives a view instead of a copy.
+    if len(idx) > 0 and np.array_equal(idx, np.arange(idx[0], idx[0] + len(idx))):
+        return slice(int(idx[0]), int(idx[0]) + len(idx))
+    return idx
+
+
+def _take(work, name, array, idx):
+    # array[idx] along the first axis, written into the scratch buffer work[name].
+    buffer = utils.work_buffer(work, name, idx.shape + array.shape[1:], array.dtype)
+    return np.take(array, idx, axis=0, out=buffer, mode='clip')
+
+
+
+class Field:
+    # A state (or co-state) named key, packed over units: value has shape (num_row, state_len).
+    def __init__(self, key, value, owner_list, is_state):
+        self.key = key
+        self.value = value
+        self.is_state = is_state
+
+        # owner_list: [(unit, start, stop, shape)], rows [start, stop) of value belong to unit.
+        self.owner_list = owner_list
+
+        # recorder_list: [(saved_row, view, recorder)], set at initialize_output(); view is the unit's state of a
+        # recorder of the unit's layout, None for a packed block.
+        self.recorder_list = []
+        self.work = {}
+
+
+    def _is_saved(self, unit):
+        return unit.param['is_state_saved'] if self.is_state else unit.param['is_co_state_saved']
+
+
+    def bind(self):
+        for unit, start, stop, shape in self.owner_list:
+            target = unit.state if self.is_state else unit.co_state
+            target[self.key] = _unit_view(self.value, start, stop, shape)
+
+
+    def initialize_output(self, net, name):
+        # Saved owners are grouped by the recorder prototype matched by the network's recorder rule,
+        # each group is recorded as one packed block, named '<name>.<group>:<key>'. Prototypes of the unit's layout
+        # (see Recorder.is_unit_layout()) record each owner on its own, named '<unit name>:<key>' as in the object engine.
+        recorder_group = {}
+        for owner in self.owner_list:
+            if self._is_saved(owner[0]):
+                prototype = net.match_recorder(owner[0], self.key)
+                if prototype is not None:
+                    group_key = ('unit', id(owner[0])) if prototype.is_unit_layout() else ('prototype', id(prototype))
+                    recorder_group.setdefault(group_key, (prototype, []))[1].append(owner)
+
+        # output: (num_saved_row, state_len, num_step+1) for states, (num_saved_row, state_len, num_step) for co-states.
+        num_record = net.param['num_step'] + 1 if self.is_state else net.param['num_step']
+
+        self.recorder_list = []
+        for k, ((kind, _), (prototype, saved_owner_list)) in enumerate(recorder_group.items()):
+            recorder = prototype.new()
+
+            if kind == 'unit':
+                unit, start, stop, shape = saved_owner_list[0]
+                view = _unit_view(self.value, start, stop, shape)
+                output = recorder.allocate(view.shape, num_record, f'{net.get_unit_name(unit)}:{self.key}', view.dtype)
+                if self.is_state:
+                    recorder.write(0, view)
+                self.recorder_list.append((None, view, recorder))
+
+                target = unit.state_output if self.is_state else unit.co_state_output
+                target[self.key] = output
+                continue
+
+            # saved_row: a slice when the saved rows are contiguous (the usual case), an index array otherwise.
+            saved_row = _as_slice(np.concatenate([np.arange(start, stop) for _, start, stop, _ in saved_owner_list]))
+            saved_value = self.get_saved_value(k, saved_row)
+
+            output = recorder.allocate(saved_value.shape, num_record, f'{name}.{k}:{self.key}', saved_value.dtype)
+            if self.is_state:
+                recorder.write(0, saved_value)
+            self.recorder_list.append((saved_row, None, recorder))
+
+            offset = 0
+            for unit, start, stop, shape in saved_owner_list:
+                target = unit.state_output if self.is_state else unit.co_state_output
+                target[self.key] = _unit_view(output, offset, offset + stop - start, shape)
+                offset += stop - start
+
+
+    def get_saved_value(self, k, saved_row):
+        if isinstance(saved_row, slice):
+            return self.value[saved_row]
+        return _take(self.work, f'saved_value_{k}', self.value, saved_row)
+
+
+    def save_output(self, step):
+        for k, (saved_row, view, recorder) in enumerate(self.recorder_list):
+            recorder.write(step + 1 if self.is_state else step, self.get_saved_value(k, saved_row) if view is None else view)
+
+
+    def finalize_output(self):
+        for _, _, recorder in self.recorder_list:
+            recorder.finalize()
+
+
+
+# ============================== Flow groups =====================================
+
+class FlowGroup:
+    # Flows of one type (and one variant of that type) evaluated together.
+    co_state_name_list = []
+
+    def __init__(self, flow_list, start, engine):
+        self.flow_list = flow_list
+        self.rows = slice(start, start + len(flow_list))
+
+        # cell_idx: (num_flow, ).
+        self.cell_idx = np.array([engine.cell_index[id(f.cell)] for f in flow_list], dtype=int)
+
+        self.param = {}
+        self.co_state = {}
+
+        # Scratch buffers reused across steps.
+        self.work = {}
+
+
+    @staticmethod
+    def variant(flow_obj):
+        return None
+
+
+    def _stack(self, name):
+        net_param = self.flow_list[0].net.param
+        return _stack_param([f.param[name] for f in self.flow_list], net_param['state_len'], net_param['dtype'])
+
+
+    def _stack_time_varying(self, name):
+        net_param = self.flow_list[0].net.param
+        return _stack_time_varying_param([f.param[name] for f in self.flow_list], net_param['state_len'], net_param['dtype'])
+
+
+    def work_buffer(self, name, shape, dtype=None):
+        return utils.work_buffer(self.work, name, shape, self.flow_list[0].net.param['dtype'] if dtype is None else dtype)
+
+
+    def get_density(self, engine):
+        # density: (num_flow, state_len).
+        return _take(self.work, 'density', engine.density, self.cell_idx)
+
+
+    def pack(self):
+        pass
+
+
+    def compute(self, engine, out):
+        # out: (num_flow, state_len).
+        out[...] = np.nan
+
+
+    def compute_kernel(self, engine, out):
+        # Compiled counterpart of compute() for backend='numba', see jit.py; compute() where there is none.
+        self.compute(engine, out)
+
+
+
+class BoundaryInflowGroup(FlowGroup):
+    @staticmethod
+    def variant(flow_obj):
+        return flow_obj.param['is_bc_constant']
+
+
+    def pack(self):
+        if self.flow_list[0].param['is_bc_constant']:
+            self.param['boundary_inflow'] = self._stack('boundary_inflow')
+        else:
+            self.param['boundary_inflow'] = self._stack_time_varying('boundary_inflow')
+
+
+    def compute(self, engine, out):
+        if self.flow_list[0].param['is_bc_constant']:
+            out[...] = self.param['boundary_inflow']
+        else:
+            out[...] = self.param['boundary_inflow'][..., engine.net.step]
+
+
+
+class BoundaryOutflowGroup(FlowGroup):
+    @staticmethod
+    def variant(flow_obj):
+        return flow_obj.param['is_bc_constant']
+
+
+    def pack(self):
+        stack = self._stack if self.flow_list[0].param['is_bc_constant'] else self._stack_time_varying
+        self.param['boundary_speed'] = stack('boundary_speed')
+        self.param['boundary_capacity'] = stack('boundary_capacity')
+
+
+    def compute(self, engine, out):
+        if self.flow_list[0].param['is_bc_constant']:
+            boundary_speed, boundary_capacity = self.param['boundary_speed'], self.param['boundary_capacity']
+        else:
+            boundary_speed = self.param['boundary_speed'][..., engine.net.step]
+            boundary_capacity = self.param['boundary_capacity'][..., engine.net.step]
+
+        np.multiply(boundary_speed, self.get_density(engine), out=out)
+        np.minimum(out, boundary_capacity, out=out)
+
+
+    def compute_kernel(self, engine, out):
+        if self.flow_list[0].param['is_bc_constant']:
+            boundary_speed, boundary_capacity = self.param['boundary_speed'], self.param['boundary_capacity']
+        else:
+            boundary_speed = np.broadcast_to(self.param['boundary_speed'][..., engine.net.step], out.shape)
+            boundary_capacity = np.broadcast_to(self.param['boundary_capacity'][..., engine.net.step], out.shape)
+
+        jit.boundary_outflow(engine.density, self.cell_idx, boundary_speed, boundary_capacity, out)
+
+
+
+class BufferSendingGroup(FlowGroup):
+    def __init__(self, flow_list, start, engine):
+        super().__init__(flow_list, start, engine)
+
+        # cell_len: (num_flow, state_len).
+        self.param['cell_len'] = engine.param['cell_len'][self.cell_idx]
+
+
+    @staticmethod
+    def variant(flow_obj):
+        return flow_obj.param['is_demand_constant'], flow_obj.param['ignore_queue']
+
+
+    def pack(self):
+        if self.flow_list[0].param['is_demand_constant']:
+            self.param['demand'] = self._stack('demand')
+        else:
+            self.param['demand'] = self._stack_time_varying('demand')
+        self.param['capacity'] = self._stack('capacity')
+
+
+    def compute(self, engine, out):
+        if self.flow_list[0].param['is_demand_constant']:
+            demand = self.param['demand']
+        else:
+            demand = self.param['demand'][..., engine.net.step]
+
+        if self.flow_list[0].param['ignore_queue']:
+            out[...] = demand
+        else:
+            # Queue length first, then demand plus the queue discharged over one step.
+            np.multiply(self.get_density(engine), self.param['cell_len'], out=out)
+            np.divide(out, engine.net.param['time_step_size'], out=out)
+            np.add(demand, out, out=out)
+            np.minimum(out, self.param['capacity'], out=out)
+
+
+
+class PiecewiseLinearSendingGroup(FlowGroup):
+    def pack(self):
+        self.param['free_flow_speed'] = self._stack('free_flow_speed')
+        self.param['capacity'] = self._stack('capacity')
+
+
+    def compute(self, engine, out):
+        np.multiply(self.param['free_flow_speed'], self.get_density(engine), out=out)
+        np.clip(out, 0, self.param['capacity'], out=out)
+
+
+    def compute_kernel(self, engine, out):
+        jit.piecewise_linear_sending(engine.density, self.cell_idx, self.param['free_flow_speed'], self.param['capacity'], out)
+
+
+
+class CapacityDropPiecewiseLinearSendingGroup(FlowGroup):
+    co_state_name_list = ['real_capacity']
+
+    def pack(self):
+        for name in ['free_flow_speed', 'capacity', 'capacity_drop_density_threshold', 'capacity_dropped']:
+            self.param[name] = self._stack(name)
+
+
+    def compute(self, engine, out):
+        density = self.get_density(engine)
+        real_capacity = self.co_state['real_capacity']
+
+        is_dropped = np.greater(density, self.param['capacity_drop_density_threshold'], out=self.work_buffer('is_dropped', out.shape, bool))
+        np.copyto(real_capacity, self.param['capacity'])
+        np.copyto(real_capacity, self.param['capacity_dropped'], where=is_dropped)
+
+        np.multiply(self.param['free_flow_speed'], density, out=out)
+        np.clip(out, 0, real_capacity, out=out)
+
+
+    def compute_kernel(self, engine, out):
+        jit.capacity_drop_piecewise_linear_sending(engine.density, self.cell_idx, self.param['free_flow_speed'], self.param['capacity'],
+                                                   self.param['capacity_drop_density_threshold'], self.param['capacity_dropped'], self.co_state['real_capacity'], out)
+
+
+
+class UnboundedReceivingGroup(FlowGroup):
+    def compute(self, engine, out):
+        out.fill(np.inf)
+
+
+
+class PiecewiseLinearReceivingGroup(FlowGroup):
+    def pack(self):
+        for name in ['congestion_wave_speed', 'max_density', 'capacity']:
+            self.param[name] = self._stack(name)
+
+
+    def compute(self, engine, out):
+        np.subtract(self.param['max_density'], self.get_density(engine), out=out)
+        np.multiply(self.param['congestion_wave_speed'], out, out=out)
+        np.clip(out, 0, self.param['capacity'], out=out)
+
+
+    def compute_kernel(self, engine, out):
+        jit.piecewise_linear_receiving(engine.density, self.cell_idx, self.param['congestion_wave_speed'], self.param['max_density'], self.param['capacity'], out)
+
+
+
+class LookAheadPiecewiseLinearReceivingGroup(FlowGroup):
+    def __init__(self, flow_list, start, engine):
+        super().__init__(flow_list, start, engine)
+
+        # upstream_cell_idx: (num_flow, ).
+        self.upstream_cell_idx = np.array([engine.cell_index[id(f.cell_upstream)] for f in flow_list], dtype=int)
+
+
+    def pack(self):
+        for name in ['congestion_wave_speed', 'max_density', 'capacity', 'look_ahead_density_threshold',
+                     'look_ahead_congestion_wave_speed', 'look_ahead_max_density', 'look_ahead_capacity']:
+            self.param[name] = self._stack(name)
+
+
+    def _select(self, name, is_look_ahead_triggered):
+        real_value = self.work_buffer(f'real_{name}', is_look_ahead_triggered.shape)
+        np.copyto(real_value, self.param[name])
+        np.copyto(real_value, self.param[f'look_ahead_{name}'], where=is_look_ahead_triggered)
+        return real_value
+
+
+    def compute(self, engine, out):
+        density_upstream = _take(self.work, 'density_upstream', engine.density, self.upstream_cell_idx)
+        is_look_ahead_triggered = np.less_equal(density_upstream, self.param['look_ahead_density_threshold'], out=self.work_buffer('is_look_ahead_triggered', out.shape, bool))
+
+        real_congestion_wave_speed = self._select('congestion_wave_speed', is_look_ahead_triggered)
+        real_max_density = self._select('max_density', is_look_ahead_triggered)
+        real_capacity = self._select('capacity', is_look_ahead_triggered)
+
+        np.subtract(real_max_density, self.get_density(engine), out=out)
+        np.multiply(real_congestion_wave_speed, out, out=out)
+        np.clip(out, 0, real_capacity, out=out)
+
+
+    def compute_kernel(self, engine, out):
+        jit.look_ahead_piecewise_linear_receiving(
+            engine.density, self.cell_idx, self.upstream_cell_idx,
+            *[self.param[name] for name in ['congestion_wave_speed', 'max_density', 'capacity', 'look_ahead_density_threshold',
+                                            'look_ahead_congestion_wave_speed', 'look_ahead_max_density', 'look_ahead_capacity']],
+            out,
+        )
+
+
+
+# Flow types with a batched kernel. Other flow types (including subclasses) are stepped object by object.
+FLOW_GROUP = {
+    flow.BoundaryInflow: BoundaryInflowGroup,
+    flow.BoundaryOutflow: BoundaryOutflowGroup,
+    flow.BufferSendingFlow: BufferSendingGroup,
+    flow.PiecewiseLinearSendingFlow: PiecewiseLinearSendingGroup,
+    flow.CapacityDropPiecewiseLinearSendingFlow: CapacityDropPiecewiseLinearSendingGroup,
+    flow.UnboundedReceivingFlow: UnboundedReceivingGroup,
+    flow.PiecewiseLinearReceivingFlow: PiecewiseLinearReceivingGroup,
+    flow.LookAheadPiecewiseLinearReceivingFlow: LookAheadPiecewiseLinearReceivingGroup,
+}
+
+
+
+# ============================== Node groups =====================================
+
+class NodeGroup:
+    # Nodes of one type (and one variant of that type) with the same number of incoming and outgoing cells.
+    def __init__(self, node_list, start, engine):
+        self.node_list = node_list
+
+        self.param = {
+            'num_incoming_cell': node_list[0].param['num_incoming_cell'],
+            'num_outgoing_cell': node_list[0].param['num_outgoing_cell'],
+        }
+        self.rows = slice(start, start + len(node_list) * self.param['num_incoming_cell'] * self.param['num_outgoing_cell'])
+
+        # sending_row: (num_node, num_incoming_cell), receiving_row: (num_node, num_outgoing_cell).
+        self.sending_row = np.array([[engine.sending_row[engine.cell_index[id(c)]] for c in n.incoming_cell_list] for n in node_list], dtype=int)
+        self.receiving_row = np.array([[engine.receiving_row[engine.cell_index[id(c)]] for c in n.outgoing_cell_list] for n in node_list], dtype=int)
+
+        # Scratch buffers reused across steps.
+        self.work = {}
+
+
+    @staticmethod
+    def variant(node_obj):
+        return None
+
+
+    def _stack(self, value_list):
+        net_param = self.node_list[0].net.param
+        return _stack_param(value_list, net_param['state_len'], net_param['dtype'])
+
+
+    def _stack_time_varying(self, value_list):
+        net_param = self.node_list[0].net.param
+        return _stack_time_varying_param(value_list, net_param['state_len'], net_param['dtype'])
+
+
+    def _work_buffer(self, name, out, dtype=None):
+        # Scratch array shaped like one movement of every node in the group: (num_node, state_len).
+        return utils.work_buffer(self.work, name, out.shape[:1] + out.shape[3:], out.dtype if dtype is None else dtype)
+
+
+    def get_sending(self, engine):
+        return _take(self.work, 'sending', engine.flow, self.sending_row)
+
+
+    def get_receiving(self, engine):
+        return _take(self.work, 'receiving', engine.flow, self.receiving_row)
+
+
+    def pack(self):
+        pass
+
+
+    def compute(self, engine, sending, receiving, out):
+        # sending: (num_node, num_incoming_cell, state_len), receiving: (num_node, num_outgoing_cell, state_len).
+        # out: (num_node, num_incoming_cell, num_outgoing_cell, state_len).
+        out[...] = 0
+
+
+    def compute_kernel(self, engine, out):
+        # Compiled counterpart of compute() for backend='numba', reading sending and receiving flows in place.
+        self.compute(engine, self.get_sending(engine), self.get_receiving(engine), out)
+
+
+    def _time_param(self, name, engine, out):
+        # Constant (num_node, state_len) parameter, or this step's column of a time-varying one, broadcast to it.
+        if self.node_list[0].param['is_split_ratio_constant']:
+            return self.param[name]
+        return np.broadcast_to(self.param[name][..., engine.net.step], out.shape[:1] + out.shape[3:])
+
+
+
+class BasicJunctionGroup(NodeGroup):
+    def compute(self, engine, sending, receiving, out):
+        np.minimum(sending[:, 0], receiving[:, 0], out=out[:, 0, 0])
+
+
+    def compute_kernel(self, engine, out):
+        jit.basic_junction(engine.flow, self.sending_row, self.receiving_row, out)
+
+
+
+class TwoToOneMergeJunctionGroup(NodeGroup):
+    def pack(self):
+        self.param['merging_priority_0'] = self._stack([n.param['merging_priority'][:, 0] for n in self.node_list])
+        self.param['merging_priority_1'] = self._stack([n.param['merging_priority'][:, 1] for n in self.node_list])
+
+
+    def compute(self, engine, sending, receiving, out):
+        sending_i_0, sending_i_1 = sending[:, 0], sending[:, 1]
+        receiving_j_0 = receiving[:, 0]
+
+        p_i_0, p_i_1 = self.param['merging_priority_0'], self.param['merging_priority_1']
+
+        flow_i_0_j_0, flow_i_1_j_0 = out[:, 0, 0], out[:, 1, 0]
+        remaining, priority_share, work = (self._work_buffer(name, out) for name in ['remaining', 'priority_share', 'work'])
+
+        is_space_enough = self._work_buffer('is_space_enough', out, bool)
+        np.less_equal(np.add(sending_i_0, sending_i_1, out=remaining), receiving_j_0, out=is_space_enough)
+
+        utils.median_of_three(sending_i_0, np.subtract(receiving_j_0, sending_i_1, out=remaining), np.multiply(p_i_0, receiving_j_0, out=priority_share), out=flow_i_0_j_0, work=work)
+        np.copyto(flow_i_0_j_0, sending_i_0, where=is_space_enough)
+
+        utils.median_of_three(sending_i_1, np.subtract(receiving_j_0, sending_i_0, out=remaining), np.multiply(p_i_1, receiving_j_0, out=priority_share), out=flow_i_1_j_0, work=work)
+        np.copyto(flow_i_1_j_0, sending_i_1, where=is_space_enough)
+
+
+    def compute_kernel(self, engine, out):
+        jit.two_to_one_merge_junction(engine.flow, self.sending_row, self.receiving_row, self.param['merging_priority_0'], self.param['merging_priority_1'], out)
+
+
+
+class OneToTwoDivergeJunctionGroup(NodeGroup):
+    @staticmethod
+    def variant(node_obj):
+        return node_obj.param['is_split_ratio_constant'], node_obj.param['is_FIFO']
+
+
+    def pack(self):
+        stack = self._stack if self.node_list[0].param['is_split_ratio_constant'] else self._stack_time_varying
+        self.param['split_ratio_0'] = stack([n.param['split_ratio'][:, 0] for n in self.node_list])
+        self.param['split_ratio_1'] = stack([n.param['split_ratio'][:, 1] for n in self.node_list])
+
+
+    def compute(self, engine, sending, receiving, out):
+        sending_i_0 = sending[:, 0]
+        receiving_j_0, receiving_j_1 = receiving[:, 0], receiving[:, 1]
+
+        if self.node_list[0].param['is_split_ratio_constant']:
+            split_j_0, split_j_1 = self.param['split_ratio_0'], self.param['split_ratio_1']
+        else:
+            split_j_0, split_j_1 = self.param['split_ratio_0'][..., engine.net.step], self.param['split_ratio_1'][..., engine.net.step]
+
+        flow_i_0_j_0, flow_i_0_j_1 = out[:, 0, 0], out[:, 0, 1]
+
+        if not self.node_list[0].param['is_FIFO']:
+            np.minimum(np.multiply(split_j_0, sending_i_0, out=flow_i_0_j_0), receiving_j_0, out=flow_i_0_j_0)
+            np.minimum(np.multiply(split_j_1, sending_i_0, out=flow_i_0_j_1), receiving_j_1, out=flow_i_0_j_1)
+        else:
+            total_flow, work = self._work_buffer('total_flow', out), self._work_buffer('work', out)
+            is_split = self._work_buffer('is_split', out, bool)
+
+            np.minimum(sending_i_0, utils.safe_div(receiving_j_0, split_j_0, out=work, mask=is_split), out=total_flow)
+            np.minimum(total_flow, utils.safe_div(receiving_j_1, split_j_1, out=work, mask=is_split), out=total_flow)
+            np.multiply(split_j_0, total_flow, out=flow_i_0_j_0)
+            np.multiply(split_j_1, total_flow, out=flow_i_0_j_1)
+
+
+    def compute_kernel(self, engine, out):
+        jit.one_to_two_diverge_junction(engine.flow, self.sending_row, self.receiving_row, self._time_param('split_ratio_0', engine, out),
+                                        self._time_param('split_ratio_1', engine, out), self.node_list[0].param['is_FIFO'], out.dtype.type(np.inf), out)
+
+
+
+class FreewayRampJunctionGroup(NodeGroup):
+    @staticmethod
+    def variant(node_obj):
+        return node_obj.param['is_split_ratio_constant'], node_obj.controller is not None
+
+
+    def pack(self):
+        self.param['onramp_priority'] = self._stack([n.param['onramp_priority'][:, 0] for n in self.node_list])
+
+        stack = self._stack if self.node_list[0].param['is_split_ratio_constant'] else self._stack_time_varying
+        self.param['split_to_mainline'] = stack([n.param['split_ratio'][:, 0] for n in self.node_list])
+        self.param['split_to_offramp'] = stack([n.param['split_ratio'][:, 1] for n in self.node_list])
+
+
+    def get_control_input(self, out):
+        # control_input: (num_node, state_len).
+        control_input = self._work_buffer('control_input', out)
+        for k, n in enumerate(self.node_list):
+            control_input[k] = n.controller.get_control_input()
+        return control_input
+
+
+    def compute(self, engine, sending, receiving, out):
+        sending_mainline, sending_onramp = sending[:, 0], sending[:, 1]
+        receiving_mainline, receiving_offramp = receiving[:, 0], receiving[:, 1]
+
+        p_onramp = self.param['onramp_priority']
+        if self.node_list[0].param['is_split_ratio_constant']:
+            split_to_mainline, split_to_offramp = self.param['split_to_mainline'], self.param['split_to_offramp']
+        else:
+            split_to_mainline, split_to_offramp = self.param['split_to_mainline'][..., engine.net.step], self.param['split_to_offramp'][..., engine.net.step]
+
+        flow_mainline_to_mainline, flow_mainline_to_offramp = out[:, 0, 0], out[:, 0, 1]
+        flow_onramp_to_mainline = out[:, 1, 0]
+
+        work_0, work_1 = self._work_buffer('work_0', out), self._work_buffer('work_1', out)
+        mask = self._work_buffer('mask', out, bool)
+
+        # Compute flow from onramp to mainline.
+        np.minimum(sending_onramp, receiving_mainline, out=flow_onramp_to_mainline)
+        if self.node_list[0].controller is not None:
+            np.minimum(flow_onramp_to_mainline, self.get_control_input(out), out=flow_onramp_to_mainline)
+
+        # Compute flow from mainline to mainline.
+        sending_mainline_to_mainline = utils.safe_div(receiving_offramp, split_to_offramp, out=work_0, mask=mask)
+        np.minimum(sending_mainline, sending_mainline_to_mainline, out=sending_mainline_to_mainline)
+        np.multiply(split_to_mainline, sending_mainline_to_mainline, out=sending_mainline_to_mainline)
+        remaining_mainline = np.subtract(receiving_mainline, np.multiply(p_onramp, flow_onramp_to_mainline, out=work_1), out=work_1)
+        np.minimum(sending_mainline_to_mainline, remaining_mainline, out=flow_mainline_to_mainline)
+
+        # Compute flow from mainline to off-ramp.
+        np.minimum(sending_mainline, receiving_offramp, out=flow_mainline_to_offramp)
+        offramp_to_mainline_ratio = utils.safe_div(split_to_offramp, split_to_mainline, out=work_0, mask=mask)
+        np.multiply(flow_mainline_to_mainline, offramp_to_mainline_ratio, out=offramp_to_mainline_ratio)
+        np.copyto(flow_mainline_to_offramp, offramp_to_mainline_ratio, where=np.not_equal(split_to_mainline, 0, out=mask))
+
+
+    def compute_kernel(self, engine, out):
+        has_control = self.node_list[0].controller is not None
+        control_input = self.get_control_input(out) if has_control else self._work_buffer('control_input', out)
+
+        jit.freeway_ramp_junction(engine.flow, self.sending_row, self.receiving_row, self.param['onramp_priority'], self._time_param('split_to_mainline', engine, out),
+                                  self._time_param('split_to_offramp', engine, out), has_control, control_input, out.dtype.type(np.inf), out)
+
+
+
+# Node types with a batched kernel. Other node types (including subclasses) are stepped object by object.
+NODE_GROUP = {
+    node.BasicJunction: BasicJunctionGroup,
+    node.TwoToOneMergeJunction: TwoToOneMergeJunctionGroup,
+    node.OneToTwoDivergeJunction: OneToTwoDivergeJunctionGroup,
+    node.FreewayRampJunction: FreewayRampJunctionGroup,
+}
+
+
+
+# ============================== Engine =====================================
+
+class ArrayEngine:
+    # Struct-of-arrays execution of a Network: all cells, flows and inter-cell flows are packed into
+    # (num_row, state_len) arrays and each phase of Network.run_one_step runs as a few whole-network operations.
+    # The units' state and co_state entries become views into the packed arrays, so the object API keeps working.
+    # Every array is allocated in initialize(); a step only writes into them and into reused scratch buffers.
+    # backend: 'numpy', or 'numba' for the compiled kernels of jit.py (NumPy is used if Numba is not installed).
+    def __init__(self, net, backend='numpy'):
+        self.net = net
+
+        self.cell_list = net.source_list + net.link_list + net.sink_list
+        self.cell_index = {id(c): i for i, c in enumerate(self.cell_list)}
+
+        self.node_list = list(net.node_list)
+        self.controller_list = [n.controller for n in self.node_list if n.controller is not None]
+
+        if backend not in ('numpy', 'numba'):
+            raise ValueError(f'Unknown backend: {backend}.')
+
+        self.param = {
+            'backend': backend,
+            'use_kernel': backend == 'numba' and jit.HAS_NUMBA,
+        }
+
+        self.compile_cell()
+        self.compile_flow()
+        self.compile_node()
+
+        self.field_list = []
+        self.work = {}
+
+
+    def compile_cell(self):
+        # Cell parameters: (num_cell, state_len), stored full width since an in-place operation with a (num_cell, 1)
+        # operand broadcast against (num_cell, state_len) allocates a temporary the size of its output.
+        shape = (len(self.cell_list), self.net.param['state_len'])
+        for name in ['min_density', 'max_density', 'min_speed', 'max_speed', 'cell_len']:
+            value = np.array([[c.param[name]] for c in self.cell_list], dtype=self.net.param['dtype'])
+            self.param[name] = np.ascontiguousarray(np.broadcast_to(value, shape))
+
+
+    def compile_flow(self):
+        grouped_flow, self.fallback_flow_list = {}, []
+        role_list = []
+
+        for c in self.cell_list:
+            for name, f in c.flow_dict.items():
+                if f is None:
+                    continue
+
+                role_list.append((name, c, f))
+
+                group_type = FLOW_GROUP.get(type(f))
+                if group_type is None:
+                    self.fallback_flow_list.append(f)
+                else:
+                    grouped_flow.setdefault((group_type, group_type.variant(f)), []).append(f)
+
+        # Grouped flows occupy contiguous rows, fallback flows come last.
+        self.flow_group_list, start = [], 0
+        for (group_type, _), flow_list in grouped_flow.items():
+            group = group_type(flow_list, start, self)
+            group.pack()
+            self.flow_group_list.append(group)
+            start += len(flow_list)
+
+        self.flow_row = {}
+        for group in self.flow_group_list:
+            for i, f in enumerate(group.flow_list):
+                self.flow_row[id(f)] = group.rows.start + i
+        for i, f in enumerate(self.fallback_flow_list):
+            self.flow_row[id(f)] = start + i
+
+        self.param['num_flow'] = start + len(self.fallback_flow_list)
+
+        # Boundary flows feed the inflow of sources and the outflow of sinks.
+        boundary_inflow = [(self.cell_index[id(c)], self.flow_row[id(f)]) for name, c, f in role_list if name == 'boundary_inflow']
+        boundary_outflow = [(self.cell_index[id(c)], self.flow_row[id(f)]) for name, c, f in role_list if name == 'boundary_outflow']
+
+        self.boundary_inflow_cell, self.boundary_inflow_row = np.array(boundary_inflow, dtype=int).reshape(-1, 2).T
+        self.boundary_outflow_cell, self.boundary_outflow_row = np.array(boundary_outflow, dtype=int).reshape(-1, 2).T
+
+        # sending_row, receiving_row: (num_cell, ), -1 if the cell has no such flow.
+        self.sending_row = np.full(len(self.cell_list), -1, dtype=int)
+        self.receiving_row = np.full(len(self.cell_list), -1, dtype=int)
+        for name, c, f in role_list:
+            if name == 'sending':
+                self.sending_row[self.cell_index[id(c)]] = self.flow_row[id(f)]
+            elif name == 'receiving':
+                self.receiving_row[self.cell_index[id(c)]] = self.flow_row[id(f)]
+
+
+    def compile_node(self):
+        grouped_node, self.fallback_node_list = {}, []
+        for n in self.node_list:
+            group_type = NODE_GROUP.get(type(n))
+            if group_type is None:
+                self.fallback_node_list.append(n)
+            else:
+                key = (group_type, group_type.variant(n), n.param['num_incoming_cell'], n.param['num_outgoing_cell'])
+                grouped_node.setdefault(key, []).append(n)
+
+        # Grouped nodes come first so that each group occupies contiguous movements.
+        self.node_group_list, start = [], 0
+        for (group_type, _, num_incoming, num_outgoing), node_list in grouped_node.items():
+            group = group_type(node_list, start, self)
+            group.pack()
+            self.node_group_list.append(group)
+            start += len(node_list) * num_incoming * num_outgoing
+
+        self.node_list = [n for group in self.node_group_list for n in group.node_list] + self.fallback_node_list
+
+        # Inter-cell flows of all nodes are flattened into movements, node by node, incoming-major.
+        self.node_block, start = [], 0
+        for n in self.node_list:
+            num_incoming, num_outgoing = n.param['num_incoming_cell'], n.param['num_outgoing_cell']
+            incoming_idx = np.array([self.cell_index[id(c)] for c in n.incoming_cell_list], dtype=int)
+            outgoing_idx = np.array([self.cell_index[id(c)] for c in n.outgoing_cell_list], dtype=int)
+            self.node_block.append((start, start + num_incoming * num_outgoing, incoming_idx, outgoing_idx))
+            start += num_incoming * num_outgoing
+
+        self.param['num_movement'] = start
+
+        # Incidence of movements on the cells they leave (tail) and enter (head), built once.
+        # tail_cell: (num_tail_cell, ), outflow_incidence: (num_tail_cell, num_movement).
+        # head_cell: (num_head_cell, ), inflow_incidence: (num_head_cell, num_movement).
+        movement_incoming = np.concatenate([np.zeros(0, dtype=int)] + [np.repeat(i_idx, len(o_idx)) for _, _, i_idx, o_idx in self.node_block])
+        movement_outgoing = np.concatenate([np.zeros(0, dtype=int)] + [np.tile(o_idx, len(i_idx)) for _, _, i_idx, o_idx in self.node_block])
+
+        self.tail_cell = np.unique(np.concatenate([np.zeros(0, dtype=int)] + [i_idx for _, _, i_idx, _ in self.node_block]))
+        self.head_cell = np.unique(np.concatenate([np.zeros(0, dtype=int)] + [o_idx for _, _, _, o_idx in self.node_block]))
+
+        self.outflow_incidence = self._incidence(self.tail_cell, movement_incoming)
+        self.inflow_incidence = self._incidence(self.head_cell, movement_outgoing)
+
+
+    def _incidence(self, cell_idx, movement_cell):
+        num_movement = self.param['num_movement']
+        return sparse.csr_matrix(
+            (np.ones(num_movement), (np.searchsorted(cell_idx, movement_cell), np.arange(num_movement))),
+            shape=(len(cell_idx), num_movement),
+        )
+
+
+    def _segment(self, cell_idx, incidence):
+        # Cells with at least one movement, where their movements start and stop in incidence.indices, and the other cells.
+        is_nonempty = np.diff(incidence.indptr) > 0
+        return cell_idx[is_nonempty], incidence.indptr[:-1][is_nonempty], incidence.indptr[1:][is_nonempty], cell_idx[~is_nonempty]
+
+
+    def work_buffer(self, name, shape, dtype=None):
+        return utils.work_buffer(self.work, name, shape, self.net.param['dtype'] if dtype is None else dtype)
+
+
+    def pack(self):
+        # Re-pack the parameters of the flow and node groups after they were changed on the units, see stream.run().
+        for group in self.flow_group_list + self.node_group_list:
+            group.pack()
+
+
+    def initialize(self):
+        net = self.net
+        state_len, dtype = net.param['state_len'], net.param['dtype']
+
+        for c in self.cell_list:
+            c.initialize_param()
+            c.initialize_state()
+            c.initialize_co_state()
+            c.state_output, c.co_state_output = {}, {}
+
+        for group in self.flow_group_list:
+            group.work = {}
+            for f in group.flow_list:
+                f.initialize_param()
+                f.initialize_state()
+                f.initialize_co_state()
+                f.state_output, f.co_state_output = {}, {}
+
+        for f in self.fallback_flow_list:
+            f.initialize()
+
+        for group in self.node_group_list:
+            group.work = {}
+
+        for n in self.node_list:
+            n.initialize_param()
+            n.initialize_state()
+            n.initialize_co_state()
+            n.initialize_work()
+            n.initialize_controller()
+            n.state_output, n.co_state_output = {}, {}
+
+        self.work = {}
+
+        num_cell = len(self.cell_list)
+
+        # Cell states and co-states: (num_cell, state_len).
+        self.density = np.array([c.state['density'] for c in self.cell_list], dtype=dtype).reshape(num_cell, state_len)
+        self.speed = np.full((num_cell, state_len), np.nan, dtype=dtype)
+        self.inflow = np.full((num_cell, state_len), np.nan, dtype=dtype)
+        self.outflow = np.full((num_cell, state_len), np.nan, dtype=dtype)
+
+        # Flows: (num_flow, state_len).
+        self.flow = np.full((self.param['num_flow'], state_len), np.nan, dtype=dtype)
+
+        # Movements: (num_movement, state_len).
+        self.movement = np.zeros((self.param['num_movement'], state_len), dtype=dtype)
+
+        # Conservation is a segmented sum of the movements, ordered by the CSR incidences.
+        # A cell whose node has no movement at all always sees zero outflow (inflow).
+        self.outflow_cell, self.outflow_segment, self.outflow_segment_stop, empty_tail_cell = self._segment(self.tail_cell, self.outflow_incidence)
+        self.inflow_cell, self.inflow_segment, self.inflow_segment_stop, empty_head_cell = self._segment(self.head_cell, self.inflow_incidence)
+        self.outflow[empty_tail_cell] = 0
+        self.inflow[empty_head_cell] = 0
+
+        cell_owner_list = [(c, i, i + 1, None) for i, c in enumerate(self.cell_list)]
+        self.field_list = [
+            Field('density', self.density, cell_owner_list, True),
+            Field('speed', self.speed, cell_owner_list, False),
+            Field('inflow', self.inflow, cell_owner_list, False),
+            Field('outflow', self.outflow, cell_owner_list, False),
+        ]
+
+        for group in self.flow_group_list:
+            flow_owner_list = [(f, self.flow_row[id(f)], self.flow_row[id(f)] + 1, None) for f in group.flow_list]
+            self.field_list.append(Field('flow', self.flow, flow_owner_list, False))
+
+            for name in group.co_state_name_list:
+                group.co_state[name] = np.full((len(group.flow_list), state_len), np.nan, dtype=dtype)
+                group_owner_list = [(f, i, i + 1, None) for i, f in enumerate(group.flow_list)]
+                self.field_list.append(Field(name, group.co_state[name], group_owner_list, False))
+
+        node_owner_list = [(n, start, stop, (n.param['num_incoming_cell'], n.param['num_outgoing_cell']))
+                           for n, (start, stop, _, _) in zip(self.node_list, self.node_block)]
+        self.field_list.append(Field('inter_cell_flow', self.movement, node_owner_list, False))
+
+        for i, field in enumerate(self.field_list):
+            field.bind()
+            field.initialize_output(net, f'engine.{i}')
+
+        # Fallback flows keep their own outputs but read and write through the packed flow array.
+        for f in self.fallback_flow_list:
+            f.co_state['flow'] = self.flow[self.flow_row[id(f)]]
+
+        self.initialize_sub_cycling()
+
+        net.active_engine = self
+        net.initialize_metric()
+
+        net.step = 0
+
+
+    def initialize_sub_cycling(self):
+        # Cell c is advanced every update_every[c] of the num_sub_step sub-steps of a step, see Network.set_sub_cycling().
+        self.param['num_sub_step'] = 1
+        if self.net.param['courant'] is None:
+            return
+
+        cell_num_sub_step = self.net.get_num_sub_step(self.net.param['courant'])
+        num_sub_step = int(cell_num_sub_step.max())
+        if num_sub_step == 1:
+            return
+
+        # Fallback flows (e.g. Markovian ones) are evaluated once per step, their cells cannot be sub-cycled.
+        for f in self.fallback_flow_list:
+            if cell_num_sub_step[self.cell_index[id(f.cell)]] > 1:
+                raise ValueError(f'Cell {f.cell.ID} needs sub-cycling but its {type(f).__name__} has no batched kernel.')
+
+        self.param['num_sub_step'] = num_sub_step
+        update_every = num_sub_step // cell_num_sub_step
+
+        # Cells advanced at the end of each sub-step, with their cell_len, min_density and max_density: (num_due_cell, state_len).
+        self.sub_step_cell = []
+        for j in range(num_sub_step):
+            idx = np.flatnonzero((j + 1) % update_every == 0)
+            self.sub_step_cell.append((idx, self.param['cell_len'][idx], self.param['min_density'][idx], self.param['max_density'][idx]))
+
+
+    def _rebind(self, unit, key, view):
+        # Fallback units write in place into their view; one that replaced the array is copied back and rebound.
+        if unit.co_state[key] is not view:
+            view[...] = unit.co_state[key]
+            unit.co_state[key] = view
+
+
+    def update_flow(self, is_fallback_updated=True):
+        for group in self.flow_group_list:
+            if self.param['use_kernel']:
+                group.compute_kernel(self, self.flow[group.rows])
+            else:
+                group.compute(self, self.flow[group.rows])
+
+        if is_fallback_updated:
+            for f in self.fallback_flow_list:
+                view = f.co_state['flow']
+                f.iterate()
+                self._rebind(f, 'flow', view)
+
+        self.inflow[self.boundary_inflow_cell] = _take(self.work, 'boundary_inflow', self.flow, self.boundary_inflow_row)
+        self.outflow[self.boundary_outflow_cell] = _take(self.work, 'boundary_outflow', self.flow, self.boundary_outflow_row)
+
+
+    def update_control_input(self):
+        for controller in self.controller_list:
+            controller.iterate()
+
+
+    def update_inter_cell_flow(self):
+        state_len = self.net.param['state_len']
+
+        for group in self.node_group_list:
+            num_node = len(group.node_list)
+            out = self.movement[group.rows].reshape(num_node, group.param['num_incoming_cell'], group.param['num_outgoing_cell'], state_len)
+            if self.param['use_kernel']:
+                group.compute_kernel(self, out)
+            else:
+                group.compute(self, group.get_sending(self), group.get_receiving(self), out)
+
+        for n in self.fallback_node_list:
+            view = n.co_state['inter_cell_flow']
+            n.update_inter_cell_flow()
+            self._rebind(n, 'inter_cell_flow', view)
+
+
+    def _segment_sum(self, name, incidence, segment):
+        # (incidence @ movement) restricted to the non-empty rows of the 0/1 incidence, without temporaries.
+        movement = _take(self.work, f'{name}_movement', self.movement, incidence.indices)
+        segment_sum = self.work_buffer(f'{name}_sum', segment.shape + self.movement.shape[1:])
+        if len(segment) > 0:
+            np.add.reduceat(movement, segment, axis=0, out=segment_sum)
+        return segment_sum
+
+
+    def update_cell_outflow_inflow(self):
+        if self.param['use_kernel']:
+            jit.segment_sum(self.movement, self.outflow_incidence.indices, self.outflow_segment, self.outflow_segment_stop, self.outflow_cell, self.outflow)
+            jit.segment_sum(self.movement, self.inflow_incidence.indices, self.inflow_segment, self.inflow_segment_stop, self.inflow_cell, self.inflow)
+            return
+
+        self.outflow[self.outflow_cell] = self._segment_sum('outflow', self.outflow_incidence, self.outflow_segment)
+        self.inflow[self.inflow_cell] = self._segment_sum('inflow', self.inflow_incidence, self.inflow_segment)
+
+
+    def update_cell_speed(self):
+        if self.param['use_kernel']:
+            jit.cell_speed(self.density, self.outflow, self.param['min_speed'], self.param['max_speed'], self.speed)
+            return
+
+        is_occupied = np.not_equal(self.density, 0, out=self.work_buffer('is_occupied', self.density.shape, bool))
+
+        self.speed[...] = self.param['max_speed']
+        np.divide(self.outflow, self.density, out=self.speed, where=is_occupied)
+        np.clip(self.speed, self.param['min_speed'], self.param['max_speed'], out=self.speed)
+
+
+    def update_cell_density(self):
+        if self.param['use_kernel']:
+            # The step size in the network dtype, as NumPy casts the Python float.
+            time_step_size = self.density.dtype.type(self.net.param['time_step_size'])
+            jit.cell_density(self.inflow, self.outflow, time_step_size, self.param['cell_len'], self.param['min_density'], self.param['max_density'], self.density)
+            return
+
+        density_change = np.subtract(self.inflow, self.outflow, out=self.work_buffer('density_change', self.density.shape))
+        np.multiply(density_change, self.net.param['time_step_size'], out=density_change)
+        np.divide(density_change, self.param['cell_len'], out=density_change)
+
+        np.add(self.density, density_change, out=self.density)
+        np.clip(self.density, self.param['min_density'], self.param['max_density'], out=self.density)
+
+
+    def save_output(self):
+        for field in self.field_list:
+            field.save_output(self.net.step)
+
+        for f in self.fallback_flow_list:
+            f.save_output()
+
+        for controller in self.controller_list:
+            controller.save_output()
+
+
+    def finalize_output(self):
+        for field in self.field_list:
+            field.finalize_output()
+
+        for f in self.fallback_flow_list:
+            f.finalize_output()
+
+        for controller in self.controller_list:
+            controller.finalize_output()
+
+        self.net.finalize_metric()
+
+
+    def run_sub_cycled_step(self):
+        # Steps 1 to 6 over num_sub_step sub-steps. Every sub-step recomputes the flows from the current densities and
+        # adds them to the pending inflow and outflow of each cell; a cell due at this sub-step is advanced by its pending
+        # flows over the time since its last update. Vehicles are conserved: a movement adds to both of its cells.
+        # Fallback flows and controllers are evaluated at the first sub-step only, so they keep the step's time scale.
+        # Inflows, outflows and inter-cell flows left for metrics and outputs are averages over the step.
+        num_sub_step = self.param['num_sub_step']
+        sub_step_size = self.density.dtype.type(self.net.param['time_step_size'] / num_sub_step)
+
+        density_start = self.work_buffer('density_start', self.density.shape)
+        np.copyto(density_start, self.density)
+
+        pending_inflow, pending_outflow, total_inflow, total_outflow = (self.work_buffer(name, self.density.shape) for name in ['pending_inflow', 'pending_outflow', 'total_inflow', 'total_outflow'])
+        total_movement = self.work_buffer('total_movement', self.movement.shape)
+        for array in (pending_inflow, pending_outflow, total_inflow, total_outflow, total_movement):
+            array.fill(0)
+
+        for j in range(num_sub_step):
+            self.update_flow(is_fallback_updated=(j == 0))
+            if j == 0:
+                self.update_control_input()
+            self.update_inter_cell_flow()
+            self.update_cell_outflow_inflow()
+
+            for pending, total, value in [(pending_inflow, total_inflow, self.inflow), (pending_outflow, total_outflow, self.outflow)]:
+                np.add(pending, value, out=pending)
+                np.add(total, value, out=total)
+            np.add(total_movement, self.movement, out=total_movement)
+
+            # Same operations as update_cell_density, on the due cells.
+            idx, cell_len, min_density, max_density = self.sub_step_cell[j]
+            density_change = _take(self.work, f'density_change_{j}', pending_inflow, idx)
+            np.subtract(density_change, _take(self.work, f'pending_outflow_{j}', pending_outflow, idx), out=density_change)
+            np.multiply(density_change, sub_step_size, out=density_change)
+            np.divide(density_change, cell_len, out=density_change)
+            np.add(_take(self.work, f'density_{j}', self.density, idx), density_change, out=density_change)
+            np.clip(density_change, min_density, max_density, out=density_change)
+
+            self.density[idx] = density_change
+            pending_inflow[idx] = 0
+            pending_outflow[idx] = 0
+
+        np.divide(total_inflow, num_sub_step, out=self.inflow)
+        np.divide(total_outflow, num_sub_step, out=self.outflow)
+        np.divide(total_movement, num_sub_step, out=self.movement)
+
+        # Metrics and speeds see the densities at the start of the step, as without sub-cycling.
+        density_end = self.work_buffer('density_end', self.density.shape)
+        np.copyto(density_end, self.density)
+        np.copyto(self.density, density_start)
+
+        self.net.update_metric()
+        self.update_cell_speed()
+
+        np.copyto(self.density, density_end)
+
+
+    def update_cell_flow(self):
+        # Step 1 & 2: update boundary flows, receiving and sending flows of all cells.
+        self.update_flow()
+
+        # Step 3: update control inputs.
+        self.update_control_input()
+
+        # Step 4: update inter-cell flows.
+        self.update_inter_cell_flow()
+
+        # Step 5: update cell inflows and outflows.
+        self.update_cell_outflow_inflow()
+
+
+    def run_one_step(self):
+        if self.param['num_sub_step'] > 1:
+            self.run_sub_cycled_step()
+        else:
+            # Steps 1 to 5.
+            self.update_cell_flow()
+
+            # Update online metrics with this step's densities and flows.
+            self.net.update_metric()
+
+            # Step 6: update cell speed and density.
+            self.update_cell_speed()
+            self.update_cell_density()
+
+        # Step 7: save results.
+        self.save_output()
+
+        self.net.step += 1
+
+
+    def run(self):
+        self.initialize()
+
+        for _ in range(self.net.param['num_step']):
+            self.run_one_step()
+
+        self.finalize_output()
+
+
+if __name__ == '__main__':
+    pass
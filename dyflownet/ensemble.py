@@ -0,0 +1,325 @@
+import fnmatch
+import numpy as np
+from scipy import stats
+
+from . import parallel
+from . import utils
+
+
+# Monte Carlo ensembles of a network with stochastic units (Markovian flows). Replicas run in batches along the
+# state_len axis: a batch network repeats every column of the network batch_size times, and each stochastic unit
+# draws every replica (antithetic pair, Sobol' batch) from its own stream spawned from one SeedSequence. Chosen fields
+# are reduced every step to running statistics over replicas (mean and variance by Welford's update, optionally P²
+# quantiles), so that no trajectory is stored and the ensemble size is limited by compute only. Batches run until num_replica replicas, or until the
+# confidence half-width of every mean is at most half_width.
+
+
+def merge_moment(mean, m2, sample, num_previous):
+    # Merge sample: (num_sample, ) + mean shape into the running mean and sum of squared deviations m2 of
+    # num_previous samples, in place; the pairwise update of Chan et al., exact for any batch size.
+    num_sample = len(sample)
+    num_total = num_previous + num_sample
+
+    sample_mean = np.mean(sample, axis=0)
+    delta = sample_mean - mean
+    mean += delta * (num_sample / num_total)
+    m2 += np.sum((sample - sample_mean)**2, axis=0) + delta**2 * (num_previous * num_sample / num_total)
+
+
+
+class P2Quantile:
+    # P² estimate of the p-quantile (Jain and Chlamtac, 1985) per element of an array, from five markers per element.
+    # Elements have shape value shape + (num_record, ) and are fed one record at a time, a batch of samples at once:
+    # marker positions move by the counts of the batch below them, then each marker moves to its desired position in
+    # as few P² steps as its neighbours allow, each step of any integer length along the piecewise-parabolic prediction.
+    # marker: (5, ) + shape, heights; position: (5, ) + shape, positions of the markers among the samples (from 0).
+    def __init__(self, p, shape):
+        self.param = {
+            'p': p,
+
+            # Desired positions of the markers, as fractions of the number of samples minus one.
+            'fraction': np.array([0, p / 2, p, (1 + p) / 2, 1]),
+        }
+
+        self.marker = np.zeros((5, ) + tuple(shape))
+        self.position = np.zeros((5, ) + tuple(shape))
+        self.position[...] = np.arange(5).reshape((5, ) + (1, ) * len(shape))
+
+
+    def add(self, sample, num_previous, index):
+        # Add sample: (num_sample, ) + value shape to the estimators of record index, which have seen num_previous samples.
+        marker, position = self.marker[..., index], self.position[..., index]
+        sample = np.asarray(sample, dtype=float)
+
+        # A first batch of at least five samples sets the markers to its order statistics nearest their desired
+        # positions, kept distinct; otherwise the first five samples are the markers.
+        if num_previous == 0 and len(sample) >= 5:
+            num_sample = len(sample)
+            offset = np.arange(5)
+            rank = np.maximum.accumulate(np.clip(np.round((num_sample - 1) * self.param['fraction']) - offset, 0, num_sample - 5)) + offset
+            marker[...] = np.sort(sample, axis=0)[rank.astype(int)]
+            position[...] = rank.reshape((5, ) + (1, ) * (marker.ndim - 1))
+            return
+
+        num_first = min(max(5 - num_previous, 0), len(sample))
+        marker[num_previous:num_previous + num_first] = sample[:num_first]
+        if num_first > 0 and num_previous + num_first == 5:
+            marker.sort(axis=0)
+        sample, num_previous = sample[num_first:], num_previous + num_first
+        if len(sample) == 0:
+            return
+
+        np.minimum(marker[0], sample.min(axis=0), out=marker[0])
+        np.maximum(marker[4], sample.max(axis=0), out=marker[4])
+
+        # Markers move up by the samples below them.
+        position[1:4] += np.sum(sample[:, None] < marker[None, 1:4], axis=0)
+        position[4] += len(sample)
+
+        desired = (num_previous + len(sample) - 1) * self.param['fraction']
+        is_moved = True
+        while is_moved:
+            is_moved = False
+            for i in range(1, 4):
+                # Integer step towards the desired position, keeping the positions distinct.
+                d = np.clip(np.trunc(desired[i] - position[i]), position[i-1] - position[i] + 1, position[i+1] - position[i] - 1)
+                is_step = d != 0
+                if not is_step.any():
+                    continue
+                is_moved = True
+
+                parabolic = marker[i] + d / (position[i+1] - position[i-1]) * (
+                    (position[i] - position[i-1] + d) * (marker[i+1] - marker[i]) / (position[i+1] - position[i]) +
+                    (position[i+1] - position[i] - d) * (marker[i] - marker[i-1]) / (position[i] - position[i-1]))
+                neighbour_marker, neighbour_position = np.where(d > 0, marker[i+1], marker[i-1]), np.where(d > 0, position[i+1], position[i-1])
+                linear = marker[i] + d * (neighbour_marker - marker[i]) / (neighbour_position - position[i])
+
+                is_parabolic = (marker[i-1] < parabolic) & (parabolic < marker[i+1])
+                marker[i] = np.where(is_step, np.where(is_parabolic, parabolic, linear), marker[i])
+                position[i] += d
+
+
+    def get(self, num_sample):
+        # Exact quantile of the first samples while there are fewer than five.
+        if num_sample < 5:
+            return np.quantile(self.marker[:num_sample], self.param['p'], axis=0) if num_sample > 0 else np.full(self.marker.shape[1:], np.nan)
+        return self.marker[2].copy()
+
+
+
+class Ensemble:
+    # field_list: glob patterns on '<unit>:<key>', as in Network.set_recorder(), matched against states and co-states.
+    # Statistics of a field keep the layout of outputs: value shape + (num_record, ), time last, where the value shape
+    # is that of the network's columns, state_len first.
+    # sampling: uniforms of the stochastic units (see MarkovianPiecewiseLinearSendingFlow), 'random', 'antithetic'
+    # (replicas in pairs driven by u and 1 - u) or 'sobol' (each batch a randomized Sobol' set). The mean and its
+    # confidence interval come from independent sampling units: replicas, antithetic pairs or batches.
+    # reference: a network with the same stochastic units, run with common random numbers (the same streams); the
+    # statistics are then those of the difference, field in net minus field in reference.
+    sampling_list = ['random', 'antithetic', 'sobol']
+
+    def __init__(self, net, field_list, quantile_list=(), confidence=0.95, sampling='random', reference=None):
+        if sampling not in self.sampling_list:
+            raise ValueError(f'Unknown sampling: {sampling}.')
+        if reference is not None and (reference.param['state_len'], reference.param['num_step']) != (net.param['state_len'], net.param['num_step']):
+            raise ValueError('The reference network must have the same state_len and num_step.')
+
+        self.net = net
+        self.reference = reference
+
+        self.param = {
+            'field_list': list(field_list),
+            'quantile_list': list(quantile_list),
+            'confidence': confidence,
+            'sampling': sampling,
+
+            # Entropy of the SeedSequence of the last run.
+            'entropy': None,
+        }
+
+        # state: num_replica, num_sample (sampling units), and per field name ('<unit>:<key>') mean and m2 over sampling
+        # units, replica_mean and replica_m2 over replicas of each network, (num_net, ) + shape, and quantile over replicas.
+        self.state = {}
+
+
+    def build_batch(self, spec, first_replica, batch_size):
+        # Network of batch_size replicas of every column, from replica first_replica on. Stochastic units (those with a
+        # seed) number k draw replica r from stream (r, k), antithetic pair j from (j, k), so results do not depend on
+        # batch_size; a Sobol' batch is one randomized set, from stream (first_replica, k).
+        state_len = spec['param']['state_len']
+        batch_spec = parallel.get_shard_spec(spec, np.tile(np.arange(state_len), batch_size))
+
+        stochastic_list = [u for u in batch_spec['unit'] if 'seed' in u['attr']['param']]
+        for k, u in enumerate(stochastic_list):
+            param = {**u['attr']['param'], 'sampling': self.param['sampling'], 'group_seed_list': None}
+            if self.param['sampling'] == 'sobol':
+                param['seed'] = np.random.SeedSequence(self.param['entropy'], spawn_key=(first_replica, k))
+            else:
+                num_group = batch_size // 2 if self.param['sampling'] == 'antithetic' else batch_size
+                first_group = first_replica // 2 if self.param['sampling'] == 'antithetic' else first_replica
+                param['group_seed_list'] = [np.random.SeedSequence(self.param['entropy'], spawn_key=(first_group + j, k)) for j in range(num_group)]
+            u['attr'] = {**u['attr'], 'param': param}
+
+        batch_net = parallel.from_spec(batch_spec)
+        batch_net.set_recorder({'*': None})
+        return batch_net
+
+
+    def match_field(self, batch_net):
+        # {field name: (unit, 'state' or 'co_state', key)} of the fields matching field_list.
+        field_dict = {}
+        for name, unit in batch_net.get_unit_dict().items():
+            for kind, value in [('state', unit.state), ('co_state', unit.co_state)]:
+                for k in value:
+                    field_name = f'{name}:{k}'
+                    if any(fnmatch.fnmatchcase(field_name, pattern) for pattern in self.param['field_list']):
+                        field_dict[field_name] = (unit, kind, k)
+
+        if not field_dict:
+            raise ValueError('No state or co-state matches field_list.')
+        return field_dict
+
+
+    def initialize_state(self, field_dict, state_len, num_net):
+        num_step = self.net.param['num_step']
+        self.state = {'num_replica': 0, 'num_sample': 0, 'mean': {}, 'm2': {}, 'replica_mean': {}, 'replica_m2': {}, 'quantile': {}}
+
+        for field_name, (unit, kind, k) in field_dict.items():
+            value = unit.state[k] if kind == 'state' else unit.co_state[k]
+            shape = (state_len, ) + value.shape[1:] + (num_step + 1 if kind == 'state' else num_step, )
+
+            self.state['mean'][field_name] = np.zeros(shape)
+            self.state['m2'][field_name] = np.zeros(shape)
+            self.state['replica_mean'][field_name] = np.zeros((num_net, ) + shape)
+            self.state['replica_m2'][field_name] = np.zeros((num_net, ) + shape)
+            self.state['quantile'][field_name] = [P2Quantile(p, shape) for p in self.param['quantile_list']]
+
+
+    def get_unit_sample(self, sample):
+        # Averages of the sampling units of a batch: (num_unit, state_len, ...).
+        if self.param['sampling'] == 'antithetic':
+            return (sample[0::2] + sample[1::2]) / 2
+        if self.param['sampling'] == 'sobol':
+            return np.mean(sample, axis=0, keepdims=True)
+        return sample
+
+
+    def get_num_unit(self, batch_size):
+        return {'antithetic': batch_size // 2, 'sobol': 1}.get(self.param['sampling'], batch_size)
+
+
+    def update(self, field_dict_list, index_dict, state_len):
+        # Merge the replicas of the batch at record index_dict[kind] of every field.
+        num_replica, num_sample = self.state['num_replica'], self.state['num_sample']
+
+        for field_name, (_, kind, _) in field_dict_list[0].items():
+            index = index_dict[kind]
+            if index is None:
+                continue
+
+            # replica: (num_net, batch_size, state_len, ...), batch rows are replica-major.
+            replica = []
+            for field_dict in field_dict_list:
+                unit, _, k = field_dict[field_name]
+                value = unit.state[k] if kind == 'state' else unit.co_state[k]
+                replica.append(np.asarray(value, dtype=float).reshape((-1, state_len) + value.shape[1:]))
+
+            for j, x in enumerate(replica):
+                merge_moment(self.state['replica_mean'][field_name][j, ..., index], self.state['replica_m2'][field_name][j, ..., index], x, num_replica)
+
+            sample = replica[0] - replica[1] if len(replica) > 1 else replica[0]
+            merge_moment(self.state['mean'][field_name][..., index], self.state['m2'][field_name][..., index], self.get_unit_sample(sample), num_sample)
+            for estimator in self.state['quantile'][field_name]:
+                estimator.add(sample, num_replica, index)
+
+
+    def run(self, num_replica, batch_size=64, seed=None, half_width=None, min_replica=10, engine='object', backend='numpy'):
+        # Run batches of batch_size replicas per column, at most num_replica replicas per column in total. With
+        # half_width, stop after the first batch (with at least min_replica replicas) where every half-width is at most half_width.
+        num_step, state_len = self.net.param['num_step'], self.net.param['state_len']
+        if self.param['sampling'] == 'antithetic' and (num_replica % 2 != 0 or batch_size % 2 != 0):
+            raise ValueError('Antithetic sampling needs an even num_replica and batch_size.')
+
+        self.param['entropy'] = np.random.SeedSequence(seed).entropy
+        spec_list = [parallel.get_spec(net) for net in [self.net, self.reference] if net is not None]
+
+        self.state = {'num_replica': 0}
+        is_first = True
+        while self.state['num_replica'] < num_replica:
+            size = min(batch_size, num_replica - self.state['num_replica'])
+
+            # Common random numbers: every network of the batch gets the same streams.
+            batch_net_list = [self.build_batch(spec, self.state['num_replica'], size) for spec in spec_list]
+            for batch_net in batch_net_list:
+                if engine == 'array':
+                    batch_net.compile(backend)
+                    batch_net.engine.initialize()
+                else:
+                    batch_net.initialize()
+
+            field_dict_list = [self.match_field(batch_net) for batch_net in batch_net_list]
+            if any(field_dict.keys() != field_dict_list[0].keys() for field_dict in field_dict_list):
+                raise ValueError('The fields of the reference network differ.')
+            if is_first:
+                self.initialize_state(field_dict_list[0], state_len, len(batch_net_list))
+
+            self.update(field_dict_list, {'state': 0, 'co_state': None}, state_len)
+            for step in range(num_step):
+                for batch_net in batch_net_list:
+                    if engine == 'array':
+                        batch_net.engine.run_one_step()
+                    else:
+                        batch_net.run_one_step()
+                self.update(field_dict_list, {'state': step + 1, 'co_state': step}, state_len)
+
+            self.state['num_replica'] += size
+            self.state['num_sample'] += self.get_num_unit(size)
+            is_first = False
+
+            if half_width is not None and self.state['num_replica'] >= min_replica:
+                if all(np.nanmax(self.get_half_width(f), initial=0) <= half_width for f in field_dict_list[0]):
+                    break
+
+        return self
+
+
+    def get_field_list(self):
+        return list(self.state['mean'])
+
+
+    def get_mean(self, field_name):
+        return self.state['mean'][field_name].copy()
+
+
+    def get_std(self, field_name):
+        # Sample standard deviation over sampling units (replicas, antithetic pairs or batches).
+        num_sample = self.state['num_sample']
+        return np.sqrt(self.state['m2'][field_name] / (num_sample - 1)) if num_sample > 1 else np.full(self.state['m2'][field_name].shape, np.nan)
+
+
+    def get_half_width(self, field_name):
+        # Half-width of the Student t confidence interval of the mean.
+        num_sample = self.state['num_sample']
+        if num_sample < 2:
+            return np.full(self.state['m2'][field_name].shape, np.inf)
+        t = stats.t.ppf((1 + self.param['confidence']) / 2, num_sample - 1)
+        return t * self.get_std(field_name) / np.sqrt(num_sample)
+
+
+    def get_quantile(self, field_name, p):
+        k = self.param['quantile_list'].index(p)
+        return self.state['quantile'][field_name][k].get(self.state['num_replica'])
+
+
+    def get_variance_reduction_factor(self, field_name):
+        # Variance of the mean with independent replicas (and independent streams for net and reference) over its
+        # variance as run, at the same number of replicas: about the fraction of replicas the run saves, as its inverse.
+        num_replica, num_sample = self.state['num_replica'], self.state['num_sample']
+        plain_variance = np.sum(self.state['replica_m2'][field_name], axis=0) / (num_replica - 1) / num_replica
+        variance = self.state['m2'][field_name] / (num_sample - 1) / num_sample
+        return utils.safe_div(plain_variance, variance, fill=np.nan)
+
+
+
+if __name__ == '__main__':
+    pass
@@ -0,0 +1,144 @@
+import numpy as np
+
+from . import sampler
+from . import vectorfield
+
+
+# Equilibria of a network, d(density)/dt = 0 for the densities of chosen cells (the other cells stay at their initial
+# density), found without running to steady state. Flow laws are piecewise affine in the densities and junctions are
+# min / median compositions of them, so the vector field is affine on each regime (free flow or congestion of each
+# cell, active constraint of each junction). The solver searches regimes by a piecewise Newton iteration from many
+# starts: the Jacobian of the regime of the current point, by a one-sided difference (exact inside a regime), gives
+# the equilibrium of that affine piece, which is the next point; the iteration stops once it lies in its own regime.
+# Stability is read from the eigenvalues of the Jacobians of the regimes on both sides of the equilibrium.
+# All columns of the network (per-column parameters) and all starts are solved together in one work network.
+
+STABILITY_LIST = ['stable', 'unstable', 'marginal']
+
+
+def get_base_density(net, column):
+    # Initial densities of every cell in the given columns: (num_cell, len(column)).
+    density = []
+    for c in net.get_cell_list():
+        initial_density = np.atleast_1d(c.initial_condition['density'])
+        density.append(initial_density[column] if len(initial_density) > 1 else np.full(len(column), initial_density[0]))
+    return np.array(density, dtype=float)
+
+
+def get_jacobian(work_net, update_cell_flow, base_density, cell_index, point, sign, h, step=0):
+    # d(density)/dt of the chosen cells at point: (num_dim, num_point) and its Jacobian: (num_point, num_dim, num_dim),
+    # from differences of size h on the side sign. Work columns hold num_dim + 1 blocks of the points, block i + 1 moved
+    # along cell i.
+    num_dim, num_point = point.shape
+    density = np.tile(base_density, (1, num_dim + 1))
+    density[cell_index] = np.tile(point, (1, num_dim + 1))
+    for i, c in enumerate(cell_index):
+        density[c, (i + 1) * num_point:(i + 2) * num_point] += sign * h
+
+    rate = vectorfield.get_rate(work_net, update_cell_flow, density, step)[cell_index].reshape(num_dim, num_dim + 1, num_point)
+    jacobian = (rate[:, 1:] - rate[:, :1]) / (sign * h)
+    return rate[:, 0], np.moveaxis(jacobian, 2, 0)
+
+
+def get_stability(jacobian_list, eig_tol=1e-9):
+    # Index in STABILITY_LIST: unstable if an eigenvalue of a side's Jacobian has a positive real part, stable if all
+    # real parts of both sides are negative, marginal otherwise (a zero eigenvalue, e.g. a continuum of equilibria).
+    max_real = np.max([np.linalg.eigvals(j).real.max(axis=-1) for j in jacobian_list], axis=0)
+    return np.where(max_real > eig_tol, 1, np.where(max_real < -eig_tol, 0, 2))
+
+
+def solve(net, cell_id_list=None, lower=None, upper=None, num_start=64, max_iter=50, tol=1e-9, h=1e-6, seed=None, step=0, engine='array', backend='numpy'):
+    # Returns {'density': (state_len, num_start, num_dim) the equilibrium reached from each start, NaN if none within
+    # max_iter, 'stability': (state_len, num_start) index in STABILITY_LIST, -1 if none, 'jacobian': (state_len,
+    # num_start, num_dim, num_dim) of the regime on the upper side, 'cell_id_list'}. Starts are scrambled Sobol points
+    # of the box [lower, upper], by default the density bounds of the cells. See get_equilibrium_list().
+    cell_list = net.get_cell_list()
+    cell_id_list = [c.ID for c in cell_list] if cell_id_list is None else list(cell_id_list)
+    cell_index = [[c.ID for c in cell_list].index(ID) for ID in cell_id_list]
+    num_dim, state_len = len(cell_index), net.param['state_len']
+
+    min_density = np.array([cell_list[i].param['min_density'] for i in cell_index], dtype=float)
+    max_density = np.array([cell_list[i].param['max_density'] for i in cell_index], dtype=float)
+    lower = min_density if lower is None else np.asarray(lower, dtype=float)
+    upper = max_density if upper is None else np.asarray(upper, dtype=float)
+    if not np.all(np.isfinite(upper)):
+        raise ValueError('Give upper for cells without a finite max_density.')
+
+    # Point k of column s is work column s * num_start + k.
+    column = np.repeat(np.arange(state_len), num_start)
+    start = next(sampler.iter_sobol(lower, upper, num_start, seed, num_start))
+    point = np.tile(start, (1, state_len))
+
+    work_net, update_cell_flow = vectorfield.build(net, np.tile(column, num_dim + 1), engine, backend)
+    base_density = get_base_density(net, column)
+
+    def evaluate(point, sign):
+        # Starts thrown to huge densities may make a flow law divide 0 by 0 (e.g. softmax routing); they fail below.
+        with np.errstate(all='ignore'):
+            return get_jacobian(work_net, update_cell_flow, base_density, cell_index, point, sign, h, step)
+
+    def is_finite(rate, jacobian):
+        return np.isfinite(rate).all(axis=0) & np.isfinite(jacobian).all(axis=(1, 2))
+
+    # Length of a step along the rate, see below.
+    rate_step = 0.25 * np.min(upper - lower)
+
+    is_failed = np.zeros(point.shape[1], dtype=bool)
+    for _ in range(max_iter):
+        rate, jacobian = evaluate(point, 1)
+        is_failed |= ~is_finite(rate, jacobian)
+        is_open = ~is_failed & (np.max(np.abs(rate), axis=0) > tol)
+        if not is_open.any():
+            break
+
+        # The equilibrium of the affine piece; pinv for regimes with a singular Jacobian.
+        open_rate, open_jacobian = rate[:, is_open], jacobian[is_open]
+        move = -np.einsum('pij,jp->ip', np.linalg.pinv(open_jacobian), open_rate)
+
+        # In flat regimes (e.g. saturated capacities, a zero Jacobian) the rate is out of the Jacobian's range and the
+        # Newton step does not reduce it: step along the rate instead, rate_step along its largest component.
+        residual = open_rate + np.einsum('pij,jp->ip', open_jacobian, move)
+        is_flat = np.max(np.abs(residual), axis=0) > 0.5 * np.max(np.abs(open_rate), axis=0)
+        move[:, is_flat] = open_rate[:, is_flat] * (rate_step / np.max(np.abs(open_rate[:, is_flat]), axis=0))
+
+        point[:, is_open] = np.clip(point[:, is_open] + move, min_density[:, None], max_density[:, None])
+
+    rate, jacobian = evaluate(point, 1)
+    _, lower_jacobian = evaluate(point, -1)
+    is_equilibrium = ~is_failed & is_finite(rate, jacobian) & is_finite(rate, lower_jacobian) & (np.max(np.abs(rate), axis=0) <= tol)
+
+    # Only equilibria are classified, a failed start has no meaningful (or finite) Jacobian.
+    stability = np.full(point.shape[1], -1)
+    if is_equilibrium.any():
+        stability[is_equilibrium] = get_stability([jacobian[is_equilibrium], lower_jacobian[is_equilibrium]])
+    point[:, ~is_equilibrium] = np.nan
+
+    return {
+        'density': point.T.reshape(state_len, num_start, num_dim),
+        'stability': stability.reshape(state_len, num_start),
+        'jacobian': jacobian.reshape(state_len, num_start, num_dim, num_dim),
+        'cell_id_list': cell_id_list,
+    }
+
+
+def get_equilibrium_list(result, column=0, x_tol=1e-6):
+    # Distinct equilibria of a column of result: [{'density': {cell ID: value}, 'stability': name, 'eigenvalue':
+    # (num_dim, ) of the upper side's Jacobian, 'num_start': starts reaching it}], merged within x_tol in max norm.
+    equilibrium_list = []
+    for density, stability, jacobian in zip(result['density'][column], result['stability'][column], result['jacobian'][column]):
+        if stability < 0:
+            continue
+
+        for e in equilibrium_list:
+            if np.max(np.abs(e['point'] - density)) <= x_tol:
+                e['num_start'] += 1
+                break
+        else:
+            equilibrium_list.append({'point': density, 'stability': STABILITY_LIST[stability], 'eigenvalue': np.linalg.eigvals(jacobian), 'num_start': 1})
+
+    return [{'density': dict(zip(result['cell_id_list'], e.pop('point'))), **e} for e in equilibrium_list]
+
+
+
+if __name__ == '__main__':
+    pass
@@ -1,6 +1,10 @@
 import numpy as np
+from scipy.stats import qmc
 from . import utils
 
+# Largest dimension of scipy.stats.qmc.Sobol.
+MAX_SOBOL_DIMENSION = 21201
+
 
 class Flow(utils.NetUnit):
     def __init__(self, cell=None, is_state_saved=True, is_co_state_saved=True):
@@ -18,24 +22,34 @@ class Flow(utils.NetUnit):
 
     def initialize_co_state(self):
         # flow: (state_len, ). 
-        self.co_state['flow'] = np.full(self.net.param['state_len'], np.nan)
+        self.co_state['flow'] = np.full(self.net.param['state_len'], np.nan, dtype=self.net.param['dtype'])
 
     
-    def compute_flow(self):
-        return np.full(self.net.param['state_len'], np.nan)
+    def compute_flow(self, out=None):
+        if out is None:
+            return np.full(self.net.param['state_len'], np.nan, dtype=self.net.param['dtype'])
+        out.fill(np.nan)
+        return out
     
 
-    def _compute_flow(self):
-        return self.compute_flow()
+    def _compute_flow(self, out=None):
+        return self.compute_flow(out=out)
 
 
     def iterate(self):
-        self.co_state['flow'] = self._compute_flow()
+        # Flows are written in place into the co-state buffer allocated at initialize().
+        self._compute_flow(out=self.co_state['flow'])
 
 
     def get_flow(self):
         return self.co_state['flow']
 
+
+    def get_wave_speed(self):
+        # Fastest characteristic speed over all columns (and steps, modes), for the CFL condition
+        # speed * time_step_size <= cell_len, see Cell.get_max_time_step(). 0 if the flow does not depend on the density.
+        return 0
+
     
 
 #------------------------Boundary inflow & outflow functions.------------------------------
@@ -52,18 +66,21 @@ class BoundaryInflow(Flow):
         self.param['is_bc_constant'] = is_bc_constant
     
 
-    def compute_flow(self, state_len, step=None):
+    def compute_flow(self, state_len, step=None, out=None):
         # boundary_inflow: : (1, ) or (state_len, ).
         if self.param['is_bc_constant']:
             boundary_inflow = self.param['boundary_inflow']
         else:
             boundary_inflow = self.param['boundary_inflow'][:, step]
 
-        return boundary_inflow * np.ones(state_len)
+        if out is None:
+            out = np.empty(state_len, dtype=self.net.param['dtype'])
+        out[...] = boundary_inflow
+        return out
     
 
-    def _compute_flow(self):
-        return self.compute_flow(self.net.param['state_len'], self.net.step)
+    def _compute_flow(self, out=None):
+        return self.compute_flow(self.net.param['state_len'], self.net.step, out=out)
 
 
 class BoundaryOutflow(Flow):
@@ -85,18 +102,23 @@ class BoundaryOutflow(Flow):
         self.param['is_bc_constant'] = is_bc_constant
 
 
-    def compute_flow(self, density, step=None):
+    def compute_flow(self, density, step=None, out=None):
         # boundary_speed, boundary_capacity: (1, ) or (state_len, ).
         if self.param['is_bc_constant']:
             boundary_speed, boundary_capacity = self.param['boundary_speed'], self.param['boundary_capacity']
         else:
             boundary_speed, boundary_capacity = self.param['boundary_speed'][:, step], self.param['boundary_capacity'][:, step]
 
-        return np.minimum(boundary_speed * density, boundary_capacity)
+        out = np.multiply(boundary_speed, density, out=out)
+        return np.minimum(out, boundary_capacity, out=out)
 
 
-    def _compute_flow(self):
-        return self.compute_flow(self.cell.state['density'], self.net.step)
+    def _compute_flow(self, out=None):
+        return self.compute_flow(self.cell.state['density'], self.net.step, out=out)
+
+
+    def get_wave_speed(self):
+        return np.max(np.abs(self.param['boundary_speed']))
 
 
 #----------------------------Sending flow functions---------------------------------
@@ -119,7 +141,7 @@ class BufferSendingFlow(Flow):
         self.param['ignore_queue'] = ignore_queue
 
 
-    def compute_flow(self, state_len=None, step=None, queue_len=None):
+    def compute_flow(self, state_len=None, step=None, queue_len=None, out=None):
         # _demand: (1, ) or (state_len, ).
         if self.param['is_demand_constant']:
             _demand = self.param['demand']
@@ -127,16 +149,25 @@ class BufferSendingFlow(Flow):
             _demand = self.param['demand'][:, step]
         
         if self.param['ignore_queue']:
-            return _demand * np.ones(state_len)
+            if out is None:
+                out = np.empty(state_len, dtype=self.net.param['dtype'])
+            out[...] = _demand
+            return out
         else:
-            # queue_len: (state_len, ).
-            return np.minimum(_demand + queue_len / self.net.param['time_step_size'], self.param['capacity'])
+            # queue_len: (state_len, ). out may share memory with queue_len.
+            out = np.divide(queue_len, self.net.param['time_step_size'], out=out)
+            np.add(_demand, out, out=out)
+            return np.minimum(out, self.param['capacity'], out=out)
 
 
-    def _compute_flow(self):
+    def _compute_flow(self, out=None):
         # flow: (state_len, ).
-        queue_len = self.cell.state['density'] * self.cell.param['cell_len']
-        return self.compute_flow(self.net.param['state_len'], self.cell.net.step, queue_len)
+        if self.param['ignore_queue']:
+            return self.compute_flow(self.net.param['state_len'], self.cell.net.step, out=out)
+
+        # queue_len is written into out and turned into the flow in place.
+        queue_len = np.multiply(self.cell.state['density'], self.cell.param['cell_len'], out=out)
+        return self.compute_flow(self.net.param['state_len'], self.cell.net.step, queue_len, out=queue_len)
 
 
 
@@ -152,13 +183,18 @@ class PiecewiseLinearSendingFlow(Flow):
         self.param['capacity'] = np.atleast_1d(capacity)
 
 
-    def compute_flow(self, density):
-        return np.clip(self.param['free_flow_speed'] * density, 0, self.param['capacity'])
+    def compute_flow(self, density, out=None):
+        out = np.multiply(self.param['free_flow_speed'], density, out=out)
+        return np.clip(out, 0, self.param['capacity'], out=out)
 
 
-    def _compute_flow(self):
+    def _compute_flow(self, out=None):
         # flow: (state_len, ).
-        return self.compute_flow(self.cell.state['density'])
+        return self.compute_flow(self.cell.state['density'], out=out)
+
+
+    def get_wave_speed(self):
+        return np.max(np.abs(self.param['free_flow_speed']))
         
 
 
@@ -181,29 +217,44 @@ class CapacityDropPiecewiseLinearSendingFlow(Flow):
 
 
     def initialize_co_state(self):
-        self.co_state['flow'] = np.full(self.net.param['state_len'], np.nan)
-        self.co_state['real_capacity'] = np.full(self.net.param['state_len'], np.nan)
+        self.co_state['flow'] = np.full(self.net.param['state_len'], np.nan, dtype=self.net.param['dtype'])
+        self.co_state['real_capacity'] = np.full(self.net.param['state_len'], np.nan, dtype=self.net.param['dtype'])
+
+
+    def compute_flow(self, density, out=None):
+        # out: optional (flow, real_capacity) buffers.
+        flow, real_capacity = (None, None) if out is None else out
 
+        if real_capacity is None:
+            real_capacity = np.where(density >  self.param['capacity_drop_density_threshold'], self.param['capacity_dropped'], self.param['capacity'])
+        else:
+            is_dropped = np.greater(density, self.param['capacity_drop_density_threshold'], out=self.work_buffer('is_dropped', real_capacity.shape, bool))
+            np.copyto(real_capacity, self.param['capacity'])
+            np.copyto(real_capacity, self.param['capacity_dropped'], where=is_dropped)
 
-    def compute_flow(self, density):
-        real_capacity = np.where(density >  self.param['capacity_drop_density_threshold'], self.param['capacity_dropped'], self.param['capacity'])
-        return np.clip(self.param['free_flow_speed'] * density, 0, real_capacity), real_capacity
+        flow = np.multiply(self.param['free_flow_speed'], density, out=flow)
+        return np.clip(flow, 0, real_capacity, out=flow), real_capacity
 
 
-    def _compute_flow(self):        
+    def _compute_flow(self, out=None):        
         # flow: (state_len, ).
-        return self.compute_flow(self.cell.state['density']) 
+        return self.compute_flow(self.cell.state['density'], out=out) 
         
 
     def iterate(self):
-        flow, real_capacity = self._compute_flow()
-        self.co_state['flow'] = flow
-        self.co_state['real_capacity'] = real_capacity
+        self._compute_flow(out=(self.co_state['flow'], self.co_state['real_capacity']))
+
+
+    def get_wave_speed(self):
+        return np.max(np.abs(self.param['free_flow_speed']))
 
 
 
 class MarkovianPiecewiseLinearSendingFlow(Flow):
-    def __init__(self, mode_list, free_flow_speed, capacity, prob_matrix, initial_condition, has_multi_regime=False, regime_bound_list=None, cell=None, is_state_saved=True, is_co_state_saved=True):
+    shared_param_list = ['mode_list', 'free_flow_speed', 'capacity', 'prob_matrix', 'regime_bound_list']
+
+    def __init__(self, mode_list, free_flow_speed, capacity, prob_matrix, initial_condition, has_multi_regime=False, regime_bound_list=None,
+                 seed=None, block_len=1, sampling='random', group_seed_list=None, cell=None, is_state_saved=True, is_co_state_saved=True):
 
         super().__init__(cell, is_state_saved, is_co_state_saved)
 
@@ -225,39 +276,134 @@ class MarkovianPiecewiseLinearSendingFlow(Flow):
         # prob_matrix: (num_mode, num_mode) or (num_regime, num_mode, num_mode)
         self.param['prob_matrix'] = np.atleast_2d(prob_matrix) if not has_multi_regime else np.atleast_3d(prob_matrix)
 
+        # seed: of the flow's random generator, restarted at initialize(); None draws fresh entropy every run.
+        self.param['seed'] = seed
+
+        # block_len: steps of uniforms drawn at once, (block_len, state_len) per draw.
+        self.param['block_len'] = block_len
+
+        # sampling: uniforms driving the transitions, 'random' (independent), 'antithetic' (the second half of the
+        # columns uses 1 - u of the first half) or 'sobol' (per window of block_len steps, one point of a fresh
+        # scrambled Sobol' sequence of dimension block_len per column; larger windows spread the points over more steps).
+        if sampling not in ('random', 'antithetic', 'sobol'):
+            raise ValueError(f'Unknown sampling: {sampling}.')
+        if sampling == 'sobol' and block_len > MAX_SOBOL_DIMENSION:
+            raise ValueError(f'Sobol sampling supports block_len up to {MAX_SOBOL_DIMENSION}, the largest Sobol dimension of SciPy.')
+        self.param['sampling'] = sampling
+
+        # group_seed_list: seeds of equal groups of consecutive columns, each group drawing from its own generator (and
+        # antithetic within the group), e.g. one stream per ensemble replica; None draws all columns from seed.
+        self.param['group_seed_list'] = group_seed_list
+
         # initial_mode: (state_len, ).
         self.set_initial_condition(initial_condition)
+
+        self.rng = None
     
 
     def initialize_state(self):
         self.state['real_time_mode'] = np.array(self.initial_condition['mode'] * np.ones(self.net.param['state_len']), dtype=int)
 
+        if self.param['sampling'] == 'antithetic' and self.net.param['state_len'] % (2 * len(self.param['group_seed_list'] or [None])) != 0:
+            raise ValueError('Antithetic sampling needs an even number of columns per group.')
+
+        group_seed_list = self.param['group_seed_list']
+        if group_seed_list is not None and self.net.param['state_len'] % len(group_seed_list) != 0:
+            raise ValueError('state_len must be a multiple of the number of column groups.')
+
+        self.rng = [np.random.default_rng(s) for s in ([self.param['seed']] if group_seed_list is None else group_seed_list)]
+        self.uniform, self.uniform_row = np.zeros((0, self.net.param['state_len'])), 0
+
+
+    def initialize_work(self):
+        super().initialize_work()
+
+        # Transition rows in float64 whatever the network dtype, as cumulative sums: (num_mode, num_mode) or
+        # (num_regime * num_mode, num_mode), row regime * num_mode + mode. The last entry is inf so every uniform lands in a mode.
+        prob_matrix = np.asarray(self.param_source.get('prob_matrix', self.param['prob_matrix']), dtype=float)
+        cumulative_prob = np.cumsum(prob_matrix, axis=-1).reshape(-1, prob_matrix.shape[-1])
+        cumulative_prob[:, -1] = np.inf
+        self.work['cumulative_prob'] = cumulative_prob
+        self.work['mode_list'] = np.asarray(self.param['mode_list'], dtype=int)
+
+        # Diagnostics of the chain (per regime): stationary distribution, spectral gap, relaxation and sojourn times.
+        self.work['chain_summary'] = utils.get_markov_chain_summary(prob_matrix, self.net.param['time_step_size'])
+
+
+    def get_chain_summary(self):
+        # See utils.get_markov_chain_summary(), times in the network's time unit; available after initialize().
+        return self.work['chain_summary']
+
 
     def initialize_co_state(self):
-        self.co_state['flow'] = np.full(self.net.param['state_len'], np.nan)
+        self.co_state['flow'] = np.full(self.net.param['state_len'], np.nan, dtype=self.net.param['dtype'])
 
         if self.param['has_multi_regime']:
-            self.co_state['real_time_regime'] = np.full(self.net.param['state_len'], np.nan)
+            self.co_state['real_time_regime'] = np.full(self.net.param['state_len'], np.nan, dtype=self.net.param['dtype'])
 
 
-    def compute_flow(self, density, mode):
-        return np.clip(self.param['free_flow_speed'][mode] * density, 0, self.param['capacity'][mode])
+    def compute_flow(self, density, mode, out=None):
+        out = np.multiply(self.param['free_flow_speed'][mode], density, out=out)
+        return np.clip(out, 0, self.param['capacity'][mode], out=out)
 
 
-    def _compute_flow(self):
+    def _compute_flow(self, out=None):
         # flow: (state_len, ).
-        return self.compute_flow(self.cell.state['density'], self.state['real_time_mode']) 
+        return self.compute_flow(self.cell.state['density'], self.state['real_time_mode'], out=out) 
+
+
+    def get_wave_speed(self):
+        return np.max(np.abs(self.param['free_flow_speed']))
+
+
+    def draw_block(self):
+        # Uniforms of the next steps: (num_row, state_len).
+        # Columns of a group: (num_row, group_len), from the group's generator.
+        group_len = self.net.param['state_len'] // len(self.rng)
 
+        block_list = []
+        for rng in self.rng:
+            if self.param['sampling'] == 'sobol':
+                # Column c is point c of the window's sequence; a group_len power of two keeps its balance properties.
+                sobol = qmc.Sobol(self.param['block_len'], scramble=True, rng=rng)
+                block_list.append(sobol.random(group_len).T)
+            elif self.param['sampling'] == 'antithetic':
+                uniform = rng.random((self.param['block_len'], group_len // 2))
+                block_list.append(np.concatenate([uniform, 1 - uniform], axis=1))
+            else:
+                block_list.append(rng.random((self.param['block_len'], group_len)))
 
-    def sample_next_mode(self):
-        if not self.param['has_multi_regime']:
-            next_mode = [np.random.choice(self.param['mode_list'], p=self.param['prob_matrix'][m, :]) for m in self.state['real_time_mode']]
+        return np.ascontiguousarray(np.concatenate(block_list, axis=1))
 
+
+    def draw_uniform(self):
+        # uniform: (state_len, ), the next row of the current block. Blocks continue one stream, so the draws do not depend on block_len.
+        if self.uniform_row == len(self.uniform):
+            self.uniform, self.uniform_row = self.draw_block(), 0
+
+        self.uniform_row += 1
+        return self.uniform[self.uniform_row - 1]
+
+
+    def sample_next_mode(self, out=None):
+        # One uniform per column against the cumulative transition row of its (regime, ) mode; out may be the mode itself.
+        mode = self.state['real_time_mode']
+        cumulative_prob = self.work['cumulative_prob']
+        if self.param['has_multi_regime']:
+            row = np.multiply(self.co_state['real_time_regime'], cumulative_prob.shape[1], out=self.work_buffer('row', mode.shape, int), casting='unsafe')
+            row = np.add(row, mode, out=row)
         else:
-            next_mode = [np.random.choice(self.param['mode_list'], p=self.param['prob_matrix'][r, m, :]) for r, m in zip(self.co_state['real_time_regime'], self.state['real_time_mode'])]
+            row = mode
+
+        # Next mode index: number of cumulative probabilities not above the uniform.
+        transition = np.take(cumulative_prob, row, axis=0, out=self.work_buffer('transition', (len(mode), cumulative_prob.shape[1]), float))
+        is_passed = np.less_equal(transition, self.draw_uniform()[:, None], out=self.work_buffer('is_passed', transition.shape, bool))
+        next_mode_idx = np.sum(is_passed, axis=1, out=self.work_buffer('next_mode_idx', mode.shape, int))
 
         # next_mode: (state_len, ).
-        return np.atleast_1d(next_mode)
+        if out is None:
+            out = np.empty(len(mode), dtype=int)
+        return np.take(self.work['mode_list'], next_mode_idx, out=out)
 
 
     def find_regime(self, density):
@@ -267,7 +413,7 @@ class MarkovianPiecewiseLinearSendingFlow(Flow):
 
 
     def iterate(self):
-        self.co_state['flow'] = self._compute_flow()
+        self._compute_flow(out=self.co_state['flow'])
 
         if self.param['has_multi_regime']:
             self.co_state['real_time_regime'] = self.find_regime(self.cell.state['density'])
@@ -281,12 +427,15 @@ class UnboundedReceivingFlow(Flow):
     def __init__(self, cell=None, is_state_saved=True, is_co_state_saved=True):
         super().__init__(cell, is_state_saved, is_co_state_saved)
 
-    def compute_flow(self, state_len):
-        return np.inf * np.ones(state_len)
+    def compute_flow(self, state_len, out=None):
+        if out is None:
+            out = np.empty(state_len, dtype=self.net.param['dtype'])
+        out.fill(np.inf)
+        return out
 
-    def _compute_flow(self):
+    def _compute_flow(self, out=None):
         # flow: (state_len, ).
-        return self.compute_flow(self.net.param['state_len'])
+        return self.compute_flow(self.net.param['state_len'], out=out)
 
 
 class PiecewiseLinearReceivingFlow(Flow):
@@ -304,13 +453,19 @@ class PiecewiseLinearReceivingFlow(Flow):
         self.param['capacity'] = np.atleast_1d(capacity)
 
 
-    def compute_flow(self, density):
-        return np.clip(self.param['congestion_wave_speed'] * (self.param['max_density'] - density), 0, self.param['capacity'])
+    def compute_flow(self, density, out=None):
+        out = np.subtract(self.param['max_density'], density, out=out)
+        np.multiply(self.param['congestion_wave_speed'], out, out=out)
+        return np.clip(out, 0, self.param['capacity'], out=out)
 
 
-    def _compute_flow(self):
+    def _compute_flow(self, out=None):
         # flow: (state_len, ).
-        return self.compute_flow(self.cell.state['density'])
+        return self.compute_flow(self.cell.state['density'], out=out)
+
+
+    def get_wave_speed(self):
+        return np.max(np.abs(self.param['congestion_wave_speed']))
         
 
 class LookAheadPiecewiseLinearReceivingFlow(Flow):
@@ -344,34 +499,35 @@ class LookAheadPiecewiseLinearReceivingFlow(Flow):
         self.param['look_ahead_capacity'] = look_ahead_capacity
 
 
-    def compute_flow(self, density, density_upstream):
+    def _select(self, name, is_look_ahead_triggered):
+        # Parameter name, or its look-ahead counterpart where triggered, written into a scratch buffer.
+        real_value = self.work_buffer(f'real_{name}', is_look_ahead_triggered.shape)
+        np.copyto(real_value, self.param[name])
+        np.copyto(real_value, self.param[f'look_ahead_{name}'], where=is_look_ahead_triggered)
+        return real_value
 
-        is_look_ahead_triggered = density_upstream <= self.param['look_ahead_density_threshold']
 
-        real_congestion_wave_speed = np.where(
-            is_look_ahead_triggered, 
-            self.param['look_ahead_congestion_wave_speed'], 
-            self.param['congestion_wave_speed'], 
-        )
+    def compute_flow(self, density, density_upstream, out=None):
+        shape = np.broadcast_shapes(np.shape(density), np.shape(density_upstream))
 
-        real_max_density = np.where(
-            is_look_ahead_triggered,
-            self.param['look_ahead_max_density'], 
-            self.param['max_density'],    
-        )
+        is_look_ahead_triggered = np.less_equal(density_upstream, self.param['look_ahead_density_threshold'], out=self.work_buffer('is_look_ahead_triggered', shape, bool))
 
-        real_capacity = np.where(
-            is_look_ahead_triggered, 
-            self.param['look_ahead_capacity'], 
-            self.param['capacity']
-        )
+        real_congestion_wave_speed = self._select('congestion_wave_speed', is_look_ahead_triggered)
+        real_max_density = self._select('max_density', is_look_ahead_triggered)
+        real_capacity = self._select('capacity', is_look_ahead_triggered)
 
-        return np.clip(real_congestion_wave_speed * (real_max_density - density), 0, real_capacity)
+        out = np.subtract(real_max_density, density, out=out)
+        np.multiply(real_congestion_wave_speed, out, out=out)
+        return np.clip(out, 0, real_capacity, out=out)
 
 
-    def _compute_flow(self):
+    def _compute_flow(self, out=None):
         # flow: (state_len, ).
-        return self.compute_flow(self.cell.state['density'], self.cell_upstream.state['density'])
+        return self.compute_flow(self.cell.state['density'], self.cell_upstream.state['density'], out=out)
+
+
+    def get_wave_speed(self):
+        return max(np.max(np.abs(self.param['congestion_wave_speed'])), np.max(np.abs(self.param['look_ahead_congestion_wave_speed'])))
         
 
 if __name__ == '__main__':
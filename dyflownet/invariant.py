@@ -0,0 +1,211 @@
+import itertools
+import numpy as np
+
+from . import stream
+
+
+# Invariant sets and basins of attraction over the densities of chosen cells (the other cells start from their initial
+# density in column). A box lower <= x <= upper is forward invariant when the vector field does not point out of it
+# on its faces: d(x_i)/dt >= 0 on the face x_i = lower_i and <= 0 on x_i = upper_i (Nagumo's condition), checked on a
+# grid of every face. Basins are found by simulating points until the chosen densities are steady and labelling each
+# by the attractor, the final densities, it reaches; refine_basin() spends the points on the grid cells a basin
+# boundary crosses. Vector field values and final densities are cached per point, so refinements only evaluate new points.
+
+
+class InvariantSetAnalysis:
+    def __init__(self, net, cell_id_list, column=0, step=0, chunk_size=65536, engine='array', backend='numpy', num_steady_step=10):
+        self.net = net
+
+        self.param = {
+            # IDs of the cells spanning the density space, in the order of point coordinates.
+            'cell_id_list': list(cell_id_list),
+            'column': column,
+            'step': step,
+            'chunk_size': chunk_size,
+            'engine': engine,
+            'backend': backend,
+
+            # Consecutive steps within tol before a simulated point counts as steady, see steady.run().
+            'num_steady_step': num_steady_step,
+
+            # Decimals of the cache keys of points.
+            'decimals': 12,
+        }
+
+        # cache: {'vector_field' or 'final_density': {point key: value}}.
+        self.cache = {'vector_field': {}, 'final_density': {}}
+
+        # attractor_list: final densities of the attractors found so far, labels are indices in it.
+        self.attractor_list = []
+
+
+    def get_key(self, point):
+        point = np.round(np.asarray(point, dtype=float), self.param['decimals']) + 0.0
+        return [p.tobytes() for p in point]
+
+
+    def cached(self, name, point, compute):
+        # Values of compute at points: (num_point, num_dim), computing only the points not in the cache.
+        point = np.atleast_2d(np.asarray(point, dtype=float))
+        key_list = self.get_key(point)
+        cache = self.cache[name]
+
+        # new: {key: index of its first point} of the points not cached yet.
+        new = {}
+        for i, k in enumerate(key_list):
+            if k not in cache and k not in new:
+                new[k] = i
+
+        if new:
+            for k, v in zip(new, compute(point[list(new.values())])):
+                cache[k] = v
+
+        return np.array([cache[k] for k in key_list])
+
+
+    def vector_field(self, point):
+        # d(density)/dt of the cells at points: (num_point, num_dim).
+        def compute(point):
+            density_by_cell = {ID: point[:, i] for i, ID in enumerate(self.param['cell_id_list'])}
+            rate = self.net.vector_field(density_by_cell, self.param['chunk_size'], self.param['column'], self.param['step'], self.param['engine'], self.param['backend'])
+            return np.stack([rate[ID] for ID in self.param['cell_id_list']], axis=1)
+
+        return self.cached('vector_field', point, compute)
+
+
+    def get_face_point(self, lower, upper, num_point=11):
+        # [(dimension, side, points: (num_point ** (num_dim - 1), num_dim))] of every face, side -1 lower and +1 upper.
+        lower, upper = np.asarray(lower, dtype=float), np.asarray(upper, dtype=float)
+        num_dim = len(lower)
+        axis_list = [np.linspace(lower[i], upper[i], num_point) for i in range(num_dim)]
+
+        face_list = []
+        for i in range(num_dim):
+            for side, bound in [(-1, lower[i]), (1, upper[i])]:
+                grid = np.meshgrid(*[axis_list[j] if j != i else np.array([bound]) for j in range(num_dim)], indexing='ij')
+                face_list.append((i, side, np.stack([g.ravel() for g in grid], axis=1)))
+        return face_list
+
+
+    def check_box(self, lower, upper, num_point=11, tol=0):
+        # Returns whether the box is invariant and {(dimension, side): largest outward d(x_i)/dt on that face}.
+        face_list = self.get_face_point(lower, upper, num_point)
+        rate = self.vector_field(np.concatenate([point for _, _, point in face_list]))
+
+        violation, start = {}, 0
+        for i, side, point in face_list:
+            outward = side * rate[start:start + len(point), i]
+            violation[(i, side)] = np.max(outward)
+            start += len(point)
+
+        return all(v <= tol for v in violation.values()), violation
+
+
+    def find_invariant_box(self, lower, upper, num_point=11, shrink=0.02, max_iter=100, tol=0):
+        # Candidate invariant box inside [lower, upper]: faces on which the field points outward move inward by shrink
+        # times the initial width, until every face passes check_box(); None if the box collapses first.
+        lower, upper = np.array(lower, dtype=float), np.array(upper, dtype=float)
+        width = upper - lower
+
+        for _ in range(max_iter):
+            is_invariant, violation = self.check_box(lower, upper, num_point, tol)
+            if is_invariant:
+                return lower, upper
+
+            for (i, side), v in violation.items():
+                if v > tol:
+                    if side < 0:
+                        lower[i] += shrink * width[i]
+                    else:
+                        upper[i] -= shrink * width[i]
+
+            if np.any(lower > upper):
+                return None
+        return None
+
+
+    def simulate(self, point, tol=1e-6):
+        # Final densities of the cells: (num_point, num_dim), from stream.run() until the densities of the chosen cells
+        # change by at most tol in num_steady_step steps in a row; NaN where a column did not within num_step. Only the
+        # chosen cells are checked, so e.g. a source queue growing without bound does not keep the others from being steady.
+        cell_id_list = self.param['cell_id_list']
+        chunk = dict(zip(cell_id_list, np.asarray(point, dtype=float).T))
+        result = stream.run(self.net, [chunk], min(self.param['chunk_size'], len(point)), field_list=[f'{ID}:density' for ID in cell_id_list],
+                            until='steady', tol=tol, column=self.param['column'], engine=self.param['engine'], backend=self.param['backend'],
+                            cell_id_list=cell_id_list, num_steady_step=self.param['num_steady_step'])
+
+        final_density = np.stack([result[f'{ID}:density'] for ID in cell_id_list], axis=1)
+        return np.where(result['convergence_step'][:, None] >= 0, final_density, np.nan)
+
+
+    def get_final_density(self, point, tol=1e-6):
+        return self.cached('final_density', point, lambda p: self.simulate(p, tol))
+
+
+    def label_basin(self, point, tol=1e-6, attractor_tol=1e-3):
+        # Labels of points: (num_point, ), the index in attractor_list of the attractor reached (final densities within
+        # attractor_tol in max norm of one found before, a new one otherwise), -1 if not steady within num_step.
+        final_density = self.get_final_density(point, tol)
+
+        label = np.full(len(final_density), -1, dtype=int)
+        is_open = ~np.isnan(final_density).any(axis=1)
+
+        while True:
+            if self.attractor_list:
+                # distance: (num_point, num_attractor).
+                distance = np.max(np.abs(final_density[:, None, :] - np.array(self.attractor_list)[None, :, :]), axis=2)
+                is_near = is_open & (np.min(distance, axis=1) <= attractor_tol)
+                label[is_near] = np.argmin(distance[is_near], axis=1)
+                is_open &= ~is_near
+
+            if not is_open.any():
+                return label
+            # The first point left open founds a new attractor.
+            self.attractor_list.append(final_density[np.argmax(is_open)].copy())
+
+
+    def refine_basin(self, lower, upper, num_point=11, num_level=3, tol=1e-6, attractor_tol=1e-3):
+        # Basin labels on a grid refined near basin boundaries: starts from num_point per dimension (an int or a list),
+        # then num_level times halves only the grid cells whose corners have different labels (another attractor, or
+        # one not steady). Returns points: (num_simulated, num_dim) and their labels: (num_simulated, ).
+        lower, upper = np.asarray(lower, dtype=float), np.asarray(upper, dtype=float)
+        num_dim = len(lower)
+        num_point_list = np.broadcast_to(num_point, num_dim)
+
+        # Points are held as integer indices on the finest grid, so that a point has the same coordinates (and cache
+        # key) at every level.
+        size = 2 ** num_level
+        spacing = (upper - lower) / ((num_point_list - 1) * size)
+        corner = np.array(list(itertools.product([0, 1], repeat=num_dim)))
+
+        # cell: (num_cell, num_dim), lower corners of the grid cells of the current level, size fine steps wide.
+        cell = self.get_grid(np.zeros(num_dim), num_point_list - 2, num_point_list - 1).astype(int) * size
+        index_list = []
+
+        while len(cell):
+            index = (cell[:, None, :] + corner[None, :, :] * size).reshape(-1, num_dim)
+            index_list.append(index)
+            if size == 1:
+                break
+
+            label = self.label_basin(lower + index * spacing, tol, attractor_tol).reshape(len(cell), len(corner))
+            is_boundary = np.any(label != label[:, :1], axis=1)
+
+            size //= 2
+            cell = (cell[is_boundary, None, :] + corner[None, :, :] * size).reshape(-1, num_dim)
+
+        index = np.unique(np.concatenate(index_list), axis=0)
+        point = lower + index * spacing
+        return point, self.label_basin(point, tol, attractor_tol)
+
+
+    def get_grid(self, lower, upper, num_point):
+        # Points of a regular grid over the box, (num_point ** num_dim, num_dim), or num_point per dimension if a list.
+        num_point_list = np.broadcast_to(num_point, len(lower))
+        grid = np.meshgrid(*[np.linspace(l, u, n) for l, u, n in zip(lower, upper, num_point_list)], indexing='ij')
+        return np.stack([g.ravel() for g in grid], axis=1)
+
+
+
+if __name__ == '__main__':
+    pass
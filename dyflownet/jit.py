@@ -0,0 +1,209 @@
+try:
+    import numba
+except ImportError:
+    numba = None
+
+
+# Optional Numba backend of the array engine, see ArrayEngine(backend='numba'). Each kernel fuses the NumPy
+# operations of one flow group, node group or cell phase into a single loop, parallel over the batch axis, and
+# performs the same floating-point operations in the same order, so that results match the NumPy path.
+# Without Numba, the functions below stay plain Python and the engine keeps to the NumPy path.
+
+HAS_NUMBA = numba is not None
+
+
+def jit(fn):
+    if numba is None:
+        return fn
+    return numba.njit(parallel=True, cache=True, error_model='numpy')(fn)
+
+
+def jit_scalar(fn):
+    if numba is None:
+        return fn
+    return numba.njit(inline='always', cache=True, error_model='numpy')(fn)
+
+
+prange = range if numba is None else numba.prange
+
+
+
+# ============================== Scalar helpers =====================================
+
+@jit_scalar
+def minimum(x, y):
+    # np.minimum, NaN propagating.
+    return x if x < y or x != x else y
+
+
+@jit_scalar
+def maximum(x, y):
+    # np.maximum, NaN propagating.
+    return x if x > y or x != x else y
+
+
+@jit_scalar
+def clip(x, lower, upper):
+    return minimum(maximum(x, lower), upper)
+
+
+@jit_scalar
+def median_of_three(x, y, z):
+    # Same operations as utils.median_of_three.
+    return maximum(minimum(x, y), minimum(maximum(x, y), z))
+
+
+@jit_scalar
+def safe_div(x, y, fill):
+    # utils.safe_div; fill is given in the array dtype, a float64 literal would promote float32 expressions.
+    return x / y if y != 0 else fill
+
+
+
+# ============================== Flow kernels =====================================
+# density: (num_cell, state_len), cell_idx: (num_flow, ), parameters and out: (num_flow, state_len).
+
+@jit
+def boundary_outflow(density, cell_idx, boundary_speed, boundary_capacity, out):
+    for s in prange(out.shape[1]):
+        for i in range(out.shape[0]):
+            out[i, s] = minimum(boundary_speed[i, s] * density[cell_idx[i], s], boundary_capacity[i, s])
+
+
+@jit
+def piecewise_linear_sending(density, cell_idx, free_flow_speed, capacity, out):
+    for s in prange(out.shape[1]):
+        for i in range(out.shape[0]):
+            out[i, s] = clip(free_flow_speed[i, s] * density[cell_idx[i], s], 0, capacity[i, s])
+
+
+@jit
+def capacity_drop_piecewise_linear_sending(density, cell_idx, free_flow_speed, capacity, capacity_drop_density_threshold, capacity_dropped, real_capacity, out):
+    for s in prange(out.shape[1]):
+        for i in range(out.shape[0]):
+            d = density[cell_idx[i], s]
+            real_capacity[i, s] = capacity_dropped[i, s] if d > capacity_drop_density_threshold[i, s] else capacity[i, s]
+            out[i, s] = clip(free_flow_speed[i, s] * d, 0, real_capacity[i, s])
+
+
+@jit
+def piecewise_linear_receiving(density, cell_idx, congestion_wave_speed, max_density, capacity, out):
+    for s in prange(out.shape[1]):
+        for i in range(out.shape[0]):
+            out[i, s] = clip(congestion_wave_speed[i, s] * (max_density[i, s] - density[cell_idx[i], s]), 0, capacity[i, s])
+
+
+@jit
+def look_ahead_piecewise_linear_receiving(density, cell_idx, upstream_cell_idx, congestion_wave_speed, max_density, capacity, look_ahead_density_threshold,
+                                          look_ahead_congestion_wave_speed, look_ahead_max_density, look_ahead_capacity, out):
+    for s in prange(out.shape[1]):
+        for i in range(out.shape[0]):
+            if density[upstream_cell_idx[i], s] <= look_ahead_density_threshold[i, s]:
+                w, m, c = look_ahead_congestion_wave_speed[i, s], look_ahead_max_density[i, s], look_ahead_capacity[i, s]
+            else:
+                w, m, c = congestion_wave_speed[i, s], max_density[i, s], capacity[i, s]
+            out[i, s] = clip(w * (m - density[cell_idx[i], s]), 0, c)
+
+
+
+# ============================== Junction kernels =====================================
+# flow: (num_flow, state_len), sending_row: (num_node, num_incoming_cell), receiving_row: (num_node, num_outgoing_cell),
+# parameters: (num_node, state_len), out: (num_node, num_incoming_cell, num_outgoing_cell, state_len).
+
+@jit
+def basic_junction(flow, sending_row, receiving_row, out):
+    for s in prange(out.shape[3]):
+        for k in range(out.shape[0]):
+            out[k, 0, 0, s] = minimum(flow[sending_row[k, 0], s], flow[receiving_row[k, 0], s])
+
+
+@jit
+def two_to_one_merge_junction(flow, sending_row, receiving_row, merging_priority_0, merging_priority_1, out):
+    for s in prange(out.shape[3]):
+        for k in range(out.shape[0]):
+            sending_i_0, sending_i_1 = flow[sending_row[k, 0], s], flow[sending_row[k, 1], s]
+            receiving_j_0 = flow[receiving_row[k, 0], s]
+
+            if sending_i_0 + sending_i_1 <= receiving_j_0:
+                out[k, 0, 0, s], out[k, 1, 0, s] = sending_i_0, sending_i_1
+            else:
+                out[k, 0, 0, s] = median_of_three(sending_i_0, receiving_j_0 - sending_i_1, merging_priority_0[k, s] * receiving_j_0)
+                out[k, 1, 0, s] = median_of_three(sending_i_1, receiving_j_0 - sending_i_0, merging_priority_1[k, s] * receiving_j_0)
+
+
+@jit
+def one_to_two_diverge_junction(flow, sending_row, receiving_row, split_j_0, split_j_1, is_FIFO, inf, out):
+    for s in prange(out.shape[3]):
+        for k in range(out.shape[0]):
+            sending_i_0 = flow[sending_row[k, 0], s]
+            receiving_j_0, receiving_j_1 = flow[receiving_row[k, 0], s], flow[receiving_row[k, 1], s]
+
+            if not is_FIFO:
+                out[k, 0, 0, s] = minimum(split_j_0[k, s] * sending_i_0, receiving_j_0)
+                out[k, 0, 1, s] = minimum(split_j_1[k, s] * sending_i_0, receiving_j_1)
+            else:
+                total_flow = minimum(sending_i_0, safe_div(receiving_j_0, split_j_0[k, s], inf))
+                total_flow = minimum(total_flow, safe_div(receiving_j_1, split_j_1[k, s], inf))
+                out[k, 0, 0, s] = split_j_0[k, s] * total_flow
+                out[k, 0, 1, s] = split_j_1[k, s] * total_flow
+
+
+@jit
+def freeway_ramp_junction(flow, sending_row, receiving_row, onramp_priority, split_to_mainline, split_to_offramp, has_control, control_input, inf, out):
+    for s in prange(out.shape[3]):
+        for k in range(out.shape[0]):
+            sending_mainline, sending_onramp = flow[sending_row[k, 0], s], flow[sending_row[k, 1], s]
+            receiving_mainline, receiving_offramp = flow[receiving_row[k, 0], s], flow[receiving_row[k, 1], s]
+
+            # Flow from onramp to mainline.
+            flow_onramp_to_mainline = minimum(sending_onramp, receiving_mainline)
+            if has_control:
+                flow_onramp_to_mainline = minimum(flow_onramp_to_mainline, control_input[k, s])
+
+            # Flow from mainline to mainline.
+            sending_mainline_to_mainline = split_to_mainline[k, s] * minimum(sending_mainline, safe_div(receiving_offramp, split_to_offramp[k, s], inf))
+            remaining_mainline = receiving_mainline - onramp_priority[k, s] * flow_onramp_to_mainline
+            flow_mainline_to_mainline = minimum(sending_mainline_to_mainline, remaining_mainline)
+
+            # Flow from mainline to off-ramp.
+            if split_to_mainline[k, s] != 0:
+                flow_mainline_to_offramp = flow_mainline_to_mainline * (split_to_offramp[k, s] / split_to_mainline[k, s])
+            else:
+                flow_mainline_to_offramp = minimum(sending_mainline, receiving_offramp)
+
+            out[k, 0, 0, s], out[k, 0, 1, s], out[k, 1, 0, s] = flow_mainline_to_mainline, flow_mainline_to_offramp, flow_onramp_to_mainline
+
+
+
+# ============================== Cell kernels =====================================
+# Cell arrays and cell parameters: (num_cell, state_len), parameters stored full width as in ArrayEngine.compile_cell.
+
+@jit
+def segment_sum(movement, indices, segment_start, segment_stop, cell, out):
+    # out[cell[k]] = sum of movement[indices[segment_start[k]:segment_stop[k]]], added in order as np.add.reduceat does.
+    for s in prange(movement.shape[1]):
+        for k in range(len(cell)):
+            total = movement[indices[segment_start[k]], s]
+            for j in range(segment_start[k] + 1, segment_stop[k]):
+                total += movement[indices[j], s]
+            out[cell[k], s] = total
+
+
+@jit
+def cell_speed(density, outflow, min_speed, max_speed, out):
+    for s in prange(out.shape[1]):
+        for i in range(out.shape[0]):
+            speed = outflow[i, s] / density[i, s] if density[i, s] != 0 else max_speed[i, s]
+            out[i, s] = clip(speed, min_speed[i, s], max_speed[i, s])
+
+
+@jit
+def cell_density(inflow, outflow, time_step_size, cell_len, min_density, max_density, density):
+    for s in prange(density.shape[1]):
+        for i in range(density.shape[0]):
+            density_change = (inflow[i, s] - outflow[i, s]) * time_step_size / cell_len[i, s]
+            density[i, s] = clip(density[i, s] + density_change, min_density[i, s], max_density[i, s])
+
+
+if __name__ == '__main__':
+    pass
@@ -0,0 +1,141 @@
+import itertools
+import numpy as np
+
+from . import parallel
+from . import utils
+from .flow import MarkovianPiecewiseLinearSendingFlow
+
+
+# Mean-field pass of a network with Markovian flows, in the manner of Markov jump linear systems: the joint mode of the
+# Markovian flows is not sampled, its distribution is propagated together with the mean of every state conditional on
+# the joint mode. The work network holds one copy of the columns per joint mode, with the modes fixed; after each step
+# the copies are mixed by the transition probabilities, taken in the regime of each copy's mean density at the start
+# of the step. Outputs of the network are the means over joint modes, and net.mode_probability holds the probabilities
+# of the modes of each Markovian flow. Exact for dynamics linear in the states within each mode; with the min and clip
+# of flow laws it is an approximation keeping conditional means only.
+
+
+def get_joint_transition(flow_list, mode_table, state_len):
+    # transition: (num_joint_mode, num_joint_mode, state_len), from joint mode j to k in each column, the product of the
+    # transitions of the flows in the regime of their cell in copy j. mode_table: (num_joint_mode, num_flow), mode indices.
+    num_joint_mode = len(mode_table)
+    transition = np.ones((num_joint_mode, num_joint_mode, state_len))
+
+    for f, flow in enumerate(flow_list):
+        prob_matrix = np.asarray(flow.param_source.get('prob_matrix', flow.param['prob_matrix']), dtype=float)
+        if flow.param['has_multi_regime']:
+            regime = flow.find_regime(flow.cell.state['density']).reshape(num_joint_mode, state_len)
+        else:
+            prob_matrix, regime = prob_matrix[None], np.zeros((num_joint_mode, state_len), dtype=int)
+
+        mode = mode_table[:, f]
+        transition *= prob_matrix[regime[:, None, :], mode[:, None, None], mode[None, :, None]]
+
+    return transition
+
+
+def get_mean(probability, value):
+    # Mean over joint modes of value: (num_joint_mode * state_len, ...), copies mode-major; probability: (state_len, num_joint_mode).
+    value = np.asarray(value, dtype=float)
+    return np.einsum('sj,js...->s...', probability, value.reshape(probability.shape[::-1] + value.shape[1:]))
+
+
+def run(net, engine='object', backend='numpy'):
+    num_step, state_len = net.param['num_step'], net.param['state_len']
+
+    # Outputs are allocated (and the initial records written) here, by the recorders of the network's rule.
+    net.initialize()
+    spec = parallel.get_spec(net)
+    unit_dict = net.get_unit_dict()
+
+    flow_name_list = [name for name, u in unit_dict.items() if isinstance(u, MarkovianPiecewiseLinearSendingFlow)]
+    if not flow_name_list:
+        raise ValueError('The mean-field pass needs a Markovian flow.')
+
+    # mode_table: (num_joint_mode, num_flow), the mode index of every flow in each joint mode.
+    mode_list_list = [np.asarray(unit_dict[name].param['mode_list'], dtype=int) for name in flow_name_list]
+    mode_table = np.array(list(itertools.product(*[range(len(mode_list)) for mode_list in mode_list_list])), dtype=int).reshape(-1, len(flow_name_list))
+    num_joint_mode = len(mode_table)
+
+    work_net = parallel.from_spec(parallel.get_shard_spec(spec, np.tile(np.arange(state_len), num_joint_mode)))
+    work_net.set_recorder({'*': None})
+    if engine == 'array':
+        work_net.compile(backend)
+        work_net.engine.initialize()
+    else:
+        work_net.initialize()
+
+    work_dict = work_net.get_unit_dict()
+    work_flow_list = [work_dict[name] for name in flow_name_list]
+
+    # fixed_mode_list: (num_joint_mode * state_len, ) per flow, its mode in each copy.
+    fixed_mode_list = [np.repeat(mode_list[mode_table[:, f]], state_len) for f, mode_list in enumerate(mode_list_list)]
+
+    # probability: (state_len, num_joint_mode), at first the joint mode of the initial modes.
+    probability = np.ones((state_len, num_joint_mode))
+    for f, name in enumerate(flow_name_list):
+        initial_mode = np.argmax(unit_dict[name].state['real_time_mode'][:, None] == mode_list_list[f][None, :], axis=1)
+        probability *= initial_mode[:, None] == mode_table[None, :, f]
+
+    # mode_probability: {flow name: (state_len, num_mode, num_step+1)}, marginal probabilities of the modes.
+    mode_probability = {name: np.zeros((state_len, len(mode_list), num_step + 1)) for name, mode_list in zip(flow_name_list, mode_list_list)}
+
+    def save_mode_probability(index):
+        for f, name in enumerate(flow_name_list):
+            for m in range(len(mode_list_list[f])):
+                mode_probability[name][:, m, index] = probability[:, mode_table[:, f] == m].sum(axis=1)
+
+    # Conditional means of the floating states, mixed every step; integer states (modes) are fixed by copy.
+    mixed_list = [(unit.state, k) for unit in work_dict.values() for k, v in unit.state.items() if np.issubdtype(np.asarray(v).dtype, np.floating)]
+    recorder_list = parallel.get_recorder_list(net)
+
+    save_mode_probability(0)
+    for step in range(num_step):
+        for flow, fixed_mode in zip(work_flow_list, fixed_mode_list):
+            flow.state['real_time_mode'] = fixed_mode.copy()
+        transition = get_joint_transition(work_flow_list, mode_table, state_len)
+
+        if engine == 'array':
+            work_net.engine.run_one_step()
+        else:
+            work_net.run_one_step()
+
+        for name, kind, k, recorder in recorder_list:
+            if kind == 'co_state':
+                recorder.write(step, get_mean(probability, work_dict[name].co_state[k]))
+
+        # joint: (num_joint_mode, num_joint_mode, state_len), probability of mode j at step and k at step + 1.
+        joint = probability.T[:, None, :] * transition
+        probability = joint.sum(axis=0).T
+
+        # weight: of copy j in the conditional mean of mode k, the overall mean for modes of probability zero.
+        weight = np.where(probability.T[None, :, :] > 0, utils.safe_div(joint, probability.T[None, :, :], fill=0), joint.sum(axis=1, keepdims=True))
+
+        for state, k in mixed_list:
+            value = np.asarray(state[k], dtype=float)
+            value = value.reshape((num_joint_mode, state_len) + value.shape[1:])
+            state[k][...] = np.einsum('jks,js...->ks...', weight, value).reshape(state[k].shape)
+
+        for flow, fixed_mode in zip(work_flow_list, fixed_mode_list):
+            flow.state['real_time_mode'] = fixed_mode.copy()
+
+        for name, kind, k, recorder in recorder_list:
+            if kind == 'state':
+                recorder.write(step + 1, get_mean(probability, work_dict[name].state[k]))
+        save_mode_probability(step + 1)
+
+    # Final states are the means; modes the most probable ones.
+    for name, unit in unit_dict.items():
+        for k, v in unit.state.items():
+            if np.issubdtype(v.dtype, np.floating):
+                v[...] = get_mean(probability, work_dict[name].state[k])
+    for f, name in enumerate(flow_name_list):
+        unit_dict[name].state['real_time_mode'][...] = mode_list_list[f][np.argmax(mode_probability[name][:, :, -1], axis=1)]
+
+    net.finalize_output()
+    net.mode_probability = mode_probability
+    net.step = num_step
+
+
+if __name__ == '__main__':
+    pass
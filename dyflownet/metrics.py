@@ -0,0 +1,268 @@
+import numpy as np
+from . import utils
+
+
+# Online metrics: updated once per step from the cells' densities and flows of that step (before densities advance),
+# so that aggregate results need no stored trajectory. Attach with Network.add_metric().
+
+class Metric:
+    def __init__(self):
+        self.param = {}
+        self.state = {}
+        self.work = {}
+
+
+    def initialize(self, net):
+        self.net = net
+        self.state = {}
+        self.work = {}
+
+
+    def update(self, net):
+        pass
+
+
+    def finalize(self):
+        pass
+
+
+    def work_buffer(self, name, shape, dtype=float):
+        return utils.work_buffer(self.work, name, shape, dtype)
+
+
+
+class CellKPI(Metric):
+    # Running sums and extrema per cell and per column, all (num_cell, state_len), cells ordered as
+    # Network.get_cell_list(). Units follow the network: density in veh/length, flows in veh/time, time_step_size in time.
+    #   vehicle_time:       sum of density * cell_len * dt (vehicle-hours travelled when time is in hours).
+    #   vehicle_distance:   sum of outflow * dt * cell_len (vehicle-km travelled when length is in km).
+    #   delay:              vehicle_time minus vehicle_distance / max_speed (free-flow travel time), per step.
+    #   cumulative_inflow, cumulative_outflow: vehicles that entered and left the cell.
+    #   max_density, max_vehicle: extrema of density and of vehicles in the cell (the queue, for sources).
+    name_list = ['vehicle_time', 'vehicle_distance', 'delay', 'cumulative_inflow', 'cumulative_outflow', 'max_density', 'max_vehicle']
+
+    def initialize(self, net):
+        super().initialize(net)
+
+        cell_list = net.get_cell_list()
+        self.param['num_source'] = len(net.source_list)
+        self.param['num_sink'] = len(net.sink_list)
+
+        # cell_len, pace (inverse of the free-flow speed): (num_cell, 1).
+        self.param['cell_len'] = np.array([[c.param['cell_len']] for c in cell_list], dtype=float)
+        self.param['pace'] = 1 / np.array([[c.param['max_speed']] for c in cell_list], dtype=float)
+
+        shape = (len(cell_list), net.param['state_len'])
+        for name in self.name_list:
+            self.state[name] = np.zeros(shape)
+        self.state['max_density'].fill(-np.inf)
+        self.state['max_vehicle'].fill(-np.inf)
+
+
+    def update(self, net):
+        dt = net.param['time_step_size']
+        density, inflow, outflow = net.get_cell_value('density'), net.get_cell_value('inflow'), net.get_cell_value('outflow')
+
+        vehicle = np.multiply(density, self.param['cell_len'], out=self.work_buffer('vehicle', density.shape))
+        np.maximum(self.state['max_vehicle'], vehicle, out=self.state['max_vehicle'])
+        np.maximum(self.state['max_density'], density, out=self.state['max_density'])
+
+        vehicle_time = np.multiply(vehicle, dt, out=vehicle)
+        np.add(self.state['vehicle_time'], vehicle_time, out=self.state['vehicle_time'])
+        np.add(self.state['delay'], vehicle_time, out=self.state['delay'])
+
+        count = np.multiply(inflow, dt, out=self.work_buffer('count', density.shape))
+        np.add(self.state['cumulative_inflow'], count, out=self.state['cumulative_inflow'])
+
+        np.multiply(outflow, dt, out=count)
+        np.add(self.state['cumulative_outflow'], count, out=self.state['cumulative_outflow'])
+
+        vehicle_distance = np.multiply(count, self.param['cell_len'], out=count)
+        np.add(self.state['vehicle_distance'], vehicle_distance, out=self.state['vehicle_distance'])
+
+        free_flow_time = np.multiply(vehicle_distance, self.param['pace'], out=vehicle_distance)
+        np.subtract(self.state['delay'], free_flow_time, out=self.state['delay'])
+
+
+    def get_summary(self):
+        # Network totals per column, (state_len, ); source queues and sink throughputs per cell, (num_cell, state_len).
+        num_source, num_sink = self.param['num_source'], self.param['num_sink']
+        num_cell = len(self.param['cell_len'])
+        return {
+            'vehicle_time': self.state['vehicle_time'].sum(axis=0),
+            'vehicle_distance': self.state['vehicle_distance'].sum(axis=0),
+            'delay': self.state['delay'].sum(axis=0),
+            'throughput': self.state['cumulative_outflow'][num_cell-num_sink:].sum(axis=0),
+            'source_queue': self.net.get_cell_value('density')[:num_source] * self.param['cell_len'][:num_source],
+            'max_source_queue': self.state['max_vehicle'][:num_source].copy(),
+            'sink_throughput': self.state['cumulative_outflow'][num_cell-num_sink:].copy(),
+        }
+
+
+
+class CumulativeCount(Metric):
+    # Newell cumulative counts (N-curves) through node boundaries, from the nodes' inter_cell_flow.
+    # boundary_list: nodes (all movements) or (node, incoming index, outgoing index) for one movement.
+    # state['count']: (num_boundary, state_len), vehicles passed since the start, plus initial_count
+    # (a scalar, (state_len, ) or (num_boundary, state_len)).
+    # recorder: optional Recorder prototype retaining the N-curves, output (num_boundary, state_len, num_step+1).
+    def __init__(self, boundary_list, initial_count=0, recorder=None):
+        super().__init__()
+
+        self.boundary_list = [b if isinstance(b, tuple) else (b, slice(None), slice(None)) for b in boundary_list]
+        self.param['initial_count'] = initial_count
+
+        self.recorder_prototype = recorder
+        self.recorder = None
+        self.output = None
+
+
+    def initialize(self, net):
+        super().initialize(net)
+
+        self.state['count'] = np.zeros((len(self.boundary_list), net.param['state_len']))
+        self.state['count'][...] = self.param['initial_count']
+
+        self.recorder, self.output = None, None
+        if self.recorder_prototype is not None:
+            self.recorder = self.recorder_prototype.new()
+            self.output = self.recorder.allocate(self.state['count'].shape, net.param['num_step']+1, 'cumulative_count')
+            self.recorder.write(0, self.state['count'])
+
+
+    def update(self, net):
+        dt = net.param['time_step_size']
+        flow = self.work_buffer('flow', (net.param['state_len'],))
+        for k, (node, i, j) in enumerate(self.boundary_list):
+            # inter_cell_flow: (state_len, num_incoming_cell, num_outgoing_cell).
+            inter_cell_flow = node.co_state['inter_cell_flow'][:, i, j]
+            np.sum(inter_cell_flow.reshape(len(flow), -1), axis=1, out=flow)
+            np.multiply(flow, dt, out=flow)
+            np.add(self.state['count'][k], flow, out=self.state['count'][k])
+
+        if self.recorder is not None:
+            self.recorder.write(net.step+1, self.state['count'])
+
+
+    def finalize(self):
+        if self.recorder is not None:
+            self.recorder.finalize()
+
+
+
+class TravelTime(Metric):
+    # Streaming FIFO travel times between an upstream and a downstream boundary (see CumulativeCount), per column.
+    # The N-curves are cut at levels count_step apart: the time the upstream curve reaches a level is kept in a
+    # ring of max_pending levels until the downstream curve reaches it, which gives one travel-time sample.
+    # Crossing times are interpolated linearly within a step.
+    # cell_list: cells between the boundaries; vehicles in them at the start have no entry time and are skipped.
+    # Samples are summarized online: count, mean, std, min, max, and a histogram over bin_edges if given.
+    def __init__(self, upstream, downstream, cell_list=None, count_step=1, bin_edges=None, max_pending=4096):
+        super().__init__()
+
+        self.param['count_step'] = count_step
+        self.param['max_pending'] = max_pending
+        self.param['bin_edges'] = None if bin_edges is None else np.asarray(bin_edges, dtype=float)
+
+        self.cell_list = [] if cell_list is None else cell_list
+        self.cumulative_count = CumulativeCount([upstream, downstream])
+
+
+    def initialize(self, net):
+        super().initialize(net)
+        state_len = net.param['state_len']
+
+        # Vehicles in the section at the start: (state_len, ).
+        initial_count = np.zeros(state_len)
+        for c in self.cell_list:
+            initial_count += np.asarray(c.state['density']) * c.param['cell_len']
+
+        self.cumulative_count.param['initial_count'] = np.stack([initial_count, np.zeros(state_len)])
+        self.cumulative_count.initialize(net)
+
+        # Next level index to be reached by each curve: (state_len, ).
+        self.state['upstream_level'] = np.floor(initial_count / self.param['count_step']).astype(int) + 1
+        self.state['downstream_level'] = np.ones(state_len, dtype=int)
+
+        # entry_time: (state_len, max_pending), indexed by level modulo max_pending, NaN if unknown.
+        self.state['entry_time'] = np.full((state_len, self.param['max_pending']), np.nan)
+
+        for name in ['num_sample', 'sum', 'sum_sq']:
+            self.state[name] = np.zeros(state_len)
+        self.state['min'] = np.full(state_len, np.inf)
+        self.state['max'] = np.full(state_len, -np.inf)
+        if self.param['bin_edges'] is not None:
+            self.state['histogram'] = np.zeros((state_len, len(self.param['bin_edges']) - 1), dtype=int)
+
+
+    def _crossing(self, level, count_previous, count, start_time, dt):
+        # Times the curves reach the levels, assuming they grow linearly during the step.
+        target = level * self.param['count_step']
+        return start_time + dt * utils.safe_div(target - count_previous, count - count_previous, fill=1)
+
+
+    def update(self, net):
+        dt = net.param['time_step_size']
+        start_time = net.step * dt
+
+        count_previous = self.work_buffer('count_previous', self.cumulative_count.state['count'].shape)
+        np.copyto(count_previous, self.cumulative_count.state['count'])
+        self.cumulative_count.update(net)
+        count = self.cumulative_count.state['count']
+
+        column = np.arange(net.param['state_len'])
+        entry_time = self.state['entry_time']
+        upstream_level, downstream_level = self.state['upstream_level'], self.state['downstream_level']
+
+        while True:
+            is_reached = upstream_level * self.param['count_step'] <= count[0]
+            if not is_reached.any():
+                break
+            if np.any(upstream_level[is_reached] - downstream_level[is_reached] >= self.param['max_pending']):
+                raise ValueError('More pending levels than max_pending, increase max_pending or count_step.')
+
+            idx = column[is_reached]
+            entry_time[idx, upstream_level[idx] % self.param['max_pending']] = self._crossing(upstream_level[idx], count_previous[0, idx], count[0, idx], start_time, dt)
+            upstream_level[idx] += 1
+
+        while True:
+            is_reached = (downstream_level * self.param['count_step'] <= count[1]) & (downstream_level < upstream_level)
+            if not is_reached.any():
+                break
+
+            idx = column[is_reached]
+            slot = downstream_level[idx] % self.param['max_pending']
+            travel_time = self._crossing(downstream_level[idx], count_previous[1, idx], count[1, idx], start_time, dt) - entry_time[idx, slot]
+            entry_time[idx, slot] = np.nan
+            downstream_level[idx] += 1
+
+            is_known = ~np.isnan(travel_time)
+            self.add_sample(idx[is_known], travel_time[is_known])
+
+
+    def add_sample(self, idx, travel_time):
+        np.add.at(self.state['num_sample'], idx, 1)
+        np.add.at(self.state['sum'], idx, travel_time)
+        np.add.at(self.state['sum_sq'], idx, travel_time**2)
+        np.minimum.at(self.state['min'], idx, travel_time)
+        np.maximum.at(self.state['max'], idx, travel_time)
+
+        if self.param['bin_edges'] is not None:
+            bin_idx = np.searchsorted(self.param['bin_edges'], travel_time, side='right') - 1
+            is_in = (bin_idx >= 0) & (bin_idx < len(self.param['bin_edges']) - 1)
+            np.add.at(self.state['histogram'], (idx[is_in], bin_idx[is_in]), 1)
+
+
+    def get_mean(self):
+        return utils.safe_div(self.state['sum'], self.state['num_sample'], fill=np.nan)
+
+
+    def get_std(self):
+        mean = self.get_mean()
+        variance = utils.safe_div(self.state['sum_sq'], self.state['num_sample'], fill=np.nan) - mean**2
+        return np.sqrt(np.maximum(variance, 0))
+
+
+
+if __name__ == '__main__':
+    pass
@@ -1,8 +1,19 @@
 import numpy as np
 import time
 
+from . import utils
+from . import parallel
+from . import steady
+from . import meanfield
+from . import vectorfield
+from . import stream
+from . import equilibrium
+from .ensemble import Ensemble
+from .engine import ArrayEngine
+from .recorder import RecorderRule
+
 class Network:
-    def __init__(self, ID, num_step, state_len, time_step_size, source_list=None, link_list=None, sink_list=None, node_list=None) -> None:
+    def __init__(self, ID, num_step, state_len, time_step_size, source_list=None, link_list=None, sink_list=None, node_list=None, dtype=np.float64) -> None:
         self.ID = ID
 
         self.step = 0
@@ -11,6 +22,12 @@ class Network:
             'num_step': num_step, 
             'state_len': state_len, 
             'time_step_size': time_step_size,
+
+            # Floating dtype of every state, co-state, parameter and output array, e.g. np.float32.
+            'dtype': np.dtype(dtype),
+
+            # Courant number of per-cell sub-cycling, None without sub-cycling, see set_sub_cycling().
+            'courant': None,
         }
 
         self.source_list = source_list if source_list is not None else []
@@ -18,6 +35,29 @@ class Network:
         self.sink_list = sink_list if sink_list is not None else []
         self.node_list = node_list if node_list is not None else []
 
+        # Compiled struct-of-arrays engine, see compile().
+        self.engine = None
+
+        # Which trajectories are recorded and how, see set_recorder().
+        self.recorder_rule = RecorderRule()
+        self.unit_name = None
+
+        # Online metrics updated every step, see add_metric().
+        self.metric_list = []
+
+        # Engine running the network, None for the object path; scratch buffers of get_cell_value().
+        self.active_engine = None
+        self.work = {}
+
+        # Shared-memory blocks behind the outputs of the last run with workers, see parallel.run().
+        self.shared_memory = []
+
+        # Steps after which each column was steady in the last run with until='steady', see steady.run().
+        self.convergence_step = None
+
+        # Mode probabilities of the Markovian flows in the last mean-field run, see meanfield.run().
+        self.mode_probability = None
+
 
     def add_cell(self, cell_type, cell):
         if cell_type == 'source':
@@ -31,6 +71,9 @@ class Network:
         for flow in cell.flow_dict.values():
             flow.hook_up_to_net(self)
 
+        self.engine = None
+        self.unit_name = None
+
 
     def add_node(self, node):
         self.node_list.append(node)
@@ -38,7 +81,116 @@ class Network:
         node.hook_up_to_net(self)
         if node.controller is not None:
             node.controller.hook_up_to_net(self)
+
+        self.engine = None
+        self.unit_name = None
+    
     
+    def add_metric(self, metric):
+        self.metric_list.append(metric)
+        return metric
+
+
+    def get_cell_list(self):
+        return self.source_list + self.link_list + self.sink_list
+
+
+    def get_cell_value(self, key):
+        # Cell state or co-state key of all cells: (num_cell, state_len), cells ordered as get_cell_list().
+        # A view of the packed array under the array engine, gathered into a reused buffer otherwise.
+        if self.active_engine is not None:
+            return getattr(self.active_engine, key)
+
+        cell_list = self.get_cell_list()
+        value = utils.work_buffer(self.work, key, (len(cell_list), self.param['state_len']), self.param['dtype'])
+        for i, c in enumerate(cell_list):
+            value[i] = c.state[key] if key in c.state else c.co_state[key]
+        return value
+
+
+    def initialize_metric(self):
+        for metric in self.metric_list:
+            metric.initialize(self)
+
+
+    def update_metric(self):
+        for metric in self.metric_list:
+            metric.update(self)
+
+
+    def finalize_metric(self):
+        for metric in self.metric_list:
+            metric.finalize()
+
+
+    def plan_time_step(self, courant=1):
+        # Largest stable time step of each cell: (num_cell, ), cells ordered as get_cell_list(), see Cell.get_max_time_step().
+        # Its minimum is the largest stable global time_step_size.
+        return np.array([c.get_max_time_step(courant) for c in self.get_cell_list()], dtype=float)
+
+
+    def get_num_sub_step(self, courant=1):
+        # Sub-steps per time step of each cell for sub-cycling: (num_cell, ), the smallest power of two that brings the
+        # cell's step within its stable step, 1 for cells stable at time_step_size.
+        ratio = self.param['time_step_size'] / self.plan_time_step(courant)
+        num_sub_step = 2 ** np.ceil(np.log2(np.maximum(ratio, 1)) - 1e-12)
+        return num_sub_step.astype(int)
+
+
+    def set_sub_cycling(self, courant=1):
+        # Multi-rate integration in the array engine: each time step, cells whose stable step (at this Courant number) is
+        # shorter than time_step_size are advanced get_num_sub_step() times with the flows recomputed in between,
+        # the other cells once. None turns sub-cycling off. Applies from the next initialize().
+        self.param['courant'] = courant
+        self.engine = None
+
+
+    def get_unit_dict(self):
+        # All units by name: cell and node IDs, '<cell ID>.<flow name>' for flows, '<node ID>.controller' for controllers.
+        # A name already taken (duplicate IDs) gets a suffix: 'node_1', 'node_1#1', ...
+        unit_list = []
+        for c in self.get_cell_list():
+            unit_list.append((c.ID, c))
+            for name, flow in c.flow_dict.items():
+                if flow is not None:
+                    unit_list.append((f'{c.ID}.{name}', flow))
+
+        for n in self.node_list:
+            unit_list.append((n.ID, n))
+            if n.controller is not None:
+                unit_list.append((f'{n.ID}.controller', n.controller))
+
+        unit_dict = {}
+        for name, unit in unit_list:
+            unique_name, k = name, 0
+            while unique_name in unit_dict:
+                k += 1
+                unique_name = f'{name}#{k}'
+            unit_dict[unique_name] = unit
+
+        return unit_dict
+
+
+    def get_unit_name(self, unit):
+        if self.unit_name is None:
+            self.unit_name = {id(u): name for name, u in self.get_unit_dict().items()}
+        return self.unit_name[id(unit)]
+
+
+    def set_recorder(self, pattern_dict=None, default=None):
+        # pattern_dict: {glob pattern on '<unit name>:<key>': recorder prototype or None}, first match wins.
+        # Unmatched trajectories use default, a FullRecorder if not given. Applies from the next initialize().
+        self.recorder_rule = RecorderRule(pattern_dict, default)
+
+
+    def match_recorder(self, unit, key):
+        return self.recorder_rule.match(self.get_unit_name(unit), key)
+
+
+    def make_recorder(self, unit, key):
+        prototype = self.match_recorder(unit, key)
+        return None if prototype is None else prototype.new()
+
     
     def initialize_cell(self):
         for c_list in (self.source_list, self.link_list, self.sink_list):
@@ -116,7 +268,7 @@ class Network:
             n.save_output()
     
 
-    def run_one_step(self):
+    def update_cell_flow(self):
         # Step 1: update boundary inflow and outflows.
         self.update_boundary_inflow()
         self.update_boundary_outflow()
@@ -135,6 +287,14 @@ class Network:
         self.update_cell_outflow()
         self.update_cell_inflow()
 
+
+    def run_one_step(self):
+        # Steps 1 to 5.
+        self.update_cell_flow()
+
+        # Update online metrics with this step's densities and flows.
+        self.update_metric()
+
         # Step 6: update cell speed and density. 
         self.update_cell_speed()
         self.update_cell_density()
@@ -147,18 +307,116 @@ class Network:
 
 
     def initialize(self):
+        self.active_engine = None
         self.initialize_cell()
         self.initialize_node()
+        self.initialize_metric()
         self.step = 0
 
 
-    def run(self):
+    def finalize_output(self):
+        for unit in self.get_unit_dict().values():
+            unit.finalize_output()
+
+        self.finalize_metric()
+
+
+    def compile(self, backend='numpy'):
+        # Pack the network into a struct-of-arrays engine. Adding cells or nodes afterwards discards it.
+        # backend: 'numpy' or 'numba' (compiled kernels when Numba is installed), see ArrayEngine.
+        self.engine = ArrayEngine(self, backend)
+        return self.engine
+
+
+    def run_ensemble(self, field_list, num_replica, batch_size=64, seed=None, half_width=None, min_replica=10, quantile_list=(), confidence=0.95,
+                     sampling='random', reference=None, engine='object', backend='numpy'):
+        # Monte Carlo ensemble of the stochastic units: statistics of the fields over replicas, per record, without
+        # storing trajectories; stops early once every confidence half-width is at most half_width, see Ensemble.
+        # sampling: 'random', 'antithetic' or 'sobol'; reference: a network compared with common random numbers.
+        start_time = time.time()
+
+        ensemble = Ensemble(self, field_list, quantile_list, confidence, sampling, reference)
+        ensemble.run(num_replica, batch_size, seed, half_width, min_replica, engine, backend)
+
+        end_time = time.time()
+
+        print(f'time cost: {end_time-start_time:.1f} seconds, {ensemble.state["num_replica"]} replicas.')
+        return ensemble
+
+
+    def vector_field(self, density_by_cell, chunk_size=65536, column=0, step=0, engine='array', backend='numpy'):
+        # d(density)/dt of every cell at a batch of densities, (num_cell, ...) ordered as get_cell_list() or {cell ID: (...)};
+        # the network is left as it is, see vectorfield.evaluate().
+        return vectorfield.evaluate(self, density_by_cell, chunk_size, column, step, engine, backend)
+
+
+    def run_stream(self, initial_condition_iter, chunk_size, consumer=None, field_list=('*:density', ), until=None, tol=1e-6, column=0, engine='array', backend='numpy',
+                   cell_id_list=None, num_steady_step=10):
+        # Run chunks of initial conditions or per-column parameters through one network of state_len chunk_size, built
+        # and compiled once; each chunk's final states, metrics and convergence steps go to consumer, see stream.run().
+        start_time = time.time()
+
+        result = stream.run(self, initial_condition_iter, chunk_size, consumer, field_list, until, tol, column, engine, backend, cell_id_list, num_steady_step)
+
+        end_time = time.time()
+
+        print(f'time cost: {end_time-start_time:.1f} seconds.')
+        return result
+
+
+    def find_equilibrium(self, cell_id_list=None, lower=None, upper=None, num_start=64, max_iter=50, tol=1e-9, seed=None, step=0, engine='array', backend='numpy'):
+        # Equilibria of the densities of the cells in every column, with their stability, by a regime search from
+        # num_start starts in [lower, upper] instead of a run to steady state, see equilibrium.solve().
+        return equilibrium.solve(self, cell_id_list, lower, upper, num_start, max_iter, tol, seed=seed, step=step, engine=engine, backend=backend)
+
+
+    def run_mean_field(self, engine='object', backend='numpy'):
+        # Deterministic pass propagating the distribution of the Markovian modes and the conditional mean states instead
+        # of sampling: outputs are mean trajectories, mode_probability the mode occupancy, see meanfield.run().
+        start_time = time.time()
+
+        meanfield.run(self, engine, backend)
+
+        end_time = time.time()
+
+        print(f'time cost: {end_time-start_time:.1f} seconds.')
+
+
+    def run(self, engine='object', workers=None, backend='numpy', until=None, tol=1e-6):
+        # workers: number of processes the state_len columns are split over, see parallel.run(); one process if None.
+        # backend: kernels of the array engine, see compile().
+        # until: None for all num_step steps, or 'steady' to stop each column once its densities change by at most tol
+        # in a step for several steps in a row (and the run once all have); time-invariant inputs only, see steady.run().
         start_time = time.time()
 
-        self.initialize()
+        if engine not in ('object', 'array'):
+            raise ValueError(f'Unknown engine: {engine}.')
+        if until not in (None, 'steady'):
+            raise ValueError(f'Unknown until: {until}.')
+        if engine == 'object' and self.param['courant'] is not None:
+            raise ValueError('Sub-cycling runs on the array engine.')
+
+        if until == 'steady':
+            if workers is not None and workers > 1:
+                raise ValueError('until=\'steady\' runs in one process.')
+            steady.run(self, tol, engine, backend)
+
+        elif workers is not None and workers > 1:
+            parallel.run(self, workers, engine, backend)
+
+        elif engine == 'object':
+            self.initialize()
+
+            for _ in range(self.param['num_step']):
+                self.run_one_step()
+
+            self.finalize_output()
+
+        elif engine == 'array':
+            if self.engine is None or self.engine.param['backend'] != backend:
+                self.compile(backend)
 
-        for _ in range(self.param['num_step']):
-            self.run_one_step()
+            self.engine.run()
         
         end_time = time.time()
 
@@ -41,7 +41,7 @@ class Node(utils.NetUnit):
 
 
     def initialize_co_state(self):
-        self.co_state['inter_cell_flow'] = np.zeros([self.net.param['state_len'], self.param['num_incoming_cell'], self.param['num_outgoing_cell']])
+        self.co_state['inter_cell_flow'] = np.zeros([self.net.param['state_len'], self.param['num_incoming_cell'], self.param['num_outgoing_cell']], dtype=self.net.param['dtype'])
 
 
     def initialize_controller(self):
@@ -62,32 +62,44 @@ class Node(utils.NetUnit):
             self.controller.iterate()
 
 
-    def compute_inter_cell_flow(self, state_len, sending_list, receiving_list):
+    def _empty_inter_cell_flow(self, state_len, sending_list, receiving_list, out=None):
+        # inter_cell_flow: (state_len, num_incoming_cell, num_outgoing_cell), zero unless set by the junction rule.
+        if out is None:
+            return np.zeros([state_len, len(sending_list), len(receiving_list)], dtype=self.net.param['dtype'])
+        return out
+
+
+    def _work_buffer(self, name, inter_cell_flow, dtype=None):
+        # Scratch array with the shape of one movement, (state_len, ).
+        return self.work_buffer(name, inter_cell_flow.shape[:1], dtype)
+
+
+    def compute_inter_cell_flow(self, state_len, sending_list, receiving_list, out=None):
         # Need customization. 
-        return np.zeros([state_len, len(sending_list), len(receiving_list)])
+        if out is None:
+            return np.zeros([state_len, len(sending_list), len(receiving_list)], dtype=self.net.param['dtype'])
+        out.fill(0)
+        return out
     
 
-    def _compute_inter_cell_flow(self):
+    def _compute_inter_cell_flow(self, out=None):
         # Need customization. 
-        return self.compute_inter_cell_flow(self.net.param['state_len'], self._sending_list(), self._receiving_list())
+        return self.compute_inter_cell_flow(self.net.param['state_len'], self._sending_list(), self._receiving_list(), out=out)
 
 
     def update_inter_cell_flow(self):
-        self.co_state['inter_cell_flow'] = self._compute_inter_cell_flow()
+        # Inter-cell flows are written in place into the co-state buffer allocated at initialize().
+        self._compute_inter_cell_flow(out=self.co_state['inter_cell_flow'])
 
 
     def update_cell_outflow(self):
-        incoming_cell_outflow = np.sum(self.co_state['inter_cell_flow'], axis=2).T
-
-        for cell, flow in zip(self.incoming_cell_list, incoming_cell_outflow):
-            cell.co_state['outflow'] = flow
+        for i, cell in enumerate(self.incoming_cell_list):
+            np.sum(self.co_state['inter_cell_flow'][:, i, :], axis=1, out=cell.co_state['outflow'])
 
 
     def update_cell_inflow(self):
-        outgoing_cell_inflow = np.sum(self.co_state['inter_cell_flow'], axis=1).T
-
-        for cell, flow in zip(self.outgoing_cell_list, outgoing_cell_inflow):
-            cell.co_state['inflow'] = flow
+        for j, cell in enumerate(self.outgoing_cell_list):
+            np.sum(self.co_state['inter_cell_flow'][:, :, j], axis=1, out=cell.co_state['inflow'])
 
     
     def save_output(self):
@@ -105,9 +117,9 @@ class BasicJunction(Node):
         super().__init__(ID, incoming_cell_list, outgoing_cell_list, controller, net, is_state_saved, is_co_state_saved)
 
 
-    def compute_inter_cell_flow(self, state_len, sending_list, receiving_list):
-        inter_cell_flow = np.zeros([state_len, len(sending_list), len(receiving_list)])
-        inter_cell_flow[:, 0, 0] = np.minimum(sending_list[0], receiving_list[0])
+    def compute_inter_cell_flow(self, state_len, sending_list, receiving_list, out=None):
+        inter_cell_flow = self._empty_inter_cell_flow(state_len, sending_list, receiving_list, out)
+        np.minimum(sending_list[0], receiving_list[0], out=inter_cell_flow[:, 0, 0])
         return inter_cell_flow
     
 
@@ -125,19 +137,23 @@ class TwoToOneMergeJunction(Node):
         return self.param['merging_priority'][:, 0], self.param['merging_priority'][:, 1] 
 
 
-    def compute_inter_cell_flow(self, state_len, sending_list, receiving_list):
+    def compute_inter_cell_flow(self, state_len, sending_list, receiving_list, out=None):
         sending_i_0, sending_i_1 = sending_list
         receiving_j_0 = receiving_list[0]
 
         p_i_0, p_i_1 = self._merging_priority() 
 
-        is_space_enough = (sending_i_0 + sending_i_1) <= receiving_j_0
-        flow_i_0_j_0 = np.where(is_space_enough, sending_i_0, np.median([sending_i_0, receiving_j_0 - sending_i_1, p_i_0 * receiving_j_0], axis=0))
-        flow_i_1_j_0 = np.where(is_space_enough, sending_i_1, np.median([sending_i_1, receiving_j_0 - sending_i_0, p_i_1 * receiving_j_0], axis=0))
+        inter_cell_flow = self._empty_inter_cell_flow(state_len, sending_list, receiving_list, out)
+        flow_i_0_j_0, flow_i_1_j_0 = inter_cell_flow[:, 0, 0], inter_cell_flow[:, 1, 0]
+        work_0, work_1, work_2 = (self._work_buffer(f'work_{k}', inter_cell_flow) for k in range(3))
 
-        inter_cell_flow = np.zeros([state_len, len(sending_list), len(receiving_list)])
-        inter_cell_flow[:, 0, 0] = flow_i_0_j_0
-        inter_cell_flow[:, 1, 0] = flow_i_1_j_0
+        is_space_enough = np.less_equal(np.add(sending_i_0, sending_i_1, out=work_0), receiving_j_0, out=self._work_buffer('is_space_enough', inter_cell_flow, bool))
+
+        utils.median_of_three(sending_i_0, np.subtract(receiving_j_0, sending_i_1, out=work_0), np.multiply(p_i_0, receiving_j_0, out=work_1), out=flow_i_0_j_0, work=work_2)
+        np.copyto(flow_i_0_j_0, sending_i_0, where=is_space_enough)
+
+        utils.median_of_three(sending_i_1, np.subtract(receiving_j_0, sending_i_0, out=work_0), np.multiply(p_i_1, receiving_j_0, out=work_1), out=flow_i_1_j_0, work=work_2)
+        np.copyto(flow_i_1_j_0, sending_i_1, where=is_space_enough)
 
         return inter_cell_flow
 
@@ -165,29 +181,32 @@ class OneToTwoDivergeJunction(Node):
         return split_j_0, split_j_1
 
 
-    def compute_inter_cell_flow(self, state_len, sending_list, receiving_list, step=None):
+    def compute_inter_cell_flow(self, state_len, sending_list, receiving_list, step=None, out=None):
         sending_i_0  = sending_list[0]
         receiving_j_0, receiving_j_1 = receiving_list
 
         split_j_0, split_j_1 = self._split_ratio(step)
 
+        inter_cell_flow = self._empty_inter_cell_flow(state_len, sending_list, receiving_list, out)
+        flow_i_0_j_0, flow_i_0_j_1 = inter_cell_flow[:, 0, 0], inter_cell_flow[:, 0, 1]
+
         if not self.param['is_FIFO']:
-            flow_i_0_j_0 = np.minimum(split_j_0 * sending_i_0, receiving_j_0)
-            flow_i_0_j_1 = np.minimum(split_j_1 * sending_i_0, receiving_j_1)
+            np.minimum(np.multiply(split_j_0, sending_i_0, out=flow_i_0_j_0), receiving_j_0, out=flow_i_0_j_0)
+            np.minimum(np.multiply(split_j_1, sending_i_0, out=flow_i_0_j_1), receiving_j_1, out=flow_i_0_j_1)
         else:
-            total_flow = np.minimum.reduce((sending_i_0, utils.safe_div(receiving_j_0, split_j_0), utils.safe_div(receiving_j_1, split_j_1)))
-            flow_i_0_j_0 = split_j_0 * total_flow
-            flow_i_0_j_1 = split_j_1 * total_flow
+            total_flow, work = self._work_buffer('total_flow', inter_cell_flow), self._work_buffer('work', inter_cell_flow)
+            is_split = self._work_buffer('is_split', inter_cell_flow, bool)
 
-        inter_cell_flow = np.zeros([state_len, len(sending_list), len(receiving_list)])
-        inter_cell_flow[:, 0, 0] = flow_i_0_j_0
-        inter_cell_flow[:, 0, 1] = flow_i_0_j_1
+            np.minimum(sending_i_0, utils.safe_div(receiving_j_0, split_j_0, out=work, mask=is_split), out=total_flow)
+            np.minimum(total_flow, utils.safe_div(receiving_j_1, split_j_1, out=work, mask=is_split), out=total_flow)
+            np.multiply(split_j_0, total_flow, out=flow_i_0_j_0)
+            np.multiply(split_j_1, total_flow, out=flow_i_0_j_1)
 
         return inter_cell_flow
 
 
-    def _compute_inter_cell_flow(self):
-        return self.compute_inter_cell_flow(self.net.param['state_len'], self._sending_list(), self._receiving_list(), self.net.step)
+    def _compute_inter_cell_flow(self, out=None):
+        return self.compute_inter_cell_flow(self.net.param['state_len'], self._sending_list(), self._receiving_list(), self.net.step, out=out)
 
 
 
@@ -198,23 +217,24 @@ class RoutedDivergeJunction(Node):
         super().__init__(ID, incoming_cell_list, outgoing_cell_list, controller, net, is_state_saved, is_co_state_saved)
 
 
-    def compute_inter_cell_flow(self, state_len, sending_list, receiving_list, control_input):
+    def compute_inter_cell_flow(self, state_len, sending_list, receiving_list, control_input, out=None):
         sending_i_0 = sending_list[0]
 
-        inter_cell_flow = np.zeros([state_len, len(sending_list), len(receiving_list)])
+        inter_cell_flow = self._empty_inter_cell_flow(state_len, sending_list, receiving_list, out)
         for j in range(len(receiving_list)):
-            inter_cell_flow[:, 0, j] = np.minimum(sending_i_0 * control_input[:, j], receiving_list[j])
+            flow_i_0_j = inter_cell_flow[:, 0, j]
+            np.minimum(np.multiply(sending_i_0, control_input[:, j], out=flow_i_0_j), receiving_list[j], out=flow_i_0_j)
 
         return inter_cell_flow
         
 
-    def _compute_inter_cell_flow(self):
+    def _compute_inter_cell_flow(self, out=None):
         if self.controller is not None:
             control_input = self.controller.get_control_input()
         else:
             control_input = None
 
-        return self.compute_inter_cell_flow(self.net.param['state_len'], self._sending_list(), self._receiving_list(), control_input)
+        return self.compute_inter_cell_flow(self.net.param['state_len'], self._sending_list(), self._receiving_list(), control_input, out=out)
 
 
 
@@ -248,45 +268,50 @@ class FreewayRampJunction(Node):
         return split_to_mainline, split_to_offramp
 
 
-    def compute_inter_cell_flow(self, state_len, sending_list, receiving_list, step=None, control_input=None):
+    def compute_inter_cell_flow(self, state_len, sending_list, receiving_list, step=None, control_input=None, out=None):
         sending_mainline, sending_onramp = sending_list
         receiving_mainline, receiving_offramp = receiving_list
 
         p_onramp = self._onramp_priority()
         split_to_mainline, split_to_offramp = self._split_ratio(step)
 
+        inter_cell_flow = self._empty_inter_cell_flow(state_len, sending_list, receiving_list, out)
+        flow_mainline_to_mainline, flow_mainline_to_offramp = inter_cell_flow[:, 0, 0], inter_cell_flow[:, 0, 1]
+        flow_onramp_to_mainline = inter_cell_flow[:, 1, 0]
+
+        work_0, work_1 = self._work_buffer('work_0', inter_cell_flow), self._work_buffer('work_1', inter_cell_flow)
+        mask = self._work_buffer('mask', inter_cell_flow, bool)
+
         # Compute flow from onramp to mainline.
-        if control_input is None:
-            flow_onramp_to_mainline = np.minimum(sending_onramp, receiving_mainline)
-        else:
-            flow_onramp_to_mainline = np.minimum.reduce((sending_onramp, receiving_mainline, control_input))
+        np.minimum(sending_onramp, receiving_mainline, out=flow_onramp_to_mainline)
+        if control_input is not None:
+            np.minimum(flow_onramp_to_mainline, control_input, out=flow_onramp_to_mainline)
 
         # Compute flow from mainline to mainline.
-        sending_mainline_to_mainline = split_to_mainline * np.minimum(sending_mainline, utils.safe_div(receiving_offramp, split_to_offramp))
-        flow_mainline_to_mainline = np.minimum(sending_mainline_to_mainline, receiving_mainline - p_onramp * flow_onramp_to_mainline)
+        sending_mainline_to_mainline = utils.safe_div(receiving_offramp, split_to_offramp, out=work_0, mask=mask)
+        np.minimum(sending_mainline, sending_mainline_to_mainline, out=sending_mainline_to_mainline)
+        np.multiply(split_to_mainline, sending_mainline_to_mainline, out=sending_mainline_to_mainline)
+        np.minimum(sending_mainline_to_mainline, np.subtract(receiving_mainline, np.multiply(p_onramp, flow_onramp_to_mainline, out=work_1), out=work_1), out=flow_mainline_to_mainline)
 
         # Compute flow from mainline to off-ramp. 
-        flow_mainline_to_offramp  = np.where(
-            split_to_mainline != 0, 
-            flow_mainline_to_mainline * utils.safe_div(split_to_offramp, split_to_mainline), 
-            np.minimum(sending_mainline, receiving_offramp), 
-        )
+        np.minimum(sending_mainline, receiving_offramp, out=flow_mainline_to_offramp)
+        offramp_to_mainline_ratio = utils.safe_div(split_to_offramp, split_to_mainline, out=work_0, mask=mask)
+        np.multiply(flow_mainline_to_mainline, offramp_to_mainline_ratio, out=offramp_to_mainline_ratio)
+        np.copyto(flow_mainline_to_offramp, offramp_to_mainline_ratio, where=np.not_equal(split_to_mainline, 0, out=mask))
 
-        inter_cell_flow = np.zeros([state_len, len(sending_list), len(receiving_list)])
-        inter_cell_flow[:, 0, 0] = flow_mainline_to_mainline
-        inter_cell_flow[:, 0, 1] = flow_mainline_to_offramp
-        inter_cell_flow[:, 1, 0] = flow_onramp_to_mainline
+        # No flow from onramp to off-ramp.
+        inter_cell_flow[:, 1, 1] = 0
 
         return inter_cell_flow
 
 
-    def _compute_inter_cell_flow(self):
+    def _compute_inter_cell_flow(self, out=None):
         if self.controller is not None:
             control_input = self.controller.get_control_input()
         else:
             control_input = None
 
-        return self.compute_inter_cell_flow(self.net.param['state_len'], self._sending_list(), self._receiving_list(), self.net.step, control_input)
+        return self.compute_inter_cell_flow(self.net.param['state_len'], self._sending_list(), self._receiving_list(), self.net.step, control_input, out=out)
 
 
 
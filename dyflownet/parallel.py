@@ -0,0 +1,295 @@
+import gc
+import glob
+import importlib
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+from . import utils
+from .recorder import AsyncRecorder, FullRecorder, MemmapRecorder
+
+
+# Process-pool execution sharding the state_len (batch) axis: each worker rebuilds a shard of the network from a spec,
+# plain data with the columns of that shard, runs it and records its trajectories straight into its rows of the
+# parent's outputs, which are allocated in shared memory (or are the MemmapRecorder files), so no copy is made. Columns are independent, so the result equals a one-process run;
+# stochastic units (Markovian flows) draw from a separate random stream in each worker, derived from their seed.
+
+# Unit attributes rebuilt by the unit itself or by the run, not part of a spec.
+_RUNTIME_ATTR = {'net', 'state', 'co_state', 'state_output', 'co_state_output', 'state_recorder', 'co_state_recorder', 'param_source', 'param_cast', 'work',
+                 'rng', 'uniform', 'uniform_row'}
+
+
+def get_spec(net):
+    # Plain-data description of a network: network param, and per unit its class, plain attributes (ID, param,
+    # initial_condition, ...) and references to other units as indices in spec['unit'].
+    # Parameters are taken as given by the user (before the dtype cast of initialize_param()).
+    unit_list = list(net.get_unit_dict().values())
+    index = {id(u): i for i, u in enumerate(unit_list)}
+
+    def encode(value):
+        if isinstance(value, utils.NetUnit):
+            return ('unit', index[id(value)])
+        if isinstance(value, list) and len(value) > 0 and all(isinstance(v, utils.NetUnit) for v in value):
+            return ('unit_list', [index[id(v)] for v in value])
+        if isinstance(value, dict) and len(value) > 0 and all(v is None or isinstance(v, utils.NetUnit) for v in value.values()):
+            return ('unit_dict', {k: None if v is None else index[id(v)] for k, v in value.items()})
+        return None
+
+    spec_unit_list = []
+    for u in unit_list:
+        attr, ref = {}, {}
+        for k, v in vars(u).items():
+            if k in _RUNTIME_ATTR:
+                continue
+            encoded = encode(v)
+            if encoded is not None:
+                ref[k] = encoded
+            else:
+                attr[k] = v
+        attr['param'] = {**u.param, **{k: v for k, v in u.param_source.items() if u.param_cast.get(k) is u.param[k]}}
+
+        spec_unit_list.append({'type': f'{type(u).__module__}.{type(u).__qualname__}', 'attr': attr, 'ref': ref})
+
+    return {
+        'ID': net.ID,
+        'param': dict(net.param),
+        'unit': spec_unit_list,
+        'source': [index[id(c)] for c in net.source_list],
+        'link': [index[id(c)] for c in net.link_list],
+        'sink': [index[id(c)] for c in net.sink_list],
+        'node': [index[id(n)] for n in net.node_list],
+    }
+
+
+def _take_column(value, state_len, column, shared_key_list=(), is_single_kept=True):
+    # Arrays whose first axis is the batch axis (length state_len) are cut to the shard; (1, ...) arrays broadcast
+    # and are kept as they are unless is_single_kept is False (initial conditions, which must have state_len rows).
+    if isinstance(value, dict):
+        return {k: value[k] if k in shared_key_list else _take_column(value[k], state_len, column, is_single_kept=is_single_kept) for k in value}
+    if isinstance(value, np.ndarray) and value.ndim > 0 and value.shape[0] == state_len and (state_len > 1 or not is_single_kept):
+        return value[column].copy()
+    return value
+
+
+def get_shard_spec(spec, column, stream=()):
+    # The spec of the given columns, a slice or an index array; an index array may repeat columns (see ensemble).
+    # stream: ints appended to the seed of seeded units, so that shards built from one spec draw different numbers.
+    state_len = spec['param']['state_len']
+
+    shard_unit_list = []
+    for u in spec['unit']:
+        cls = _import(u['type'])
+        attr = dict(u['attr'])
+        attr['param'] = _take_column(attr['param'], state_len, column, cls.shared_param_list)
+        attr['initial_condition'] = _take_column(attr.get('initial_condition', {}), state_len, column, is_single_kept=False)
+        if stream and attr['param'].get('seed') is not None:
+            attr['param'] = {**attr['param'], 'seed': [*np.atleast_1d(attr['param']['seed']).tolist(), *stream]}
+        shard_unit_list.append({**u, 'attr': attr})
+
+    return {**spec, 'param': {**spec['param'], 'state_len': len(np.arange(state_len)[column])}, 'unit': shard_unit_list}
+
+
+def _import(path):
+    module, name = path.rsplit('.', 1)
+    return getattr(importlib.import_module(module), name)
+
+
+def from_spec(spec):
+    from .net import Network
+
+    unit_list = []
+    for u in spec['unit']:
+        cls = _import(u['type'])
+        unit = cls.__new__(cls)
+        utils.NetUnit.__init__(unit)
+        for k, v in u['attr'].items():
+            setattr(unit, k, v)
+        unit_list.append(unit)
+
+    for unit, u in zip(unit_list, spec['unit']):
+        for k, (kind, value) in u['ref'].items():
+            if kind == 'unit':
+                setattr(unit, k, unit_list[value])
+            elif kind == 'unit_list':
+                setattr(unit, k, [unit_list[i] for i in value])
+            else:
+                setattr(unit, k, {name: None if i is None else unit_list[i] for name, i in value.items()})
+
+    param = spec['param']
+    net = Network(spec['ID'], param['num_step'], param['state_len'], param['time_step_size'], dtype=param['dtype'])
+    net.param.update(param)
+    for cell_type in ['source', 'link', 'sink']:
+        for i in spec[cell_type]:
+            net.add_cell(cell_type, unit_list[i])
+    for i in spec['node']:
+        net.add_node(unit_list[i])
+
+    return net
+
+
+def get_recorder_list(net):
+    # (unit name, 'state' or 'co_state', key, recorder) of every recorded trajectory.
+    recorder_list = []
+    for name, unit in net.get_unit_dict().items():
+        for kind, recorder_dict in [('state', unit.state_recorder), ('co_state', unit.co_state_recorder)]:
+            for k, recorder in recorder_dict.items():
+                recorder_list.append((name, kind, k, recorder))
+    return recorder_list
+
+
+def _open_target(target):
+    # The full output array described by target, and the handle keeping it open.
+    if target[0] == 'shared_memory':
+        _, shm_name, shape, dtype = target
+        shm = shared_memory.SharedMemory(name=shm_name)
+        return np.ndarray(shape, dtype=dtype, buffer=shm.buf), shm
+
+    file = np.load(target[1], mmap_mode='r+')
+    return np.moveaxis(file, 0, -1), file
+
+
+def _close_target(handle):
+    if isinstance(handle, shared_memory.SharedMemory):
+        handle.close()
+    else:
+        handle.flush()
+
+
+
+class _SharedMemoryBuffer:
+    # Recorder buffer of the parent: every output in a new shared memory block, filled with NaN.
+    def __init__(self):
+        # shm_dict: {id(output): its block}.
+        self.shm_dict = {}
+
+
+    def __call__(self, shape, dtype):
+        shm = shared_memory.SharedMemory(create=True, size=max(int(np.prod(shape)) * np.dtype(dtype).itemsize, 1))
+        output = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+        output[...] = np.nan
+        self.shm_dict[id(output)] = shm
+        return output
+
+
+
+class _ShardBuffer:
+    # Recorder buffer of a worker: the rows start:stop of the parent's output described by target.
+    def __init__(self, target, start, stop):
+        self.target = target
+        self.start, self.stop = start, stop
+        self.handle = None
+
+
+    def __call__(self, shape, dtype):
+        array, self.handle = _open_target(self.target)
+        view = array[self.start:self.stop]
+        if view.shape != tuple(shape) or view.dtype != dtype:
+            raise ValueError(f'Shard output {tuple(shape)} {dtype} does not match the parent\'s {view.shape} {view.dtype}.')
+        return view
+
+
+    def close(self):
+        if self.handle is not None:
+            _close_target(self.handle)
+            self.handle = None
+
+
+
+def _run_shard(spec, output_list, start, stop, engine, backend):
+    # Worker: run columns start:stop, every trajectory recorded straight into its rows of the parent's output.
+    net = from_spec(get_shard_spec(spec, slice(start, stop), (start, )))
+
+    buffer_list = []
+    for _, _, _, prototype, target in output_list:
+        prototype.buffer = _ShardBuffer(target, start, stop)
+        buffer_list.append(prototype.buffer)
+
+    net.set_recorder({glob.escape(f'{name}:{k}'): prototype for name, _, k, prototype, _ in output_list}, default=None)
+    net.run(engine=engine, backend=backend)
+
+    # Final states and co-states of the shard, batch axis first.
+    result = {name: ({k: np.array(v) for k, v in u.state.items()}, {k: np.array(v) for k, v in u.co_state.items()}) for name, u in net.get_unit_dict().items()}
+
+    # The views of the outputs go before their shared memory is closed.
+    del net
+    gc.collect()
+    for buffer in buffer_list:
+        buffer.close()
+    return result
+
+
+def _get_shared_prototype(prototype, buffer):
+    # A copy of prototype allocating in buffer, the recorder wrapped by an AsyncRecorder; MemmapRecorder files are
+    # shared already.
+    if prototype is None:
+        return None
+
+    base = prototype.recorder if isinstance(prototype, AsyncRecorder) else prototype
+    if isinstance(base, MemmapRecorder):
+        return prototype
+
+    shared = prototype.new()
+    (shared.recorder if isinstance(shared, AsyncRecorder) else shared).buffer = buffer
+    return shared
+
+
+def run(net, workers, engine='object', backend='numpy'):
+    # Run net over workers processes, columns split into contiguous shards; outputs are left in net as for net.run().
+    if net.metric_list:
+        raise ValueError('Metrics are not supported with workers, run without workers.')
+
+    state_len = net.param['state_len']
+    bound = np.linspace(0, state_len, min(workers, state_len) + 1).astype(int)
+
+    # Outputs are allocated in shared memory (or in the MemmapRecorder files), and the initial records written, here
+    # by the recorders of the network's rule; workers record into their rows of them.
+    rule, buffer = net.recorder_rule, _SharedMemoryBuffer()
+    net.set_recorder({pattern: _get_shared_prototype(p, buffer) for pattern, p in rule.pattern_dict.items()}, _get_shared_prototype(rule.default, buffer))
+    try:
+        net.initialize()
+    finally:
+        net.recorder_rule = rule
+    net.shared_memory = list(buffer.shm_dict.values())
+    spec = get_spec(net)
+
+    output_list = []
+    for name, kind, k, recorder in get_recorder_list(net):
+        base = recorder.recorder if isinstance(recorder, AsyncRecorder) else recorder
+
+        if isinstance(base, MemmapRecorder):
+            base.file.flush()
+            target, prototype = ('file', base.get_path()), FullRecorder()
+        else:
+            target, prototype = ('shared_memory', buffer.shm_dict[id(base.output)].name, base.output.shape, base.output.dtype), base.new()
+            prototype.buffer = None
+
+        output_list.append((name, kind, k, prototype, target))
+
+    try:
+        with ProcessPoolExecutor(len(bound) - 1) as executor:
+            future_list = [executor.submit(_run_shard, spec, output_list, start, stop, engine, backend) for start, stop in zip(bound[:-1], bound[1:])]
+            result_list = [future.result() for future in future_list]
+    finally:
+        # The name goes away, the parent keeps its mapping as long as the arrays are referenced.
+        for shm in net.shared_memory:
+            shm.unlink()
+
+    # Workers already finalized (e.g. rotated ring buffers) their rows.
+    for name, kind, k, recorder in get_recorder_list(net):
+        base = recorder.recorder if isinstance(recorder, AsyncRecorder) else recorder
+        base.param['last_index'] = recorder.param['last_index'] = recorder.param['num_record'] - 1
+
+    unit_dict = net.get_unit_dict()
+    for (start, stop), result in zip(zip(bound[:-1], bound[1:]), result_list):
+        for name, (state, co_state) in result.items():
+            unit = unit_dict[name]
+            for target, value in [(unit.state, state), (unit.co_state, co_state)]:
+                for k, v in value.items():
+                    if np.shape(target.get(k))[:1] == (state_len,):
+                        target[k][start:stop] = v
+
+    net.step = net.param['num_step']
+
+
+if __name__ == '__main__':
+    pass
@@ -0,0 +1,389 @@
+import copy
+import fnmatch
+import os
+import queue
+import threading
+import numpy as np
+
+
+# A recorder stores the trajectory of one state (or co-state) array, or of a packed block of them in the array engine.
+# Trajectories keep the layout of NetUnit outputs: value shape + (num_record, ), time last.
+# Record index k is the value after step k-1 for states (k = 0 is the initial condition) and at step k for co-states.
+
+class Recorder:
+    def __init__(self):
+        self.output = None
+        self.param = {}
+
+        # buffer: optional callable (shape, dtype) -> array the output is allocated in, e.g. shared memory or a view of
+        # it (see parallel.run), initialized by the buffer; None allocates in process memory, filled with NaN.
+        self.buffer = None
+
+
+    def new(self):
+        # A fresh, unallocated recorder with the same settings. Network rules hold prototypes, one recorder per trajectory.
+        recorder = copy.copy(self)
+        recorder.param = dict(self.param)
+        recorder.output = None
+        return recorder
+
+
+    def allocate(self, shape, num_record, name=None, dtype=float):
+        # Returns the array exposed as state_output / co_state_output. name identifies the trajectory, '<unit>:<key>'.
+        self.param['num_record'] = num_record
+        self.param['last_index'] = -1
+        self.param['name'] = name
+        # Outputs are floating so that unrecorded entries can be NaN; integer states (e.g. modes) are saved as float64.
+        self.param['dtype'] = np.dtype(dtype) if np.issubdtype(dtype, np.floating) else np.dtype(float)
+        self.output = self._allocate(shape, num_record)
+        return self.output
+
+
+    def _allocate(self, shape, num_record):
+        if self.buffer is not None:
+            return self.buffer(tuple(shape) + (num_record,), self.param['dtype'])
+        return np.full(tuple(shape) + (num_record,), np.nan, dtype=self.param['dtype'])
+
+
+    def is_unit_layout(self):
+        # Whether the trajectory is recorded per unit, with the unit's own shape, also by the array engine (which
+        # otherwise packs the trajectories of units sharing a prototype into one block); true for given buffers.
+        return self.buffer is not None
+
+
+    def write(self, index, value):
+        self.param['last_index'] = index
+
+
+    def write_block(self, start, block):
+        # block: value shape + (num_index, ), records start, start+1, ...
+        for i in range(block.shape[-1]):
+            self.write(start + i, block[..., i])
+
+
+    def finalize(self):
+        # Called once at the end of a run, the output is in chronological order afterwards.
+        pass
+
+
+    def get_time_index(self):
+        # Record indices of the columns of output.
+        return np.arange(self.param['num_record'])
+
+
+
+class FullRecorder(Recorder):
+    # Every record kept in memory, the original behaviour.
+    def write(self, index, value):
+        self.output[..., index] = value
+        self.param['last_index'] = index
+
+
+    def write_block(self, start, block):
+        self.output[..., start:start+block.shape[-1]] = block
+        self.param['last_index'] = start + block.shape[-1] - 1
+
+
+
+class RingRecorder(Recorder):
+    # Keep the last num_kept records only, in a ring buffer rotated into chronological order by finalize().
+    def __init__(self, num_kept):
+        super().__init__()
+
+        if num_kept < 1:
+            raise ValueError('num_kept must be positive.')
+        self.param['num_kept'] = num_kept
+
+
+    def _allocate(self, shape, num_record):
+        return super()._allocate(shape, min(self.param['num_kept'], num_record))
+
+
+    def write(self, index, value):
+        self.output[..., index % self.output.shape[-1]] = value
+        self.param['last_index'] = index
+
+
+    def finalize(self):
+        num_slot = self.output.shape[-1]
+        num_written = self.param['last_index'] + 1
+        if num_written > num_slot:
+            self.output[...] = np.roll(self.output, -(num_written % num_slot), axis=-1)
+
+
+    def get_time_index(self):
+        num_written = self.param['last_index'] + 1
+        num_slot = self.output.shape[-1]
+        start = max(num_written - num_slot, 0)
+        return np.arange(start, start + num_slot)
+
+
+
+class DecimatedRecorder(Recorder):
+    # Keep every k-th record (record indices 0, k, 2k, ...).
+    def __init__(self, every):
+        super().__init__()
+
+        if every < 1:
+            raise ValueError('every must be positive.')
+        self.param['every'] = every
+
+
+    def _allocate(self, shape, num_record):
+        return super()._allocate(shape, -(-num_record // self.param['every']))
+
+
+    def write(self, index, value):
+        if index % self.param['every'] == 0:
+            self.output[..., index // self.param['every']] = value
+        self.param['last_index'] = index
+
+
+    def get_time_index(self):
+        return np.arange(0, self.param['num_record'], self.param['every'])
+
+
+
+class MemmapRecorder(FullRecorder):
+    # Every record kept in a .npy file under run_dir, opened as a memory map.
+    # The file is time-major, (num_record, ) + value shape, so that writing one record is one contiguous write;
+    # output is the transposed view with time last, as for in-memory recorders.
+    # Files can be reopened after the run with np.load(path, mmap_mode='r').
+    # The file is not filled at creation, records are written in order: finalize() sets the records after the last
+    # written one to NaN, so that only unwritten records are touched; before that they read as zeros.
+    # Trajectories are recorded per unit by both engines, one file per '<unit>:<key>', e.g. link_0.density.npy.
+    def __init__(self, run_dir):
+        super().__init__()
+
+        self.param['run_dir'] = run_dir
+        self.file = None
+
+
+    def new(self):
+        recorder = super().new()
+        recorder.file = None
+        return recorder
+
+
+    def get_path(self):
+        file_name = self.param['name'].replace(os.sep, '_').replace(':', '.')
+        return os.path.join(self.param['run_dir'], f'{file_name}.npy')
+
+
+    def _allocate(self, shape, num_record):
+        if self.param['name'] is None:
+            raise ValueError('MemmapRecorder needs a trajectory name.')
+
+        os.makedirs(self.param['run_dir'], exist_ok=True)
+        self.file = np.lib.format.open_memmap(self.get_path(), mode='w+', dtype=self.param['dtype'], shape=(num_record,) + tuple(shape))
+        return np.moveaxis(self.file, 0, -1)
+
+
+    def finalize(self):
+        self.file[self.param['last_index'] + 1:] = np.nan
+        self.file.flush()
+
+
+    def is_unit_layout(self):
+        return True
+
+
+
+class AsyncWriter:
+    # One background thread flushing chunks for any number of AsyncRecorders.
+    # The thread starts with the first submitted chunk and is stopped by close(), called when the last open trajectory
+    # is finalized; a later submit starts a new one.
+    def __init__(self):
+        self.queue = queue.Queue()
+        self.thread = None
+        self.error = None
+        self.lock = threading.Lock()
+
+        # ids of the allocated, not yet finalized AsyncRecorders writing through this writer.
+        self.open_set = set()
+
+
+    def open(self, recorder):
+        with self.lock:
+            self.open_set.add(id(recorder))
+
+
+    def release(self, recorder):
+        with self.lock:
+            self.open_set.discard(id(recorder))
+            is_last = not self.open_set
+        if is_last:
+            self.close()
+
+
+    def submit(self, recorder, chunk, start, size):
+        self.check()
+
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name='dyflownet-writer', daemon=True)
+                self.thread.start()
+            self.queue.put((recorder, chunk, start, size))
+
+
+    def close(self):
+        # Stop the thread once the chunks queued before are written.
+        with self.lock:
+            if self.thread is None:
+                return
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+
+            recorder, chunk, start, size = item
+            try:
+                if self.error is None:
+                    recorder.recorder.write_block(start, chunk[..., :size])
+            except BaseException as e:
+                self.error = e
+            finally:
+                # Hand the buffer back, the producer may be waiting for it.
+                recorder.free.put(chunk)
+
+
+    def check(self):
+        # A failed write aborts the run: the thread is stopped and the writer reset before raising, so that it does
+        # not outlive the run and can serve the next one.
+        if self.error is not None:
+            error = self.error
+            self.close()
+            with self.lock:
+                self.open_set.clear()
+                self.error = None
+            raise RuntimeError('Background trajectory writer failed.') from error
+
+
+
+class AsyncRecorder(Recorder):
+    # Wraps a recorder (e.g. a MemmapRecorder) so that its writes happen on a background thread.
+    # Each record is copied into a chunk of chunk_len records; full chunks are queued to the writer.
+    # Every trajectory owns num_buffer reusable chunks: when all are queued, write() waits for one to come back,
+    # so at most num_buffer * chunk_len records per trajectory are pending (backpressure).
+    # finalize() flushes the last partial chunk and waits for all pending chunks.
+    def __init__(self, recorder, chunk_len=64, num_buffer=4, writer=None):
+        super().__init__()
+
+        if chunk_len < 1 or num_buffer < 1:
+            raise ValueError('chunk_len and num_buffer must be positive.')
+
+        self.param['chunk_len'] = chunk_len
+        self.param['num_buffer'] = num_buffer
+
+        # Prototype of the wrapped recorder; new() makes one per trajectory.
+        self.recorder = recorder
+
+        # Shared by all trajectories spawned from this prototype.
+        self.writer = writer if writer is not None else AsyncWriter()
+
+        self.free = None
+        self.chunk = None
+
+
+    def new(self):
+        recorder = super().new()
+        recorder.recorder = self.recorder.new()
+        recorder.free = None
+        recorder.chunk = None
+        return recorder
+
+
+    def allocate(self, shape, num_record, name=None, dtype=float):
+        self.output = self.recorder.allocate(shape, num_record, name, dtype)
+        self.param['num_record'] = num_record
+        self.param['last_index'] = -1
+        self.param['name'] = name
+
+        self.free = queue.Queue()
+        for _ in range(self.param['num_buffer']):
+            self.free.put(np.empty(tuple(shape) + (self.param['chunk_len'],), dtype=self.output.dtype))
+
+        self.chunk = None
+        self.param['chunk_start'] = 0
+        self.param['chunk_size'] = 0
+        self.writer.open(self)
+        return self.output
+
+
+    def write(self, index, value):
+        if self.chunk is not None and index != self.param['chunk_start'] + self.param['chunk_size']:
+            self.submit()
+
+        if self.chunk is None:
+            self.chunk = self.free.get()
+            self.writer.check()
+            self.param['chunk_start'] = index
+            self.param['chunk_size'] = 0
+
+        self.chunk[..., self.param['chunk_size']] = value
+        self.param['chunk_size'] += 1
+        self.param['last_index'] = index
+
+        if self.param['chunk_size'] == self.param['chunk_len']:
+            self.submit()
+
+
+    def submit(self):
+        self.writer.submit(self, self.chunk, self.param['chunk_start'], self.param['chunk_size'])
+        self.chunk = None
+
+
+    def wait(self):
+        # Block until every chunk of this trajectory is written.
+        chunk_list = [self.free.get() for _ in range(self.param['num_buffer'])]
+        for chunk in chunk_list:
+            self.free.put(chunk)
+        self.writer.check()
+
+
+    def finalize(self):
+        # The writer thread stops after the last open trajectory, also if a write failed.
+        try:
+            if self.chunk is not None:
+                self.submit()
+            self.wait()
+        finally:
+            self.writer.release(self)
+        self.recorder.finalize()
+
+
+    def get_time_index(self):
+        return self.recorder.get_time_index()
+
+
+    def is_unit_layout(self):
+        return self.recorder.is_unit_layout()
+
+
+
+class RecorderRule:
+    # Glob patterns on '<unit>:<key>' mapped to recorder prototypes, first match wins; None drops the trajectory.
+    # Unit names: cell and node IDs, '<cell ID>.<flow name>' for flows and '<node ID>.controller' for controllers,
+    # e.g. {'link_*:density': FullRecorder(), 'sink_*.boundary_outflow:*': RingRecorder(100), '*': None}.
+    def __init__(self, pattern_dict=None, default=None):
+        self.pattern_dict = dict(pattern_dict) if pattern_dict is not None else {}
+        self.default = default if default is not None else FullRecorder()
+
+
+    def match(self, unit_name, key):
+        field_name = f'{unit_name}:{key}'
+        for pattern, prototype in self.pattern_dict.items():
+            if fnmatch.fnmatchcase(field_name, pattern):
+                return prototype
+        return self.default
+
+
+
+if __name__ == '__main__':
+    pass
@@ -0,0 +1,91 @@
+import math
+import numpy as np
+from scipy.stats import qmc
+
+from . import parallel
+
+
+# Streaming samplers of initial densities: each yields chunks (num_dim, chunk_size) (the last one shorter), rows
+# ordered as the axes or box dimensions, the layout of utils.generate_boundary_combos(); memory is that of one chunk.
+# iter_network() turns the chunks into networks of state_len the chunk length, so a study never holds the full sample.
+
+
+def get_boundary_face(*arrays):
+    # Disjoint product grids covering the boundary of the grid of arrays: face j holds the points whose first axis at
+    # an endpoint is j, i.e. interior values on axes before j, the endpoints on axis j and all values after it.
+    array_list = [np.asarray(a) for a in arrays]
+
+    face_list = []
+    for j, array in enumerate(array_list):
+        endpoint = array[[0, -1]] if len(array) > 1 else array[:1]
+        face_list.append([a[1:-1] for a in array_list[:j]] + [endpoint] + array_list[j + 1:])
+    return face_list
+
+
+def count_boundary_combos(*arrays):
+    # Number of points of generate_boundary_combos(*arrays), without building them.
+    size_list = [len(a) for a in arrays]
+    return math.prod(size_list) - math.prod(max(n - 2, 0) for n in size_list)
+
+
+def iter_boundary_combos(*arrays, chunk_size=65536):
+    # The points of utils.generate_boundary_combos(*arrays) in chunks, enumerated face by face (see get_boundary_face())
+    # rather than filtered from the full grid: the same points, in another order, and O(chunk_size) memory.
+    face_list = get_boundary_face(*arrays)
+    bound = np.cumsum([0] + [math.prod(len(a) for a in face) for face in face_list])
+
+    for start in range(0, int(bound[-1]), chunk_size):
+        stop = min(start + chunk_size, int(bound[-1]))
+
+        block_list = []
+        for f, face in enumerate(face_list):
+            face_start, face_stop = max(start, bound[f]), min(stop, bound[f + 1])
+            if face_start < face_stop:
+                index = np.unravel_index(np.arange(face_start - bound[f], face_stop - bound[f]), [len(a) for a in face])
+                block_list.append(np.stack([a[i] for a, i in zip(face, index)]))
+
+        yield np.concatenate(block_list, axis=1)
+
+
+def iter_latin_hypercube(lower, upper, num_sample, seed=None, chunk_size=65536):
+    # Latin hypercube sample of the box [lower, upper] in chunks: every dimension has exactly one point in each of its
+    # num_sample strata. The stratum permutations, (num_dim, num_sample) ints, are drawn up front; points per chunk.
+    lower, upper = np.asarray(lower, dtype=float), np.asarray(upper, dtype=float)
+    rng = np.random.default_rng(seed)
+    stratum = np.stack([rng.permutation(num_sample) for _ in range(len(lower))])
+
+    for start in range(0, num_sample, chunk_size):
+        stop = min(start + chunk_size, num_sample)
+        unit = (stratum[:, start:stop] + rng.random((len(lower), stop - start))) / num_sample
+        yield lower[:, None] + unit * (upper - lower)[:, None]
+
+
+def iter_sobol(lower, upper, num_sample, seed=None, chunk_size=65536):
+    # Scrambled Sobol points of the box [lower, upper] in chunks, consecutive points of one sequence; num_sample and
+    # chunk_size powers of two keep its balance properties.
+    lower, upper = np.asarray(lower, dtype=float), np.asarray(upper, dtype=float)
+    sobol = qmc.Sobol(len(lower), scramble=True, rng=np.random.default_rng(seed))
+
+    for start in range(0, num_sample, chunk_size):
+        unit = sobol.random(min(chunk_size, num_sample - start)).T
+        yield lower[:, None] + unit * (upper - lower)[:, None]
+
+
+def iter_network(net, cell_id_list, sample_iter, column=0):
+    # For each chunk (len(cell_id_list), n) of sample_iter, a network like net with state_len n, the densities of the
+    # cells in cell_id_list starting from the chunk and every other column copied from column of net.
+    spec = parallel.get_spec(net)
+
+    for sample in sample_iter:
+        work_net = parallel.from_spec(parallel.get_shard_spec(spec, np.full(sample.shape[1], column)))
+
+        cell_dict = {c.ID: c for c in work_net.get_cell_list()}
+        for ID, density in zip(cell_id_list, sample):
+            cell_dict[ID].set_initial_condition({'density': np.array(density)})
+
+        yield work_net
+
+
+
+if __name__ == '__main__':
+    pass
@@ -0,0 +1,135 @@
+import numpy as np
+
+from . import parallel
+from .flow import MarkovianPiecewiseLinearSendingFlow
+
+
+# Run until steady state: a column is frozen once no cell density changes by more than tol in num_steady_step steps
+# in a row; it is no longer simulated and its states and co-states keep their last values. The simulated columns live in a work network
+# rebuilt from the spec of the network (see parallel.get_spec) with the unfrozen columns only, whenever at most
+# compact_ratio of its columns are still unfrozen; states carry over from the previous work network.
+# Outputs of the network are written every step from full-width buffers, so frozen columns are filled forward.
+# Only for time-invariant inputs, since a frozen column would not see later changes of them: networks with time-varying
+# boundary conditions, demands or split ratios, or with Markovian flows, are rejected (see get_time_varying_unit_list).
+
+
+def _build(spec, column, current, step, engine, backend):
+    # Seeded stochastic units restart their stream at initialize(); a rebuild after step 0 continues on another one.
+    work_net = parallel.from_spec(parallel.get_shard_spec(spec, column, (step, ) if step > 0 else ()))
+    work_net.set_recorder({'*': None})
+
+    if engine == 'array':
+        work_net.compile(backend)
+        work_net.engine.initialize()
+    else:
+        work_net.initialize()
+
+    # Continue from the current states of the columns.
+    for name, unit in work_net.get_unit_dict().items():
+        for k, v in unit.state.items():
+            v[...] = current[name][0][k][column]
+
+    work_net.step = step
+
+    # (full-width array, state or co_state dict of a work unit, key) of every state and co-state, copied every step.
+    copy_list = [(value[k], work_value, k) for name, unit in work_net.get_unit_dict().items()
+                 for value, work_value in zip(current[name], (unit.state, unit.co_state)) for k in work_value]
+    return work_net, copy_list
+
+
+def _run_one_step(work_net, engine):
+    if engine == 'array':
+        work_net.engine.run_one_step()
+    else:
+        work_net.run_one_step()
+
+
+def get_time_varying_unit_list(net):
+    # Names of the units whose inputs change over time: a parameter is_..._constant set to False, or a Markovian flow.
+    return [name for name, unit in net.get_unit_dict().items()
+            if isinstance(unit, MarkovianPiecewiseLinearSendingFlow) or any(k.startswith('is_') and k.endswith('_constant') and not v for k, v in unit.param.items())]
+
+
+def check_input(net):
+    # Raises for networks that cannot be run until steady state: with metrics, or with time-varying inputs.
+    if net.metric_list:
+        raise ValueError('Metrics are not supported with until=\'steady\'.')
+
+    time_varying_unit_list = get_time_varying_unit_list(net)
+    if time_varying_unit_list:
+        raise ValueError(f'until=\'steady\' needs time-invariant inputs, these units vary over time: {time_varying_unit_list}.')
+
+
+def run(net, tol, engine='object', backend='numpy', compact_ratio=0.5, num_steady_step=10):
+    # Leaves net.convergence_step: (state_len, ), the number of steps after which each column was steady, -1 if never.
+    # num_steady_step: consecutive steps within tol before a column is frozen, so that a pause of the dynamics (e.g. a
+    # controller catching up) does not freeze it.
+    check_input(net)
+
+    num_step, state_len = net.param['num_step'], net.param['state_len']
+
+    # Outputs are allocated (and the initial records written) here, by the recorders of the network's rule.
+    net.initialize()
+    spec = parallel.get_spec(net)
+
+    # current: {unit name: (state, co_state)}, full-width values of the last step.
+    unit_dict = net.get_unit_dict()
+    current = {name: ({k: np.array(v) for k, v in u.state.items()}, {k: np.array(v) for k, v in u.co_state.items()}) for name, u in unit_dict.items()}
+    recorder_list = parallel.get_recorder_list(net)
+
+    convergence_step = np.full(state_len, -1, dtype=int)
+    num_steady = np.zeros(state_len, dtype=int)
+    column = np.arange(state_len)
+    work_net, copy_list = _build(spec, column, current, 0, engine, backend)
+
+    for step in range(num_step):
+        density_previous = np.array(work_net.get_cell_value('density'))
+        _run_one_step(work_net, engine)
+
+        # Density change of this step per column: (num_work_column, ).
+        change = np.max(np.abs(work_net.get_cell_value('density') - density_previous), axis=0, initial=0)
+        is_active = convergence_step[column] < 0
+        active_column = column[is_active]
+
+        if len(active_column) == state_len:
+            for value, work_value, k in copy_list:
+                value[...] = work_value[k]
+        else:
+            for value, work_value, k in copy_list:
+                value[active_column] = np.asarray(work_value[k])[is_active]
+
+        num_steady[active_column] = np.where(change[is_active] <= tol, num_steady[active_column] + 1, 0)
+        convergence_step[active_column[num_steady[active_column] >= num_steady_step]] = step + 1
+
+        for name, kind, k, recorder in recorder_list:
+            if kind == 'state':
+                recorder.write(step + 1, current[name][0][k])
+            else:
+                recorder.write(step, current[name][1][k])
+
+        active_column = column[convergence_step[column] < 0]
+        if len(active_column) == 0:
+            # Steady everywhere: the remaining records repeat the last one.
+            for name, kind, k, recorder in recorder_list:
+                value = current[name][0][k] if kind == 'state' else current[name][1][k]
+                start = step + 2 if kind == 'state' else step + 1
+                if start < recorder.param['num_record']:
+                    recorder.write_block(start, np.broadcast_to(value[..., None], value.shape + (recorder.param['num_record'] - start,)))
+            break
+
+        if len(active_column) <= compact_ratio * len(column) and step + 1 < num_step:
+            column = active_column
+            work_net, copy_list = _build(spec, column, current, step + 1, engine, backend)
+
+    for name, unit in unit_dict.items():
+        for target, value in zip((unit.state, unit.co_state), current[name]):
+            for k, v in value.items():
+                target[k][...] = v
+
+    net.finalize_output()
+    net.convergence_step = convergence_step
+    net.step = num_step
+
+
+if __name__ == '__main__':
+    pass
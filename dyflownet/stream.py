@@ -0,0 +1,194 @@
+import fnmatch
+import glob
+import os
+import numpy as np
+
+from . import parallel
+from . import steady
+
+
+# Streaming runs of more columns than fit in memory through one network: the network is built from the spec of net
+# with state_len chunk_size (every column a copy of column) and compiled once; each chunk of initial conditions or
+# per-column parameters is written into its units, run from step 0 and reduced to a flat result dict handed to
+# consumer. Trajectories are not recorded, so memory does not grow with the number of chunks.
+# A chunk is {unit name: {key: (n, ...)}} with keys of the unit's initial_condition or param, or {cell ID: (n, )}
+# for the density; chunks longer than chunk_size are split, a shorter one is padded with its last column.
+# Result of a chunk: 'column': (n, ) indices of the columns in the stream, '<unit name>:<key>': (n, ...) final states
+# and co-states matching field_list, 'metric.<i>.<name>': (n, ...) final state of metric i of net (column axis
+# first), and 'convergence_step': (n, ) with until='steady' (which, as steady.run(), does not support metrics).
+
+
+def split_chunk(chunk, chunk_size):
+    # Pieces of chunk of at most chunk_size columns, values normalized to {unit name: {key: array}}.
+    chunk = {name: value if isinstance(value, dict) else {'density': value} for name, value in chunk.items()}
+    chunk = {name: {k: np.asarray(v) for k, v in value.items()} for name, value in chunk.items()}
+    num_column = len(next(iter(next(iter(chunk.values())).values())))
+
+    for start in range(0, num_column, chunk_size):
+        yield {name: {k: v[start:start + chunk_size] for k, v in value.items()} for name, value in chunk.items()}
+
+
+def set_chunk(unit_dict, chunk, chunk_size, spec_unit_dict):
+    # Writes a chunk into the units, padded to chunk_size columns; returns its number of columns.
+    num_column = 0
+    for name, value in chunk.items():
+        unit = unit_dict[name]
+        for k, v in value.items():
+            num_column = len(v)
+            v = np.concatenate([v, np.repeat(v[-1:], chunk_size - len(v), axis=0)])
+
+            if k in spec_unit_dict[name]['attr'].get('initial_condition', {}):
+                unit.set_initial_condition({k: v})
+            elif k in spec_unit_dict[name]['attr']['param']:
+                unit.param[k] = v
+            else:
+                raise ValueError(f'{name} has no initial condition or parameter {k}.')
+    return num_column
+
+
+def get_result(work_net, field_list, column=slice(None)):
+    # Values at column of the states and co-states matching field_list and of the metrics, column axis first.
+    result = {}
+    for name, unit in work_net.get_unit_dict().items():
+        for value in (unit.state, unit.co_state):
+            for k, v in value.items():
+                field_name = f'{name}:{k}'
+                if any(fnmatch.fnmatchcase(field_name, pattern) for pattern in field_list):
+                    result[field_name] = np.array(v[column])
+
+    for i, metric in enumerate(work_net.metric_list):
+        for k, v in metric.state.items():
+            result[f'metric.{i}.{k}'] = np.array(np.moveaxis(np.asarray(v), -1, 0)[column])
+    return result
+
+
+def run_chunk(work_net, field_list, tol, engine, cell_index=slice(None), num_steady_step=10):
+    # Runs the work network from step 0. Returns its result (see get_result()) and the convergence step of each column,
+    # -1 if never (all -1 without tol). With tol, a column converges once the densities of the cells at cell_index (all
+    # by default) change by at most tol in num_steady_step steps in a row, as in steady.run(); its result is taken at
+    # that step, and the run stops once every column has converged.
+    if engine == 'array':
+        work_net.engine.initialize()
+    else:
+        work_net.initialize()
+
+    state_len = work_net.param['state_len']
+    convergence_step = np.full(state_len, -1, dtype=int)
+    num_steady = np.zeros(state_len, dtype=int)
+    result = None
+
+    for step in range(work_net.param['num_step']):
+        if tol is not None:
+            density_previous = np.array(work_net.get_cell_value('density')[cell_index])
+
+        if engine == 'array':
+            work_net.engine.run_one_step()
+        else:
+            work_net.run_one_step()
+
+        if tol is not None:
+            change = np.max(np.abs(work_net.get_cell_value('density')[cell_index] - density_previous), axis=0, initial=0)
+            num_steady = np.where(change <= tol, num_steady + 1, 0)
+
+            converged = np.flatnonzero((convergence_step < 0) & (num_steady >= num_steady_step))
+            if len(converged) > 0:
+                result = get_result(work_net, field_list) if result is None else result
+                for k, v in get_result(work_net, field_list, converged).items():
+                    result[k][converged] = v
+                convergence_step[converged] = step + 1
+
+            if np.all(convergence_step >= 0):
+                break
+
+    work_net.finalize_metric()
+
+    # Columns that did not converge keep their last values.
+    if result is None:
+        result = get_result(work_net, field_list)
+    else:
+        remaining = np.flatnonzero(convergence_step < 0)
+        for k, v in get_result(work_net, field_list, remaining).items():
+            result[k][remaining] = v
+    return result, convergence_step
+
+
+def run(net, chunk_iter, chunk_size, consumer=None, field_list=('*:density', ), until=None, tol=1e-6, column=0, engine='array', backend='numpy',
+        cell_id_list=None, num_steady_step=10):
+    # consumer: called with the result of every chunk, e.g. an NpzTable; without one, the results are concatenated
+    # and returned. until='steady' follows steady.run(): the same networks are rejected, and a column's result is taken
+    # once it is steady, while the chunk runs until all its columns are; cell_id_list: the cells checked for
+    # steadiness, all by default.
+    if until == 'steady':
+        steady.check_input(net)
+
+    spec = parallel.get_spec(net)
+    work_net = parallel.from_spec(parallel.get_shard_spec(spec, np.full(chunk_size, column)))
+    work_net.set_recorder({'*': None})
+    work_net.metric_list = net.metric_list
+
+    unit_dict = work_net.get_unit_dict()
+    spec_unit_dict = dict(zip(unit_dict, spec['unit']))
+    work_cell_id_list = [c.ID for c in work_net.get_cell_list()]
+    cell_index = slice(None) if cell_id_list is None else [work_cell_id_list.index(ID) for ID in cell_id_list]
+    seed_dict = {name: unit.param['seed'] for name, unit in unit_dict.items() if unit.param.get('seed') is not None}
+
+    if engine == 'array':
+        work_net.compile(backend)
+
+    result_list, start = [], 0
+    for item in chunk_iter:
+        for chunk in split_chunk(item, chunk_size):
+            num_column = set_chunk(unit_dict, chunk, chunk_size, spec_unit_dict)
+
+            # Every chunk draws from its own stream, as the shards of parallel.run() do.
+            for name, seed in seed_dict.items():
+                unit_dict[name].param['seed'] = [*np.atleast_1d(seed).tolist(), start]
+            if engine == 'array':
+                work_net.engine.pack()
+
+            chunk_result, convergence_step = run_chunk(work_net, field_list, tol if until == 'steady' else None, engine, cell_index, num_steady_step)
+
+            result = {'column': np.arange(start, start + num_column)}
+            result.update({k: v[:num_column] for k, v in chunk_result.items()})
+            if until == 'steady':
+                result['convergence_step'] = convergence_step[:num_column]
+
+            if consumer is None:
+                result_list.append(result)
+            else:
+                consumer(result)
+            start += num_column
+
+    if consumer is None and result_list:
+        return {k: np.concatenate([r[k] for r in result_list]) for k in result_list[0]}
+
+
+
+class NpzTable:
+    # On-disk table of streamed results, one .npz file per chunk in directory; a consumer of run().
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+
+    def __call__(self, result):
+        np.savez(os.path.join(self.directory, f'chunk_{result["column"][0]:012d}.npz'), **result)
+
+
+    def get_path_list(self):
+        return sorted(glob.glob(os.path.join(glob.escape(self.directory), 'chunk_*.npz')))
+
+
+    def load(self, key_list=None):
+        # {key: values of all chunks concatenated}, of the keys in key_list or of all.
+        value_dict = {}
+        for path in self.get_path_list():
+            with np.load(path) as file:
+                for k in file.files if key_list is None else key_list:
+                    value_dict.setdefault(k, []).append(file[k])
+        return {k: np.concatenate(v) for k, v in value_dict.items()}
+
+
+
+if __name__ == '__main__':
+    pass
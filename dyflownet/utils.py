@@ -1,11 +1,39 @@
 import numpy as np
+from scipy import sparse
 from scipy.linalg import null_space
+from scipy.sparse import linalg as sparse_linalg
 
-def safe_div(x, y, fill = np.inf):
-    return np.divide(x, y, out=np.full_like(x, fill, dtype=float), where=(y != 0))
+def safe_div(x, y, fill = np.inf, out=None, mask=None):
+    # out, mask: optional preallocated result and (y != 0) buffers.
+    if out is None:
+        out = np.full(np.broadcast_shapes(np.shape(x), np.shape(y)), fill, dtype=np.result_type(x, y, 1.0))
+    else:
+        out.fill(fill)
+
+    mask = np.not_equal(y, 0, out=mask)
+    return np.divide(x, y, out=out, where=mask)
+
+
+def median_of_three(x, y, z, out=None, work=None):
+    # Elementwise median of three arrays, same as np.median([x, y, z], axis=0) without stacking.
+    # out, work: optional preallocated result and scratch buffers.
+    out = np.minimum(x, y, out=out)
+    work = np.maximum(x, y, out=work)
+    np.minimum(work, z, out=work)
+    return np.maximum(out, work, out=out)
+
+
+def work_buffer(work, name, shape, dtype=float):
+    # Scratch array kept in the dict work and reused across steps; reallocated only if shape or dtype changes.
+    buffer = work.get(name)
+    if buffer is None or buffer.shape != shape or buffer.dtype != dtype:
+        buffer = work[name] = np.empty(shape, dtype=dtype)
+    return buffer
 
 
 def generate_boundary_combos(*arrays):
+    # Points of the grid of arrays with at least one coordinate at an endpoint: (len(arrays), num_point). Builds the full
+    # grid; sampler.iter_boundary_combos() yields the same points in chunks.
     array_list = [np.asarray(a) for a in arrays]
     N = len(array_list)
 
@@ -22,14 +50,82 @@ def generate_boundary_combos(*arrays):
 
 
 def get_stationary_distribution(prob_matrix):
-    A = prob_matrix - np.eye(prob_matrix.shape[0])
-    nullspace = null_space(A.T)
+    # prob_matrix: (..., num_mode, num_mode), stacked transition matrices, or one scipy sparse matrix.
+    # Returns (..., num_mode) (num_mode, for a sparse matrix), from pi (I - P + 1) = 1, one batched solve; the matrix
+    # is singular only for chains without a unique stationary distribution, which fall back to the null space of P - I.
+    if sparse.issparse(prob_matrix):
+        return _get_sparse_stationary_distribution(prob_matrix)
+
+    prob_matrix = np.asarray(prob_matrix, dtype=float)
+    num_mode = prob_matrix.shape[-1]
+    A = np.eye(num_mode) - prob_matrix + 1
+
+    try:
+        pi = np.linalg.solve(np.swapaxes(A, -1, -2), np.ones(prob_matrix.shape[:-1])[..., None])[..., 0]
+    except np.linalg.LinAlgError:
+        pi = np.empty(prob_matrix.shape[:-1])
+        for idx in np.ndindex(prob_matrix.shape[:-2]):
+            nullspace = null_space((prob_matrix[idx] - np.eye(num_mode)).T)
+            pi[idx] = (nullspace.T / np.sum(nullspace))[0, :]
+
+    return pi
+
+
+def _get_sparse_stationary_distribution(prob_matrix, tol=1e-12):
+    # Iterative solve of pi (I - P) = 0 with the last equation replaced by sum(pi) = 1.
+    num_mode = prob_matrix.shape[0]
+    A = (sparse.identity(num_mode, format='csr') - sparse.csr_matrix(prob_matrix)).T.tolil()
+    A[num_mode - 1, :] = np.ones(num_mode)
+    b = np.zeros(num_mode)
+    b[-1] = 1
+
+    # GMRES, again with an incomplete-LU preconditioner (costly to build, but needed by slowly mixing chains) if it stalls.
+    A = A.tocsc()
+    pi, info = sparse_linalg.lgmres(A, b, x0=np.full(num_mode, 1 / num_mode), rtol=tol, atol=0, maxiter=50)
+    if info != 0:
+        preconditioner = sparse_linalg.LinearOperator(A.shape, sparse_linalg.spilu(A).solve)
+        pi, info = sparse_linalg.lgmres(A, b, x0=pi, M=preconditioner, rtol=tol, atol=0, maxiter=1000)
+    if info != 0:
+        raise ValueError('Stationary distribution did not converge.')
+    return pi
+
+
+def get_spectral_gap(prob_matrix):
+    # 1 - |lambda_2|, lambda_2 the second largest eigenvalue in modulus: (..., ), or a float for a sparse matrix.
+    # The distance to the stationary distribution shrinks about like (1 - gap) ** step.
+    if sparse.issparse(prob_matrix):
+        modulus = np.sort(np.abs(sparse_linalg.eigs(sparse.csr_matrix(prob_matrix, dtype=float).T, k=2, which='LM', return_eigenvectors=False)))
+    else:
+        modulus = np.sort(np.abs(np.linalg.eigvals(np.asarray(prob_matrix, dtype=float))), axis=-1)
+    return 1 - modulus[..., -2]
+
+
+def get_sojourn_time(prob_matrix, time_step_size=1):
+    # Expected time spent in each mode once entered, geometric in steps: time_step_size / (1 - P_ii), (..., num_mode).
+    if sparse.issparse(prob_matrix):
+        stay = sparse.csr_matrix(prob_matrix).diagonal()
+    else:
+        stay = np.diagonal(np.asarray(prob_matrix, dtype=float), axis1=-2, axis2=-1)
+    return safe_div(time_step_size, 1 - stay, fill=np.inf)
+
+
+def get_markov_chain_summary(prob_matrix, time_step_size=1):
+    # Stationary distribution, spectral gap, relaxation time (time_step_size / gap) and sojourn times of stacked chains.
+    spectral_gap = get_spectral_gap(prob_matrix)
+    return {
+        'stationary_distribution': get_stationary_distribution(prob_matrix),
+        'spectral_gap': spectral_gap,
+        'relaxation_time': safe_div(time_step_size, spectral_gap, fill=np.inf),
+        'sojourn_time': get_sojourn_time(prob_matrix, time_step_size),
+    }
+
 
-    return (nullspace.T / np.sum(nullspace))[0, :]
-    
 
 
 class NetUnit:
+    # Array parameters whose first axis is not the batch axis (e.g. per-mode values), kept whole when columns are split.
+    shared_param_list = []
+
     def __init__(self, net=None, is_state_saved=True, is_co_state_saved=True):
 
         self.hook_up_to_net(net)
@@ -45,6 +141,17 @@ class NetUnit:
         self.co_state = {}
         self.co_state_output = {}
 
+        # Recorders behind state_output and co_state_output, set at initialize_output().
+        self.state_recorder = {}
+        self.co_state_recorder = {}
+
+        # Floating parameters as given, param holds them cast to the network dtype, see initialize_param().
+        self.param_source = {}
+        self.param_cast = {}
+
+        # Scratch buffers of the in-place hot path, see work_buffer().
+        self.work = {}
+
         self.initial_condition = {}
 
 
@@ -62,11 +169,24 @@ class NetUnit:
     
     
     def initialize(self):
+        self.initialize_param()
         self.initialize_state()
         self.initialize_co_state()
+        self.initialize_work()
         self.initialize_output()
 
 
+    def initialize_param(self):
+        # Cast floating parameters to the network dtype. Casts start from the values as given, so that runs in
+        # different dtypes see the same parameters; a parameter replaced by the user becomes the new source.
+        dtype = self.net.param['dtype']
+        for k, v in self.param.items():
+            if isinstance(v, (np.ndarray, np.floating)) and np.issubdtype(v.dtype, np.floating):
+                if k not in self.param_cast or self.param_cast[k] is not v:
+                    self.param_source[k] = v
+                self.param[k] = self.param_cast[k] = np.asarray(self.param_source[k], dtype=dtype)[()]
+
+
     def initialize_state(self):
         pass
 
@@ -75,22 +195,43 @@ class NetUnit:
         pass
 
 
+    def initialize_work(self):
+        self.work = {}
+
+
+    def work_buffer(self, name, shape, dtype=None):
+        return work_buffer(self.work, name, shape, self.net.param['dtype'] if dtype is None else dtype)
+
+
     def initialize_output(self):
+        # Trajectories are stored by recorders chosen through the network's recorder rule, see Network.set_recorder().
+        self.state_output, self.state_recorder = {}, {}
+        self.co_state_output, self.co_state_recorder = {}, {}
+
         if self.param['is_state_saved']:
             for k, v in self.state.items():
-                self.state_output[k] = np.full(v.shape + (self.net.param['num_step']+1,), np.nan)
-                self.state_output[k][:, 0] = v
+                recorder = self.net.make_recorder(self, k)
+                if recorder is not None:
+                    self.state_output[k] = recorder.allocate(v.shape, self.net.param['num_step']+1, f'{self.net.get_unit_name(self)}:{k}', v.dtype)
+                    self.state_recorder[k] = recorder
+                    recorder.write(0, v)
         
         if self.param['is_co_state_saved']:
             for k, v in self.co_state.items():
-                self.co_state_output[k] = np.full(v.shape + (self.net.param['num_step'],), np.nan)
+                recorder = self.net.make_recorder(self, k)
+                if recorder is not None:
+                    self.co_state_output[k] = recorder.allocate(v.shape, self.net.param['num_step'], f'{self.net.get_unit_name(self)}:{k}', v.dtype)
+                    self.co_state_recorder[k] = recorder
             
     
     def save_output(self):
-        if self.param['is_state_saved']:
-            for k, v in self.state_output.items():
-                v[..., self.net.step+1] = self.state[k]
+        for k, recorder in self.state_recorder.items():
+            recorder.write(self.net.step+1, self.state[k])
 
-        if self.param['is_co_state_saved']:
-            for k, v in self.co_state_output.items():
-                v[..., self.net.step] = self.co_state[k]
\ No newline at end of file
+        for k, recorder in self.co_state_recorder.items():
+            recorder.write(self.net.step, self.co_state[k])
+
+
+    def finalize_output(self):
+        for recorder in list(self.state_recorder.values()) + list(self.co_state_recorder.values()):
+            recorder.finalize()
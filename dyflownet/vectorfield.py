@@ -0,0 +1,90 @@
+import numpy as np
+
+from . import parallel
+
+
+# Vector field of a network: d(density)/dt = (inflow - outflow) / cell_len of every cell at given densities, from the
+# flows of one step (before densities are clipped to their bounds). Points are evaluated in chunks by a work network
+# of chunk_size columns rebuilt from the spec (see parallel.get_spec), all with the parameters of one column of the
+# network and the boundary conditions of one step, so that the network itself is left as it is.
+# Units with memory (controllers, Markovian modes) start from their initial states and advance once per chunk.
+
+
+def get_density(net, density_by_cell, column=0):
+    # density: (num_cell, num_point) and the batch shape. Cells missing from a dict keep their initial density in column.
+    cell_list = net.get_cell_list()
+    if not isinstance(density_by_cell, dict):
+        density = np.asarray(density_by_cell, dtype=float)
+        if len(density) != len(cell_list):
+            raise ValueError(f'Densities of {len(density)} cells given, the network has {len(cell_list)}.')
+        return density.reshape(len(cell_list), -1), density.shape[1:]
+
+    unknown = set(density_by_cell) - {c.ID for c in cell_list}
+    if unknown:
+        raise ValueError(f'Unknown cells: {sorted(unknown)}.')
+
+    batch_shape = np.broadcast_shapes(*[np.shape(v) for v in density_by_cell.values()])
+    density = np.empty((len(cell_list), int(np.prod(batch_shape))))
+    for i, c in enumerate(cell_list):
+        if c.ID in density_by_cell:
+            density[i] = np.broadcast_to(density_by_cell[c.ID], batch_shape).ravel()
+        else:
+            initial_density = np.atleast_1d(c.initial_condition['density'])
+            density[i] = initial_density[column if len(initial_density) > 1 else 0]
+    return density, batch_shape
+
+
+def build(net, column, engine='array', backend='numpy'):
+    # Work network of the given columns of net, an index array (see parallel.get_shard_spec), and the function running
+    # steps 1 to 5 on it.
+    work_net = parallel.from_spec(parallel.get_shard_spec(parallel.get_spec(net), column))
+    work_net.set_recorder({'*': None})
+    if engine == 'array':
+        work_net.compile(backend)
+        work_net.engine.initialize()
+        return work_net, work_net.engine.update_cell_flow
+
+    work_net.initialize()
+    return work_net, work_net.update_cell_flow
+
+
+def get_rate(work_net, update_cell_flow, density, step=0):
+    # d(density)/dt of every cell: (num_cell, state_len) of the work network at density: (num_cell, state_len).
+    for value, d in zip([c.state['density'] for c in work_net.get_cell_list()], density):
+        value[...] = d
+
+    work_net.step = step
+    update_cell_flow()
+
+    # cell_len: (num_cell, 1).
+    cell_len = np.array([[c.param['cell_len']] for c in work_net.get_cell_list()], dtype=float)
+    return (work_net.get_cell_value('inflow') - work_net.get_cell_value('outflow')) / cell_len
+
+
+def evaluate(net, density_by_cell, chunk_size=65536, column=0, step=0, engine='array', backend='numpy'):
+    # Returns d(density)/dt as density_by_cell is given: (num_cell, ...) or {cell ID: (...)}.
+    cell_list = net.get_cell_list()
+    density, batch_shape = get_density(net, density_by_cell, column)
+    num_point = density.shape[1]
+    chunk_size = max(min(chunk_size, num_point), 1)
+
+    work_net, update_cell_flow = build(net, np.full(chunk_size, column), engine, backend)
+
+    rate = np.empty((len(cell_list), num_point))
+    for start in range(0, num_point, chunk_size):
+        stop = min(start + chunk_size, num_point)
+
+        # The last chunk is padded with its first point.
+        density_chunk = np.repeat(density[:, start:start + 1], chunk_size, axis=1)
+        density_chunk[:, :stop - start] = density[:, start:stop]
+
+        rate[:, start:stop] = get_rate(work_net, update_cell_flow, density_chunk, step)[:, :stop - start]
+
+    rate = rate.reshape((len(cell_list), ) + tuple(batch_shape))
+    if isinstance(density_by_cell, dict):
+        return {c.ID: rate[i] for i, c in enumerate(cell_list)}
+    return rate
+
+
+if __name__ == '__main__':
+    pass
@@ -0,0 +1,73 @@
+import tracemalloc
+import numpy as np
+
+import dyflownet as dfn
+
+
+# In-place hot path: after a few warm-up steps, a step allocates no array, on both engines. Checked by the peak of
+# traced memory over the steps, which a temporary of even one row of state_len columns would exceed.
+
+STATE_LEN = 4096
+
+
+def build_merge():
+    v, F, w = 60, 6000, 20
+    max_density, max_speed = 400, 60
+    S = STATE_LEN
+    density = np.linspace(0, max_density, S)
+
+    net = dfn.net.Network(ID='net_0', state_len=S, num_step=50, time_step_size=6/3600)
+    source_0 = dfn.cell.Source('source_0', initial_condition={'density': np.zeros(S)}, boundary_inflow=dfn.flow.BoundaryInflow(4800),
+                               sending=dfn.flow.BufferSendingFlow(4800, ignore_queue=True))
+    source_1 = dfn.cell.Source('source_1', initial_condition={'density': np.zeros(S)}, boundary_inflow=dfn.flow.BoundaryInflow(1200),
+                               sending=dfn.flow.BufferSendingFlow(1200, capacity=2000))
+    link_list = [dfn.cell.Link(f'link_{i}', max_density=max_density, max_speed=max_speed, initial_condition={'density': density},
+                               receiving=dfn.flow.PiecewiseLinearReceivingFlow(w, max_density, F),
+                               sending=(dfn.flow.PiecewiseLinearSendingFlow(v, F) if i != 1 else dfn.flow.CapacityDropPiecewiseLinearSendingFlow(v, F, 150, 5000)))
+                 for i in range(3)]
+    sink_0 = dfn.cell.Sink('sink_0', max_density=max_density, max_speed=max_speed, initial_condition={'density': np.zeros(S)},
+                           receiving=dfn.flow.PiecewiseLinearReceivingFlow(w, max_density, F), boundary_outflow=dfn.flow.BoundaryOutflow(v, F))
+
+    net.add_cell('source', source_0)
+    net.add_cell('source', source_1)
+    for link in link_list:
+        net.add_cell('link', link)
+    net.add_cell('sink', sink_0)
+
+    net.add_node(dfn.node.BasicJunction('node_0', [source_0], [link_list[0]]))
+    net.add_node(dfn.node.BasicJunction('node_1', [link_list[0]], [link_list[1]]))
+    net.add_node(dfn.node.TwoToOneMergeJunction('node_2', [link_list[1], source_1], [link_list[2]], merging_priority=[0.7, 0.3]))
+    net.add_node(dfn.node.BasicJunction('node_3', [link_list[2]], [sink_0]))
+    net.set_recorder({'*': None})
+    return net
+
+
+def get_step_peak(net, engine, num_warm_up=5, num_step=20):
+    # Peak of traced memory over num_step steps above the memory at their start, in bytes.
+    if engine == 'array':
+        net.compile()
+        net.engine.initialize()
+        run_one_step = net.engine.run_one_step
+    else:
+        net.initialize()
+        run_one_step = net.run_one_step
+
+    for _ in range(num_warm_up):
+        run_one_step()
+
+    tracemalloc.start()
+    try:
+        start = tracemalloc.get_traced_memory()[0]
+        for _ in range(num_step):
+            run_one_step()
+        return tracemalloc.get_traced_memory()[1] - start
+    finally:
+        tracemalloc.stop()
+
+
+def test_object_step_does_not_allocate():
+    assert get_step_peak(build_merge(), 'object') < STATE_LEN * 8
+
+
+def test_array_step_does_not_allocate():
+    assert get_step_peak(build_merge(), 'array') < STATE_LEN * 8
@@ -0,0 +1,37 @@
+import numpy as np
+import pytest
+
+import dyflownet as dfn
+from dyflownet.ensemble import P2Quantile
+
+
+def build(state_len=2, num_step=50):
+    net = dfn.net.Network(ID='net_0', state_len=state_len, num_step=num_step, time_step_size=1)
+    source_0 = dfn.cell.Source('source_0', initial_condition={'density': [0] * state_len}, boundary_inflow=dfn.flow.BoundaryInflow(0.6),
+                               sending=dfn.flow.BufferSendingFlow(0.6, capacity=1))
+    outflow = dfn.flow.MarkovianPiecewiseLinearSendingFlow([0, 1], [1, 1], [1, 0.5], [[0.9, 0.1], [0.3, 0.7]], {'mode': 0})
+    sink_0 = dfn.cell.Sink('sink_0', initial_condition={'density': np.linspace(0, 3, state_len)},
+                           receiving=dfn.flow.PiecewiseLinearReceivingFlow(0.25, 6, np.inf), boundary_outflow=outflow)
+    net.add_cell('source', source_0)
+    net.add_cell('sink', sink_0)
+    net.add_node(dfn.node.BasicJunction('node_0', [source_0], [sink_0]))
+    return net
+
+
+@pytest.mark.parametrize('sampling', ['random', 'antithetic'])
+def test_statistics_do_not_depend_on_batch_size(sampling):
+    ensemble_list = [build().run_ensemble(['sink_0:density'], 24, batch_size=batch_size, seed=0, sampling=sampling) for batch_size in (24, 8, 2)]
+
+    for ensemble in ensemble_list[1:]:
+        np.testing.assert_allclose(ensemble.get_mean('sink_0:density'), ensemble_list[0].get_mean('sink_0:density'), rtol=0, atol=1e-12)
+        np.testing.assert_allclose(ensemble.get_std('sink_0:density'), ensemble_list[0].get_std('sink_0:density'), rtol=0, atol=1e-12)
+
+
+@pytest.mark.parametrize('batch_size', [1, 64])
+def test_p2_quantile(batch_size):
+    sample = np.random.default_rng(0).exponential(1, (10000, 3))
+    estimator = P2Quantile(0.9, (3, 1))
+    for start in range(0, len(sample), batch_size):
+        estimator.add(sample[start:start + batch_size], start, 0)
+
+    np.testing.assert_allclose(estimator.get(len(sample))[:, 0], np.quantile(sample, 0.9, axis=0), rtol=0.05)
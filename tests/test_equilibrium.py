@@ -0,0 +1,47 @@
+import numpy as np
+
+import dyflownet as dfn
+
+
+def add_sink(ID, speed):
+    return dfn.cell.Sink(ID, max_density=5, max_speed=1, initial_condition={'density': [0]},
+                         receiving=dfn.flow.PiecewiseLinearReceivingFlow(0.25, 5, 1), boundary_outflow=dfn.flow.BoundaryOutflow(speed, 1))
+
+
+def build(num_sink):
+    # A source with demand 0.6 feeding one sink through a basic junction, or two through a diverge junction.
+    net = dfn.net.Network(ID='net_0', state_len=1, num_step=10, time_step_size=0.1)
+    source_0 = dfn.cell.Source('source_0', initial_condition={'density': [0]}, boundary_inflow=dfn.flow.BoundaryInflow(0.6),
+                               sending=dfn.flow.BufferSendingFlow(0.6, ignore_queue=True))
+    sink_list = [add_sink('sink_0', 1), add_sink('sink_1', 0.5)][:num_sink]
+    net.add_cell('source', source_0)
+    for sink in sink_list:
+        net.add_cell('sink', sink)
+
+    if num_sink == 1:
+        net.add_node(dfn.node.BasicJunction('node_0', [source_0], sink_list))
+    else:
+        net.add_node(dfn.node.OneToTwoDivergeJunction('node_0', [source_0], sink_list, [0.5, 0.5]))
+    return net
+
+
+def test_basic_junction():
+    # Inflow 0.6 = outflow min(x, 1) at x = 0.6; outflows saturate above 1, where starts must leave the flat regime.
+    result = dfn.equilibrium.solve(build(1), ['sink_0'], lower=[0], upper=[5], num_start=16, seed=0)
+
+    assert np.all(result['stability'] == 0)
+    equilibrium_list = dfn.equilibrium.get_equilibrium_list(result)
+    assert len(equilibrium_list) == 1
+    np.testing.assert_allclose(equilibrium_list[0]['density']['sink_0'], 0.6, atol=1e-8)
+    np.testing.assert_allclose(equilibrium_list[0]['eigenvalue'], [-1], atol=1e-6)
+
+
+def test_diverge_junction():
+    # Half of 0.6 to each sink: 0.3 = x_0 and 0.3 = 0.5 x_1.
+    result = dfn.equilibrium.solve(build(2), ['sink_0', 'sink_1'], lower=[0, 0], upper=[5, 5], num_start=16, seed=0)
+
+    equilibrium_list = dfn.equilibrium.get_equilibrium_list(result)
+    assert len(equilibrium_list) == 1
+    assert equilibrium_list[0]['stability'] == 'stable'
+    np.testing.assert_allclose([equilibrium_list[0]['density'][ID] for ID in ('sink_0', 'sink_1')], [0.3, 0.6], atol=1e-8)
+    np.testing.assert_allclose(np.sort(equilibrium_list[0]['eigenvalue'].real), [-1, -0.5], atol=1e-6)
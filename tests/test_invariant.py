@@ -0,0 +1,30 @@
+import numpy as np
+
+import dyflownet as dfn
+
+
+def build(num_step=2000):
+    # Source -> link -> sink, all empty; the sink settles at density 0.5.
+    net = dfn.net.Network(ID='net_0', state_len=1, num_step=num_step, time_step_size=0.1)
+    source_0 = dfn.cell.Source('source_0', initial_condition={'density': [0]}, boundary_inflow=dfn.flow.BoundaryInflow(0.5),
+                               sending=dfn.flow.BufferSendingFlow(0.5, ignore_queue=True))
+    link_0 = dfn.cell.Link('link_0', max_density=5, max_speed=1, initial_condition={'density': [0]},
+                           receiving=dfn.flow.PiecewiseLinearReceivingFlow(0.25, 5, 1), sending=dfn.flow.PiecewiseLinearSendingFlow(1, 1))
+    sink_0 = dfn.cell.Sink('sink_0', max_density=5, max_speed=1, initial_condition={'density': [0]},
+                           receiving=dfn.flow.PiecewiseLinearReceivingFlow(0.25, 5, 1), boundary_outflow=dfn.flow.BoundaryOutflow(1, 1))
+    net.add_cell('source', source_0)
+    net.add_cell('link', link_0)
+    net.add_cell('sink', sink_0)
+    net.add_node(dfn.node.BasicJunction('node_0', [source_0], [link_0]))
+    net.add_node(dfn.node.BasicJunction('node_1', [link_0], [sink_0]))
+    return net
+
+
+def test_basin_waits_for_delayed_arrival():
+    # The empty sink does not move in the first step, the empty link has sent nothing yet.
+    analysis = dfn.invariant.InvariantSetAnalysis(build(), ['sink_0'])
+    label = analysis.label_basin([[0.0], [2.0]], tol=1e-10)
+
+    np.testing.assert_array_equal(label, [0, 0])
+    assert len(analysis.attractor_list) == 1
+    np.testing.assert_allclose(analysis.attractor_list[0], [0.5], atol=1e-6)
@@ -0,0 +1,68 @@
+import numpy as np
+import pytest
+
+import dyflownet as dfn
+
+
+def build(state_len=2, num_step=200):
+    # Source -> link -> sink at steady state: flow 0.5 everywhere, densities 0.5 with free-flow speed 1 and cell_len 2.
+    net = dfn.net.Network(ID='net_0', state_len=state_len, num_step=num_step, time_step_size=0.1)
+    source_0 = dfn.cell.Source('source_0', max_speed=1, cell_len=2, initial_condition={'density': np.zeros(state_len)}, boundary_inflow=dfn.flow.BoundaryInflow(0.5),
+                               sending=dfn.flow.BufferSendingFlow(0.5, ignore_queue=True))
+    link_0 = dfn.cell.Link('link_0', max_density=5, max_speed=1, cell_len=2, initial_condition={'density': np.full(state_len, 0.5)},
+                           receiving=dfn.flow.PiecewiseLinearReceivingFlow(0.25, 5, 1), sending=dfn.flow.PiecewiseLinearSendingFlow(1, 1))
+    sink_0 = dfn.cell.Sink('sink_0', max_density=5, max_speed=1, cell_len=2, initial_condition={'density': np.full(state_len, 0.5)},
+                           receiving=dfn.flow.PiecewiseLinearReceivingFlow(0.25, 5, 1), boundary_outflow=dfn.flow.BoundaryOutflow(1, 1))
+    net.add_cell('source', source_0)
+    net.add_cell('link', link_0)
+    net.add_cell('sink', sink_0)
+    net.add_node(dfn.node.BasicJunction('node_0', [source_0], [link_0]))
+    net.add_node(dfn.node.BasicJunction('node_1', [link_0], [sink_0]))
+    return net
+
+
+@pytest.mark.parametrize('engine', ['array', 'object'])
+def test_cell_kpi_on_constant_flow(engine):
+    net = build()
+    kpi = net.add_metric(dfn.metrics.CellKPI())
+    net.run(engine=engine)
+
+    # Link: 1 vehicle on it, 0.5 veh/time leaving over 20 time units, at free-flow speed.
+    link = net.get_cell_list().index(net.link_list[0])
+    np.testing.assert_allclose(kpi.state['vehicle_distance'][link], 0.5 * 0.1 * 2 * 200)
+    np.testing.assert_allclose(kpi.state['vehicle_time'][link], 0.5 * 2 * 0.1 * 200)
+    np.testing.assert_allclose(kpi.state['delay'][link], 0, atol=1e-12)
+    np.testing.assert_allclose(kpi.state['cumulative_inflow'][link], 0.5 * 0.1 * 200)
+    np.testing.assert_allclose(kpi.state['cumulative_outflow'][link], 0.5 * 0.1 * 200)
+    np.testing.assert_allclose(kpi.state['max_vehicle'][link], 1)
+
+    summary = kpi.get_summary()
+    np.testing.assert_allclose(summary['throughput'], 0.5 * 0.1 * 200)
+    np.testing.assert_allclose(summary['source_queue'], 0, atol=1e-12)
+
+
+@pytest.mark.parametrize('engine', ['array', 'object'])
+def test_cumulative_count_on_constant_flow(engine):
+    net = build()
+    count = net.add_metric(dfn.metrics.CumulativeCount(net.node_list, initial_count=[[1], [0]], recorder=dfn.recorder.FullRecorder()))
+    net.run(engine=engine)
+
+    # N-curves: (num_boundary, state_len, num_step+1), growing by 0.5 * dt per step from their initial counts.
+    expected = np.array([1, 0])[:, None, None] + 0.5 * 0.1 * np.arange(201)
+    np.testing.assert_allclose(count.output, np.broadcast_to(expected, count.output.shape), rtol=0, atol=1e-12)
+    np.testing.assert_allclose(count.state['count'], count.output[..., -1])
+
+
+@pytest.mark.parametrize('engine', ['array', 'object'])
+def test_fifo_travel_time_on_constant_flow(engine):
+    net = build()
+    travel_time = net.add_metric(dfn.metrics.TravelTime(net.node_list[0], net.node_list[1], [net.link_list[0]], count_step=0.25, bin_edges=[0, 1.5, 2.5]))
+    net.run(engine=engine)
+
+    # Every vehicle entering the link takes cell_len / speed = 2; the one vehicle on it at the start gives no samples.
+    np.testing.assert_array_equal(travel_time.state['num_sample'], (0.5 * 20 - 1) / 0.25)
+    np.testing.assert_allclose(travel_time.get_mean(), 2)
+    np.testing.assert_allclose(travel_time.get_std(), 0, atol=1e-6)
+    np.testing.assert_allclose(travel_time.state['min'], 2)
+    np.testing.assert_allclose(travel_time.state['max'], 2)
+    np.testing.assert_array_equal(travel_time.state['histogram'][:, 1], travel_time.state['num_sample'])
@@ -0,0 +1,44 @@
+import numpy as np
+import pytest
+
+import dyflownet as dfn
+
+
+def build(state_len=5, num_step=50):
+    net = dfn.net.Network(ID='net_0', state_len=state_len, num_step=num_step, time_step_size=0.1)
+    source_0 = dfn.cell.Source('source_0', initial_condition={'density': np.zeros(state_len)}, boundary_inflow=dfn.flow.BoundaryInflow(np.linspace(0.2, 1, state_len)),
+                               sending=dfn.flow.BufferSendingFlow(0.5, ignore_queue=True))
+    link_0 = dfn.cell.Link('link_0', max_density=5, max_speed=1, initial_condition={'density': np.linspace(0, 4, state_len)},
+                           receiving=dfn.flow.PiecewiseLinearReceivingFlow(0.25, 5, 1), sending=dfn.flow.PiecewiseLinearSendingFlow(1, 1))
+    sink_0 = dfn.cell.Sink('sink_0', max_density=5, max_speed=1, initial_condition={'density': np.zeros(state_len)},
+                           receiving=dfn.flow.PiecewiseLinearReceivingFlow(0.25, 5, 1), boundary_outflow=dfn.flow.BoundaryOutflow(1, 1))
+    net.add_cell('source', source_0)
+    net.add_cell('link', link_0)
+    net.add_cell('sink', sink_0)
+    net.add_node(dfn.node.BasicJunction('node_0', [source_0], [link_0]))
+    net.add_node(dfn.node.BasicJunction('node_1', [link_0], [sink_0]))
+    return net
+
+
+def get_output_dict(net):
+    return {(name, kind, k): np.array(output) for name, unit in net.get_unit_dict().items()
+            for kind, output_dict in [('state', unit.state_output), ('co_state', unit.co_state_output)] for k, output in output_dict.items()}
+
+
+@pytest.mark.parametrize('engine', ['object', 'array'])
+@pytest.mark.parametrize('rule', [None, {'link_*:density': dfn.recorder.RingRecorder(7), 'node_*:*': dfn.recorder.DecimatedRecorder(4)}])
+def test_workers_match_one_process(engine, rule):
+    net_list = []
+    for workers in (None, 2):
+        net = build()
+        if rule is not None:
+            net.set_recorder(rule)
+        net.run(engine=engine, workers=workers)
+        net_list.append(net)
+
+    output_dict, worker_output_dict = get_output_dict(net_list[0]), get_output_dict(net_list[1])
+    assert output_dict.keys() == worker_output_dict.keys()
+    for k, v in output_dict.items():
+        np.testing.assert_array_equal(worker_output_dict[k], v, err_msg=str(k))
+    for cell, worker_cell in zip(net_list[0].get_cell_list(), net_list[1].get_cell_list()):
+        np.testing.assert_array_equal(worker_cell.state['density'], cell.state['density'])
@@ -0,0 +1,94 @@
+import os
+import threading
+
+import numpy as np
+import pytest
+
+import dyflownet as dfn
+from dyflownet.recorder import AsyncRecorder, FullRecorder, MemmapRecorder
+
+
+def build(state_len=3, num_step=50):
+    net = dfn.net.Network(ID='net_0', state_len=state_len, num_step=num_step, time_step_size=0.1)
+    source_0 = dfn.cell.Source('source_0', initial_condition={'density': np.zeros(state_len)}, boundary_inflow=dfn.flow.BoundaryInflow(0.5),
+                               sending=dfn.flow.BufferSendingFlow(0.5, ignore_queue=True))
+    link_0 = dfn.cell.Link('link_0', max_density=5, max_speed=1, initial_condition={'density': np.linspace(0, 4, state_len)},
+                           receiving=dfn.flow.PiecewiseLinearReceivingFlow(0.25, 5, 1), sending=dfn.flow.PiecewiseLinearSendingFlow(1, 1))
+    sink_0 = dfn.cell.Sink('sink_0', max_density=5, max_speed=1, initial_condition={'density': np.zeros(state_len)},
+                           receiving=dfn.flow.PiecewiseLinearReceivingFlow(0.25, 5, 1), boundary_outflow=dfn.flow.BoundaryOutflow(1, 1))
+    net.add_cell('source', source_0)
+    net.add_cell('link', link_0)
+    net.add_cell('sink', sink_0)
+    net.add_node(dfn.node.BasicJunction('node_0', [source_0], [link_0]))
+    net.add_node(dfn.node.BasicJunction('node_1', [link_0], [sink_0]))
+    return net
+
+
+def get_output_dict(net):
+    return {(name, kind, k): np.array(output) for name, unit in net.get_unit_dict().items()
+            for kind, output_dict in [('state', unit.state_output), ('co_state', unit.co_state_output)] for k, output in output_dict.items()}
+
+
+def is_writer_alive():
+    return any(thread.name == 'dyflownet-writer' and thread.is_alive() for thread in threading.enumerate())
+
+
+class FailingRecorder(FullRecorder):
+    def write_block(self, start, block):
+        raise OSError('disk full')
+
+
+def test_memmap_fills_unwritten_records_at_finalize(tmp_path):
+    recorder = MemmapRecorder(str(tmp_path)).new()
+    output = recorder.allocate((3, ), 10, name='cell_0:density')
+    for index in range(4):
+        recorder.write(index, np.full(3, index))
+    recorder.finalize()
+
+    saved = np.load(recorder.get_path())
+    np.testing.assert_array_equal(saved[:4], np.arange(4)[:, None] * np.ones(3))
+    assert np.isnan(saved[4:]).all()
+    np.testing.assert_array_equal(output, saved.T)
+
+
+@pytest.mark.parametrize('engine', ['object', 'array'])
+def test_memmap_files_are_named_after_units(tmp_path, engine):
+    net = build()
+    net.set_recorder(default=MemmapRecorder(str(tmp_path)))
+    net.run(engine=engine)
+
+    output_dict = get_output_dict(net)
+    assert sorted(os.listdir(tmp_path)) == sorted(f'{name}.{k}.npy' for name, _, k in output_dict)
+    for (name, _, k), v in output_dict.items():
+        np.testing.assert_array_equal(np.moveaxis(np.load(tmp_path / f'{name}.{k}.npy'), 0, -1), v, err_msg=f'{name}:{k}')
+
+
+@pytest.mark.parametrize('engine', ['object', 'array'])
+def test_async_matches_full_recorder(engine):
+    net = build()
+    net.run(engine=engine)
+    async_net = build()
+    async_net.set_recorder(default=AsyncRecorder(FullRecorder(), chunk_len=4, num_buffer=2))
+    async_net.run(engine=engine)
+
+    output_dict, async_output_dict = get_output_dict(net), get_output_dict(async_net)
+    assert output_dict.keys() == async_output_dict.keys()
+    for k, v in output_dict.items():
+        np.testing.assert_array_equal(async_output_dict[k], v, err_msg=str(k))
+    assert not is_writer_alive()
+
+    # A second run starts the writer again.
+    async_net.run(engine=engine)
+    for k, v in get_output_dict(async_net).items():
+        np.testing.assert_array_equal(v, output_dict[k], err_msg=str(k))
+    assert not is_writer_alive()
+
+
+def test_async_write_failure_is_raised():
+    net = build()
+    net.set_recorder({'link_0:density': AsyncRecorder(FailingRecorder(), chunk_len=4)})
+    with pytest.raises(RuntimeError, match='writer failed') as info:
+        net.run()
+
+    assert isinstance(info.value.__cause__, OSError)
+    assert not is_writer_alive()
@@ -0,0 +1,35 @@
+import numpy as np
+import pytest
+
+import dyflownet as dfn
+
+
+def build(demand, is_demand_constant=True, num_step=5000):
+    net = dfn.net.Network(ID='net_0', state_len=2, num_step=num_step, time_step_size=0.01)
+    source_0 = dfn.cell.Source('source_0', initial_condition={'density': [0, 0]}, boundary_inflow=dfn.flow.BoundaryInflow(0.5),
+                               sending=dfn.flow.BufferSendingFlow(demand, is_demand_constant=is_demand_constant, ignore_queue=True))
+    sink_0 = dfn.cell.Sink('sink_0', max_density=5, max_speed=1, initial_condition={'density': [0, 2]},
+                           receiving=dfn.flow.PiecewiseLinearReceivingFlow(0.25, 5, 1), boundary_outflow=dfn.flow.BoundaryOutflow(1, 1))
+    net.add_cell('source', source_0)
+    net.add_cell('sink', sink_0)
+    net.add_node(dfn.node.BasicJunction('node_0', [source_0], [sink_0]))
+    return net
+
+
+def test_time_varying_demand_is_rejected():
+    # A demand that is zero for the first 50 steps: the first steps are steady, but the run is not.
+    demand = np.where(np.arange(5000) < 50, 0.0, 0.5)[None, :]
+    net = build(demand, is_demand_constant=False)
+    with pytest.raises(ValueError, match='time-invariant'):
+        net.run(until='steady')
+
+
+def test_steady_matches_full_run():
+    full = build(0.5)
+    full.run()
+    net = build(0.5)
+    net.run(until='steady', tol=1e-10)
+
+    assert np.all(net.convergence_step > 0)
+    np.testing.assert_allclose(net.sink_list[0].state['density'], full.sink_list[0].state['density'], atol=1e-7)
+    np.testing.assert_allclose(net.sink_list[0].state['density'], 0.5, atol=1e-7)
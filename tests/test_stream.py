@@ -0,0 +1,84 @@
+import numpy as np
+import pytest
+
+import dyflownet as dfn
+
+
+def build(state_len=1, num_step=300, demand=0.5, is_demand_constant=True):
+    # Source -> link -> sink, all empty; the sink settles at density 0.5.
+    net = dfn.net.Network(ID='net_0', state_len=state_len, num_step=num_step, time_step_size=0.1)
+    source_0 = dfn.cell.Source('source_0', initial_condition={'density': np.zeros(state_len)}, boundary_inflow=dfn.flow.BoundaryInflow(0.5),
+                               sending=dfn.flow.BufferSendingFlow(demand, is_demand_constant=is_demand_constant, ignore_queue=True))
+    link_0 = dfn.cell.Link('link_0', max_density=5, max_speed=1, initial_condition={'density': np.zeros(state_len)},
+                           receiving=dfn.flow.PiecewiseLinearReceivingFlow(0.25, 5, 1), sending=dfn.flow.PiecewiseLinearSendingFlow(1, 1))
+    sink_0 = dfn.cell.Sink('sink_0', max_density=5, max_speed=1, initial_condition={'density': np.zeros(state_len)},
+                           receiving=dfn.flow.PiecewiseLinearReceivingFlow(0.25, 5, 1), boundary_outflow=dfn.flow.BoundaryOutflow(1, 1))
+    net.add_cell('source', source_0)
+    net.add_cell('link', link_0)
+    net.add_cell('sink', sink_0)
+    net.add_node(dfn.node.BasicJunction('node_0', [source_0], [link_0]))
+    net.add_node(dfn.node.BasicJunction('node_1', [link_0], [sink_0]))
+    return net
+
+
+def get_chunk_list(link_density, capacity):
+    return [{'link_0': link_density[:3], 'sink_0.receiving': {'capacity': capacity[:3]}},
+            {'link_0': link_density[3:], 'sink_0.receiving': {'capacity': capacity[3:]}}]
+
+
+@pytest.mark.parametrize('engine', ['array', 'object'])
+def test_chunks_match_full_run(engine):
+    # Chunks of 3 and 2 columns through chunk_size 2: split, and the last piece padded.
+    link_density = np.linspace(0, 4, 5)
+    capacity = np.linspace(0.2, 1, 5)
+
+    full = build(state_len=5)
+    full.link_list[0].set_initial_condition({'density': link_density})
+    full.sink_list[0].flow_dict['receiving'].param['capacity'] = capacity
+    full.run(engine=engine)
+
+    result = build().run_stream(get_chunk_list(link_density, capacity), 2, field_list=['*_0:density'], engine=engine)
+
+    np.testing.assert_array_equal(result['column'], np.arange(5))
+    for cell in full.get_cell_list():
+        np.testing.assert_allclose(result[f'{cell.ID}:density'], cell.state['density'], rtol=0, atol=1e-12)
+
+
+def test_npz_table_round_trip(tmp_path):
+    table = dfn.stream.NpzTable(str(tmp_path))
+    result = build().run_stream(get_chunk_list(np.linspace(0, 4, 5), np.ones(5)), 2)
+    build().run_stream(get_chunk_list(np.linspace(0, 4, 5), np.ones(5)), 2, consumer=table)
+
+    assert len(table.get_path_list()) == 3
+    loaded = table.load()
+    assert loaded.keys() == result.keys()
+    for k, v in result.items():
+        np.testing.assert_array_equal(loaded[k], v)
+
+
+def test_steady_waits_for_delayed_arrival():
+    # The sink does not move in the first step, while the empty link has sent nothing yet.
+    result = build(num_step=2000).run_stream([{'sink_0': np.zeros(2)}], 2, until='steady', tol=1e-10, cell_id_list=['sink_0'])
+
+    assert np.all(result['convergence_step'] > 1)
+    np.testing.assert_allclose(result['sink_0:density'], 0.5, atol=1e-7)
+
+
+def test_steady_matches_steady_run():
+    link_density = np.linspace(0, 4, 5)
+    net = build(state_len=5, num_step=2000)
+    net.link_list[0].set_initial_condition({'density': link_density})
+    net.run(until='steady', tol=1e-10)
+
+    result = build(num_step=2000).run_stream([{'link_0': link_density}], 2, until='steady', tol=1e-10)
+
+    np.testing.assert_array_equal(result['convergence_step'], net.convergence_step)
+    for cell in net.get_cell_list():
+        np.testing.assert_array_equal(result[f'{cell.ID}:density'], cell.state['density'])
+
+
+def test_steady_rejects_time_varying_inputs():
+    demand = np.where(np.arange(300) < 50, 0.0, 0.5)[None, :]
+    net = build(demand=demand, is_demand_constant=False)
+    with pytest.raises(ValueError, match='time-invariant'):
+        net.run_stream([{'sink_0': np.zeros(2)}], 2, until='steady', cell_id_list=['sink_0'])
@@ -0,0 +1,60 @@
+import numpy as np
+import pytest
+
+import dyflownet as dfn
+
+
+def build(state_len=2):
+    # Source -> link -> sink with cell_len 2, the source queue ignored.
+    net = dfn.net.Network(ID='net_0', state_len=state_len, num_step=10, time_step_size=0.1)
+    source_0 = dfn.cell.Source('source_0', cell_len=2, initial_condition={'density': np.zeros(state_len)}, boundary_inflow=dfn.flow.BoundaryInflow(0.5),
+                               sending=dfn.flow.BufferSendingFlow(0.5, ignore_queue=True))
+    link_0 = dfn.cell.Link('link_0', max_density=5, max_speed=1, cell_len=2, initial_condition={'density': np.linspace(0, 4, state_len)},
+                           receiving=dfn.flow.PiecewiseLinearReceivingFlow(0.25, 5, 1), sending=dfn.flow.PiecewiseLinearSendingFlow(1, 1))
+    sink_0 = dfn.cell.Sink('sink_0', max_density=5, max_speed=1, cell_len=2, initial_condition={'density': np.zeros(state_len)},
+                           receiving=dfn.flow.PiecewiseLinearReceivingFlow(0.25, 5, 1), boundary_outflow=dfn.flow.BoundaryOutflow(1, 1))
+    net.add_cell('source', source_0)
+    net.add_cell('link', link_0)
+    net.add_cell('sink', sink_0)
+    net.add_node(dfn.node.BasicJunction('node_0', [source_0], [link_0]))
+    net.add_node(dfn.node.BasicJunction('node_1', [link_0], [sink_0]))
+    return net
+
+
+def get_expected(link_density, sink_density):
+    # Demand 0.5 into the link, link sending min(x, 1) into the sink receiving min(0.25 (5 - y), 1), sink outflow min(y, 1).
+    inflow = np.minimum(0.5, np.clip(0.25 * (5 - link_density), 0, 1))
+    flow = np.minimum(np.clip(link_density, 0, 1), np.clip(0.25 * (5 - sink_density), 0, 1))
+    return {'source_0': (0.5 - inflow) / 2, 'link_0': (inflow - flow) / 2, 'sink_0': (flow - np.minimum(sink_density, 1)) / 2}
+
+
+@pytest.mark.parametrize('engine', ['array', 'object'])
+def test_matches_hand_computed_rate(engine):
+    link_density, sink_density = np.meshgrid(np.linspace(0, 5, 11), np.linspace(0, 5, 7), indexing='ij')
+    rate = build().vector_field({'link_0': link_density, 'sink_0': sink_density}, engine=engine)
+
+    for ID, expected in get_expected(link_density, sink_density).items():
+        np.testing.assert_allclose(rate[ID], expected, rtol=0, atol=1e-12, err_msg=ID)
+
+
+def test_does_not_depend_on_chunk_size():
+    density = np.random.default_rng(0).uniform(0, 5, (3, 37))
+    net = build()
+    rate = net.vector_field(density)
+
+    for chunk_size in (1, 5, 36):
+        np.testing.assert_array_equal(net.vector_field(density, chunk_size=chunk_size), rate)
+
+
+def test_leaves_network_unchanged():
+    net = build()
+    net.run()
+    density_list = [c.state['density'].copy() for c in net.get_cell_list()]
+    output_list = [c.state_output['density'].copy() for c in net.get_cell_list()]
+
+    net.vector_field(np.ones((3, 4)), chunk_size=3)
+
+    assert net.step == net.param['num_step']
+    for c, density, output in zip(net.get_cell_list(), density_list, output_list):
+        np.testing.assert_array_equal(c.state['density'], density)
+        np.testing.assert_array_equal(c.state_output['density'], output)